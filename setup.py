@@ -19,5 +19,11 @@ setup(
 
     packages=find_packages(),
 
-    install_requires=['flask==2.1.2', 'flask-restx>=0.5.1', 'werkzeug==2.0.2'],
+    install_requires=['flask==2.1.2', 'flask-restx>=0.5.1', 'werkzeug==2.0.2', 'gunicorn'],
+
+    entry_points={
+        'console_scripts': [
+            'tdt-api=tdt_api.app:main',
+        ],
+    },
 )
\ No newline at end of file
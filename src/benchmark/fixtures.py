@@ -0,0 +1,88 @@
+import os
+import stat
+import subprocess
+
+RLTBL_STUB = """#!/bin/sh
+# Benchmark stand-in for rltbl: answers every CGI request with a {size} bytes page after {latency} seconds.
+[ "$REQUEST_METHOD" = "POST" ] && cat > /dev/null
+sleep {latency}
+printf 'Status: 200 OK\\r\\nContent-Type: text/html\\r\\nContent-Length: {size}\\r\\n\\r\\n'
+head -c {size} /dev/zero | tr '\\000' 'x'
+"""
+
+MAKEFILE = """init:
+\tmkdir -p .relatable && touch .relatable/relatable.db
+"""
+
+TAXONOMY_DETAILS = """title: Benchmark taxonomy
+species: Homo sapiens
+"""
+
+
+def write_rltbl_stub(path, size, latency):
+    """
+    Writes the fake rltbl CGI script.
+    :param path: path of the script
+    :param size: size of the response bodies in bytes
+    :param latency: seconds each request takes
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(RLTBL_STUB.format(size=int(size), latency=float(latency)))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def git(*args, cwd=None):
+    subprocess.run(('git',) + args, cwd=cwd, check=True, capture_output=True)
+
+
+def create_origin(root, rltbl_size, rltbl_latency):
+    """
+    Creates the bare repository the synthetic taxonomies are cloned from: a Makefile whose init target creates an empty
+    relatable database, the fake rltbl and a taxonomy details file.
+    :return: path of the bare repository
+    """
+    work_dir = os.path.join(root, 'template')
+    os.makedirs(work_dir)
+    write_rltbl_stub(os.path.join(work_dir, 'bin', 'rltbl'), rltbl_size, rltbl_latency)
+    with open(os.path.join(work_dir, 'Makefile'), 'w') as file:
+        file.write(MAKEFILE)
+    with open(os.path.join(work_dir, 'taxonomy_details.yaml'), 'w') as file:
+        file.write(TAXONOMY_DETAILS)
+    git('init', '-q', '-b', 'main', cwd=work_dir)
+    git('add', '.', cwd=work_dir)
+    git('-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost', 'commit', '-q', '-m', 'Template',
+        cwd=work_dir)
+    origin = os.path.join(root, 'origins', 'template.git')
+    git('clone', '-q', '--bare', work_dir, origin)
+    return origin
+
+
+def origin_url(origin, name):
+    """
+    Returns the URL of the origin repository of the named taxonomy. Every name is a symbolic link to the template
+    repository, so that any number of distinct taxonomies can be cloned from it.
+    """
+    link = os.path.join(os.path.dirname(origin), name + '.git')
+    if not os.path.exists(link):
+        os.symlink(origin, link)
+    return link
+
+
+def create_volume(root, taxonomies, rltbl_size=16 * 1024, rltbl_latency=0.01):
+    """
+    Creates a taxonomies volume with initialized synthetic taxonomies named tax_0, tax_1...
+    :param root: empty folder holding the origin repositories and the volume
+    :param taxonomies: number of taxonomies
+    :param rltbl_size: size of the fake rltbl responses in bytes
+    :param rltbl_latency: latency of the fake rltbl in seconds
+    :return: volume folder and origin repository
+    """
+    origin = create_origin(root, rltbl_size, rltbl_latency)
+    volume = os.path.join(root, 'volume')
+    os.makedirs(volume)
+    for i in range(taxonomies):
+        name = f'tax_{i}'
+        git('clone', '-q', '--branch', 'main', origin_url(origin, name), os.path.join(volume, name))
+        subprocess.run(['make', 'init'], cwd=os.path.join(volume, name), check=True, capture_output=True)
+    return volume, origin
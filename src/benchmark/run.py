@@ -0,0 +1,313 @@
+"""
+Offline benchmark of the TDT API.
+
+Serves the API in-process against a synthetic taxonomies volume, a fake rltbl and a fake GitHub API, and reports the
+throughput and latency percentiles of the main endpoints at several concurrency levels. Results can be saved as a
+JSON baseline and later runs compared against it:
+
+    cd src
+    python -m benchmark.run --save benchmark/baseline.json
+    python -m benchmark.run --compare benchmark/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import contextlib
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark.fixtures import create_volume, origin_url
+from test.fake_github import FakeGitHub
+
+TOKEN_SECRET = 'benchmark-token-secret-of-32-bytes-or-more'
+ADMIN_SECRET = 'benchmark-admin-secret'
+ORG = 'bench-org'
+USERS = 20
+
+SCENARIOS = ('browser_get', 'browser_get_cached', 'browser_post', 'session_info', 'check_permissions',
+             'admin_reload', 'admin_init')
+ADMIN_SCENARIOS = ('admin_reload', 'admin_init')
+
+
+def percentile(values, fraction):
+    """
+    Returns the given percentile of the sorted values, interpolating between the closest ranks.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(latencies, errors, elapsed, statuses):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "statuses": statuses,
+        "seconds": round(elapsed, 4),
+        "throughput": round(count / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(latencies) / count * 1000, 3) if count else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if count else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if count else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if count else None,
+        "max_ms": round(latencies[-1] * 1000, 3) if count else None,
+    }
+
+
+class Benchmark:
+    """
+    Runs the scenarios against an application created on a synthetic volume.
+    """
+
+    def __init__(self, app, volume, origin, taxonomies):
+        self.app = app
+        self.volume = volume
+        self.origin = origin
+        self.taxonomies = taxonomies
+        self.local = threading.local()
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+        import jwt
+        self.tokens = [jwt.encode({'name': f'user_{i}', 'email': f'user_{i}@localhost', 'repoOrg': ORG},
+                                  TOKEN_SECRET, algorithm='HS256') for i in range(USERS)]
+
+    @property
+    def client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.app.test_client()
+            self.local.client = client
+        return client
+
+    def next_id(self):
+        with self.counter_lock:
+            self.counter += 1
+            return self.counter
+
+    def taxonomy(self, i):
+        return f'tax_{i % self.taxonomies}'
+
+    def browser_get(self, i):
+        return self.client.get(f'/api/browser/{self.taxonomy(i)}/table?offset={self.next_id()}')
+
+    def browser_get_cached(self, i):
+        return self.client.get(f'/api/browser/{self.taxonomy(i)}/table')
+
+    def browser_post(self, i):
+        return self.client.post(f'/api/browser/{self.taxonomy(i)}/table', data=f'row={i}',
+                                content_type='application/x-www-form-urlencoded')
+
+    def session_info(self, i):
+        return self.client.get(f'/api/session_info/{self.taxonomy(i)}?token={self.tokens[i % USERS]}')
+
+    def check_permissions(self, i):
+        return self.client.get(f'/api/check_permissions/{ORG}/{self.taxonomy(i)}/user_{i % USERS}')
+
+    def admin_reload(self, i):
+        """
+        Reloads a taxonomy and waits for the background job to finish.
+        """
+        return self.wait_for_job(self.client.post('/admin_api/reload_taxonomy', json={
+            'repository': origin_url(self.origin, self.taxonomy(i)), 'branch': 'main', 'mode': 'incremental',
+            'admin_secret': ADMIN_SECRET}))
+
+    def admin_init(self, i):
+        """
+        Initializes a new taxonomy and waits for the background job to finish.
+        """
+        name = f'init_{self.next_id()}'
+        response = self.wait_for_job(self.client.post('/admin_api/init_taxonomies', json={
+            'repositories': {origin_url(self.origin, name): 'main'}, 'admin_secret': ADMIN_SECRET}))
+        shutil.rmtree(os.path.join(self.volume, name), ignore_errors=True)
+        return response
+
+    def wait_for_job(self, response):
+        """
+        Polls the job started by the response until it finished.
+        :return: last job status response
+        """
+        if response.status_code != 202:
+            return response
+        job_id = response.get_json()['job_id']
+        while True:
+            response = self.client.get(f'/admin_api/jobs/{job_id}')
+            if response.get_json()['status'] not in ('pending', 'running'):
+                return response
+            time.sleep(0.01)
+
+    def run(self, scenario, concurrency, requests):
+        """
+        Sends the given number of requests of the scenario from concurrency threads.
+        :return: summary of the run
+        """
+        call = getattr(self, scenario)
+        latencies = []
+        statuses = dict()
+        errors = 0
+        lock = threading.Lock()
+        sequence = iter(range(requests))
+
+        def worker():
+            nonlocal errors
+            while True:
+                with lock:
+                    i = next(sequence, None)
+                if i is None:
+                    return
+                start = time.perf_counter()
+                try:
+                    response = call(i)
+                    response.get_data()
+                    response.close()
+                    status = response.status_code
+                    failed = status >= 500 or (scenario in ADMIN_SCENARIOS
+                                               and response.get_json()['status'] != 'succeeded')
+                except Exception as e:
+                    status, failed = type(e).__name__, True
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[str(status)] = statuses.get(str(status), 0) + 1
+                    errors += failed
+
+        # one request per thread first, so that the clients and the lazily created pools are warm
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(call, i) for i in range(min(concurrency, 4))]:
+                future.result().close()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        return summarize(latencies, errors, time.perf_counter() - start, statuses)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change of throughput and p95 latency against the baseline.
+    :return: list of the scenarios whose p95 latency regressed by more than the tolerance
+    """
+    regressions = []
+    print(f"\n{'scenario':<20}{'concurrency':>12}{'p95 ms':>12}{'baseline':>12}{'change':>9}{'req/s':>10}"
+          f"{'baseline':>10}")
+    for scenario, levels in results["results"].items():
+        for concurrency, result in levels.items():
+            previous = baseline.get("results", {}).get(scenario, {}).get(concurrency)
+            if previous is None or not previous.get("p95_ms") or result["p95_ms"] is None:
+                continue
+            change = result["p95_ms"] / previous["p95_ms"] - 1
+            print(f"{scenario:<20}{concurrency:>12}{result['p95_ms']:>12.2f}{previous['p95_ms']:>12.2f}"
+                  f"{change:>+9.0%}{result['throughput']:>10.1f}{previous['throughput']:>10.1f}")
+            if change > tolerance:
+                regressions.append(f"{scenario}@{concurrency}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the TDT API.")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma separated scenarios to run.")
+    parser.add_argument('--concurrency', default='1,8,32', help="Comma separated concurrency levels.")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per scenario and concurrency level.")
+    parser.add_argument('--admin-requests', type=int, default=10,
+                        help="Requests per concurrency level of the admin scenarios.")
+    parser.add_argument('--taxonomies', type=int, default=4, help="Number of synthetic taxonomies.")
+    parser.add_argument('--rltbl-size', type=int, default=16 * 1024, help="Size of the fake rltbl responses.")
+    parser.add_argument('--rltbl-latency', type=float, default=0.01, help="Seconds each fake rltbl call takes.")
+    parser.add_argument('--github-latency', type=float, default=0.05, help="Seconds each fake GitHub call takes.")
+    parser.add_argument('--verbose', action='store_true', help="Show the logs and output of the API.")
+    parser.add_argument('--save', help="Write the results to this JSON file.")
+    parser.add_argument('--compare', help="Compare the results with this JSON baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="p95 latency increase over the baseline reported as a regression.")
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    root = tempfile.mkdtemp(prefix='tdt-benchmark-')
+    permissions = {(ORG, f'tax_{t}', f'user_{u}'): 'write' if u % 2 else 'read'
+                   for t in range(args.taxonomies) for u in range(USERS // 2)}
+    try:
+        with FakeGitHub(permissions, {ORG: {f'user_{u}' for u in range(USERS // 2)}},
+                        latency=args.github_latency, rate_limit=10 ** 9) as github:
+            volume, origin = create_volume(root, args.taxonomies, args.rltbl_size, args.rltbl_latency)
+            # the configuration is read when the modules are imported
+            os.environ.update({
+                'TAXONOMIES_VOLUME': volume,
+                'RLTBL_ROOT': '/api/browser/',
+                'GITHUB_API_URL': github.url,
+                'GITHUB_TOKEN': 'benchmark',
+                'TOKEN_SECRET': TOKEN_SECRET,
+                'ADMIN_SECRET': ADMIN_SECRET,
+                'TAXONOMY_INDEX_POLL_INTERVAL': '0',
+                'RLTBL_QUEUE_TIMEOUT': os.environ.get('RLTBL_QUEUE_TIMEOUT', '120'),
+                'RLTBL_MAX_QUEUE': os.environ.get('RLTBL_MAX_QUEUE', str(max(levels) * 2)),
+            })
+            from tdt_api.app import create_app, on_worker_exit
+            benchmark = Benchmark(create_app(), volume, origin, args.taxonomies)
+
+            results = dict()
+            output = sys.stdout if args.verbose else open(os.devnull, 'w')
+            try:
+                for scenario in scenarios:
+                    requests = args.admin_requests if scenario in ADMIN_SCENARIOS else args.requests
+                    for concurrency in levels:
+                        # the endpoints print to stdout
+                        with contextlib.redirect_stdout(output):
+                            result = benchmark.run(scenario, concurrency, requests)
+                        results.setdefault(scenario, dict())[str(concurrency)] = result
+                        print(f"{scenario:<20} c={concurrency:<4} {result['throughput']:>9.1f} req/s  "
+                              f"p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms  "
+                              f"p99 {result['p99_ms']:>8.2f} ms  errors {result['errors']}", flush=True)
+            finally:
+                on_worker_exit()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {key: value for key, value in vars(args).items() if key not in ('save', 'compare')},
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        if regressions:
+            print(f"p95 latency regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,219 @@
 import os
-from flask import Flask, Blueprint
-from restx import api
+import logging
+import argparse
+import multiprocessing
+from flask import Flask, Blueprint, Response
+from tdt_api.restx import api
 from tdt_api.endpoints.taxonomy_service import api as api_namespace
 from tdt_api.endpoints.admin_service import api as admin_api_namespace
+from tdt_api.utils import sqlite_reader, scheduler, metrics, jwt_utils
+from tdt_api.utils.governor import governor
+from tdt_api.utils.response_cache import browser_cache
+from tdt_api.utils.init_manager import init_manager
+from tdt_api.utils.job_manager import job_manager
+from tdt_api.utils.warmup import warmup
+from tdt_api.utils.github_client import github_client
+from tdt_api.utils.github_utils import permission_cache, org_role_cache
+from tdt_api.utils.taxonomy_index import taxonomy_index
+from tdt_api.utils.search_index import search_index
 from flask_cors import CORS
 from dotenv import load_dotenv
 
-app = Flask(__name__)
-CORS(app)
-app.config["CORS_HEADERS"] = "Content-Type"
+log = logging.getLogger(__name__)
 
 # Get URL prefix from environment variable or uses root ('/') by default
 url_prefix = os.environ.get("TDT_URL_PREFIX", "")
 
-blueprint = Blueprint("tdt", __name__, url_prefix=url_prefix)
+# Settings of the production server (tdt-api serve)
+TDT_BIND = os.getenv("TDT_BIND", "0.0.0.0:8080")
+TDT_WORKERS = int(os.getenv("TDT_WORKERS", str(min(2 * multiprocessing.cpu_count(), 8))))
+TDT_THREADS = int(os.getenv("TDT_THREADS", "8"))
+TDT_TIMEOUT = int(os.getenv("TDT_TIMEOUT", "120"))
+TDT_GRACEFUL_TIMEOUT = int(os.getenv("TDT_GRACEFUL_TIMEOUT", "30"))
+TDT_KEEPALIVE = int(os.getenv("TDT_KEEPALIVE", "5"))
+TDT_MAX_REQUESTS = int(os.getenv("TDT_MAX_REQUESTS", "0"))
 
 
-def initialize_app(flask_app):
+_app = None
+
+
+def create_app():
+    """
+    Application factory. Creates the Flask application with the TDT API registered on it. The API is a module level
+    singleton, so the application is created once per process and returned by subsequent calls.
+    """
+    global _app
+    if _app is not None:
+        return _app
+    if os.path.exists('.env'):
+        load_dotenv('.env')
+    jwt_utils.configure()
+
+    flask_app = Flask(__name__)
+    CORS(flask_app)
+    flask_app.config["CORS_HEADERS"] = "Content-Type"
+
+    blueprint = Blueprint("tdt", __name__, url_prefix=url_prefix)
+    initialize_app(flask_app, blueprint)
+    taxonomy_index.build()
+    job_manager.recover()
+    taxonomy_index.add_listener(search_index.on_taxonomy_changed)
+    search_index.start_sync({entry["name"]: entry["species"] for entry in taxonomy_index.list()[1]})
+    taxonomy_index.start_watcher()
+    warmup.start()
+    _app = flask_app
+    return flask_app
+
+
+def initialize_app(flask_app, blueprint):
+    if metrics.METRICS_ENABLED:
+        blueprint.add_url_rule("/metrics", "metrics", metrics_endpoint)
+        metrics.init_app(flask_app)
+        metrics.register_collector(collect_component_metrics)
+        # every worker sees the same rate limit, the lowest value is the most recent
+        metrics.aggregate_gauge("tdt_github_rate_limit_remaining", "min")
     api.init_app(blueprint)
     api.add_namespace(api_namespace)
     api.add_namespace(admin_api_namespace)
     flask_app.register_blueprint(blueprint)
 
 
+def metrics_endpoint():
+    """
+    Prometheus metrics of the server, of all the worker processes when PROMETHEUS_MULTIPROC_DIR is set.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def collect_component_metrics():
+    """
+    Exports the statistics kept by the caches and the rltbl scheduler.
+    """
+    result = [
+        ("tdt_response_cache_requests_total", "counter", "Browser response cache lookups.",
+         [({"result": "hit"}, browser_cache.hits), ({"result": "miss"}, browser_cache.misses)]),
+        ("tdt_response_cache_evictions_total", "counter", "Responses evicted from the browser cache.",
+         [({}, browser_cache.evictions)]),
+        ("tdt_response_cache_bytes", "gauge", "Size of the cached response bodies.", [({}, browser_cache.size)]),
+    ]
+    sessions = jwt_utils.session_cache.stats()
+    result.append(("tdt_session_cache_requests_total", "counter", "Verified session cache lookups.",
+                   [({"result": "hit"}, sessions["hits"]), ({"result": "miss"}, sessions["misses"])]))
+    result.append(("tdt_session_cache_size", "gauge", "Verified sessions in the cache.", [({}, sessions["size"])]))
+    permissions = permission_cache.stats()
+    result.append(("tdt_permission_cache_requests_total", "counter", "Permission cache lookups.",
+                   [({"result": name}, permissions[name]) for name in ("hits", "stale_hits", "misses")]))
+    result.append(("tdt_permission_cache_loads_total", "counter", "Permissions loaded from GitHub.",
+                   [({"result": "ok"}, permissions["loads"] - permissions["errors"]),
+                    ({"result": "error"}, permissions["errors"])]))
+    if github_client.rate_limit_remaining is not None:
+        result.append(("tdt_github_rate_limit_remaining", "gauge", "GitHub API calls left in the rate limit window.",
+                       [({}, github_client.rate_limit_remaining)]))
+
+    taxonomies = scheduler.stats()
+    result.append(("tdt_rltbl_active", "gauge", "Running rltbl calls.",
+                   [({"taxonomy": name, "mode": "read"}, stats["readers"]) for name, stats in taxonomies.items()] +
+                   [({"taxonomy": name, "mode": "write"}, int(stats["writing"])) for name, stats in taxonomies.items()]))
+    result.append(("tdt_rltbl_queued", "gauge", "rltbl calls waiting for their turn.",
+                   [({"taxonomy": name}, stats["queued"]) for name, stats in taxonomies.items()]))
+    result.append(("tdt_rltbl_rejected_total", "counter", "rltbl calls rejected with 503.",
+                   [({"taxonomy": name, "reason": reason}, stats[key]) for name, stats in taxonomies.items()
+                    for reason, key in (("queue_full", "rejected"), ("timeout", "timeouts"))]))
+    processes = governor.stats()
+    result.append(("tdt_subprocess_active", "gauge", "Running subprocesses.",
+                   [({"priority": priority}, count) for priority, count in processes["running"].items()]))
+    result.append(("tdt_subprocess_waiting", "gauge", "Subprocesses waiting for a slot.",
+                   [({"priority": priority}, count) for priority, count in processes["waiting"].items()]))
+    result.append(("tdt_subprocess_rejected_total", "counter", "Subprocesses rejected for lack of a free slot.",
+                   [({"priority": priority}, count) for priority, count in processes["rejected"].items()]))
+    result.append(("tdt_subprocess_killed_total", "counter", "Subprocesses killed by a timeout or a signal.",
+                   [({"priority": priority, "reason": reason}, count)
+                    for (priority, reason), count in processes["killed"].items()]))
+    return result
+
+
+def on_worker_start():
+    """
+    Runs in each server worker after it is forked. Drops connections and executor state that may have been inherited
+    from the parent process, so that every worker creates its own pools on first use.
+    """
+    github_client.close()
+    permission_cache.shutdown()
+    org_role_cache.shutdown()
+    metrics.start_collector()
+
+
+def on_worker_exit():
+    """
+    Runs when a server worker stops after its in-flight requests were drained: closes the database connections and stops
+    the background executors.
+    """
+    taxonomy_index.stop_watcher()
+    sqlite_reader.close_pools()
+    init_manager.shutdown(wait=False)
+    job_manager.shutdown(wait=False)
+    permission_cache.shutdown()
+    org_role_cache.shutdown()
+    github_client.close()
+    search_index.close()
+    metrics.stop_collector()
+
+
+def serve():
+    """
+    Serves the API with gunicorn using TDT_WORKERS processes of TDT_THREADS threads each.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    if metrics.PROMETHEUS_MULTIPROC_DIR:
+        metrics.init_directory()
+    elif TDT_WORKERS > 1:
+        log.warning("PROMETHEUS_MULTIPROC_DIR is not set, /metrics reports the worker serving the scrape only.")
+
+    class TdtApplication(BaseApplication):
+
+        def load_config(self):
+            options = {
+                "bind": TDT_BIND,
+                "workers": TDT_WORKERS,
+                "threads": TDT_THREADS,
+                "worker_class": "gthread" if TDT_THREADS > 1 else "sync",
+                "timeout": TDT_TIMEOUT,
+                "graceful_timeout": TDT_GRACEFUL_TIMEOUT,
+                "keepalive": TDT_KEEPALIVE,
+                "max_requests": TDT_MAX_REQUESTS,
+                "max_requests_jitter": TDT_MAX_REQUESTS // 10,
+                "accesslog": "-",
+                "post_fork": lambda server, worker: on_worker_start(),
+                "worker_exit": lambda server, worker: on_worker_exit(),
+                "child_exit": lambda server, worker: metrics.mark_worker_dead(worker.pid),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # the application is created in each worker, after the fork
+            return create_app()
+
+    log.info(f"Serving TDT API on {TDT_BIND} with {TDT_WORKERS} workers x {TDT_THREADS} threads.")
+    TdtApplication().run()
+
+
 def main():
-    if os.path.exists('.env'):
-        load_dotenv('.env')
+    parser = argparse.ArgumentParser(prog="tdt-api", description="Taxonomy Development Tools restful API.")
+    parser.add_argument("command", nargs="?", choices=["run", "serve"], default="run",
+                        help="'run' starts the development server, 'serve' the production server.")
+    args = parser.parse_args()
 
-    initialize_app(app)
-    app.run(host="0.0.0.0", port=8080, debug=False)
+    if args.command == "serve":
+        serve()
+    else:
+        app = create_app()
+        try:
+            app.run(host="0.0.0.0", port=8080, debug=False, threaded=True)
+        finally:
+            on_worker_exit()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,12 +2,14 @@ import os
 import flask
 import logging
 import subprocess
+from functools import partial
 from flask_restx import Resource, fields
 from tdt_api.restx import api
 from flask import send_from_directory, request, make_response, jsonify
 from tdt_api.exception.api_exception import ApiException
-from tdt_api.utils.command_line_utils import runcmd
-from tdt_api.utils.github_utils import init_taxonomy_folder
+from tdt_api.utils.job_manager import job_manager
+from tdt_api.utils import scheduler
+from tdt_api.utils.taxonomy_jobs import init_taxonomy_task, reload_taxonomy_task
 
 
 TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
@@ -38,6 +40,13 @@ init_taxonomies_model = api.model('InitTaxonomies', {
 reload_taxonomy_model = api.model('ReloadTaxonomy', {
     'repository': fields.String(required=True, example="https://github.com/brain-bican/human-brain-cell-atlas_v1_neurons"),
     'branch': fields.String(required=True, example="cloud"),
+    'mode': fields.String(required=False, enum=['incremental', 'full'], default='incremental',
+                          description="'incremental' fetches the branch and swaps in the updated copy once it is "
+                                      "built, 'full' deletes the taxonomy and clones it again."),
+    'admin_secret': fields.String(required=True, example="your_admin_secret")
+})
+
+cancel_job_model = api.model('CancelJob', {
     'admin_secret': fields.String(required=True, example="your_admin_secret")
 })
 
@@ -45,7 +54,8 @@ reload_taxonomy_model = api.model('ReloadTaxonomy', {
 class InitTaxonomiesEndpoint(Resource):
 
     @api.expect(init_taxonomies_model, validate=True)
-    @api.doc(description="Initializes the taxonomies folder structure in the server.")
+    @api.doc(description="Initializes the taxonomies folder structure in the server. Repositories are cloned and "
+                         "initialized by a background job, use /admin_api/jobs/<job_id> to follow its progress.")
     def post(self):
         data = request.get_json()
         repo_urls = data.get('repositories')
@@ -56,7 +66,9 @@ class InitTaxonomiesEndpoint(Resource):
         elif not repo_urls:
             raise ApiException("Invalid request data. 'repositories' is mandatory data.", 400)
 
+        tasks = dict()
         for repo_url in repo_urls:
+            branch = repo_urls[repo_url]
             if not str(repo_url).endswith(".git"):
                 repo_url = repo_url + ".git"
             repo_name = str(repo_url).split("/")[-1].split(".")[0]
@@ -64,23 +76,71 @@ class InitTaxonomiesEndpoint(Resource):
             check_directory_traversal_attack(repo_name, taxonomy_dir)
 
             if not os.path.exists(taxonomy_dir):
-                log.info(f"Taxonomy {repo_name} does not exist. Initializing...")
-                branch = repo_urls[repo_url]
-                init_taxonomy_folder(branch, repo_url, TAXONOMIES_VOLUME, taxonomy_dir)
-                log.info(f"Taxonomy {repo_name} initialized successfully.")
+                tasks[repo_name] = partial(init_taxonomy_task, repo_name, branch, repo_url, taxonomy_dir)
+
+        job = job_manager.submit("init_taxonomies", tasks)
+        return {"job_id": job.id, "status": job.status.value, "repositories": list(tasks)}, 202
+
+
+@api.route('/jobs', methods=['GET'])
+class JobsEndpoint(Resource):
+
+    @api.doc(description="Returns the most recent background jobs, newest first.",
+             params={'limit': 'Maximum number of jobs to return (default 20).'})
+    def get(self):
+        limit = request.args.get('limit', 20, type=int)
+        if limit < 1:
+            raise ApiException("'limit' must be positive.", 400)
+        return job_manager.list(min(limit, job_manager.history_size)), 200
+
+
+@api.route('/jobs/<string:job_id>', methods=['GET'])
+class JobEndpoint(Resource):
+
+    @api.doc(description="Returns the status of a background job with the progress, timing and errors of its tasks, "
+                         "and the commands each task ran with their output and duration.")
+    def get(self, job_id):
+        job = job_manager.get(job_id)
+        if job is None:
+            raise ApiException(f"Job {job_id} not found.", 404)
+        return job.to_dict(), 200
 
-        return "Taxonomies updated successfully.", 200
+
+@api.route('/jobs/<string:job_id>/cancel', methods=['POST'])
+class CancelJobEndpoint(Resource):
+
+    @api.expect(cancel_job_model, validate=True)
+    @api.doc(description="Cancels a background job: its queued tasks are skipped and the running commands are "
+                         "terminated.")
+    def post(self, job_id):
+        data = request.get_json()
+        if data.get('admin_secret') != ADMIN_SECRET:
+            raise ApiException("Invalid admin secret.", 403)
+        job = job_manager.cancel(job_id)
+        if job is None:
+            raise ApiException(f"Job {job_id} not found.", 404)
+        return job.to_dict(), 202
+
+
+@api.route('/scheduler', methods=['GET'])
+class SchedulerEndpoint(Resource):
+
+    @api.doc(description="Returns the active, queued and rejected rltbl calls and the queue wait times per taxonomy.")
+    def get(self):
+        return scheduler.stats(), 200
 
 
 @api.route('/reload_taxonomy', methods=['POST'])
 class ReloadTaxonomy(Resource):
 
     @api.expect(reload_taxonomy_model, validate=True)
-    @api.doc(description="Reloads the given taxonomy in the server.")
+    @api.doc(description="Reloads the given taxonomy in the server in a background job, use /admin_api/jobs/<job_id> "
+                         "to follow its progress.")
     def post(self):
         data = request.get_json()
         repo_url = data.get('repository')
         branch = data.get('branch')
+        mode = data.get('mode', 'incremental')
         admin_secret = data.get('admin_secret')
 
         if admin_secret != ADMIN_SECRET:
@@ -92,15 +152,9 @@ class ReloadTaxonomy(Resource):
         taxonomy_dir = os.path.join(TAXONOMIES_VOLUME, repo_name)
         check_directory_traversal_attack(repo_name, taxonomy_dir)
 
-        if os.path.exists(taxonomy_dir):
-            # delete taxonomy folder
-            runcmd(f"rm -rf {taxonomy_dir}")
-            log.info(f"Taxonomy {repo_name} deleted successfully.")
-
-        init_taxonomy_folder(branch, repo_url, TAXONOMIES_VOLUME, taxonomy_dir)
-        log.info(f"Taxonomy {repo_name} initialized successfully.")
-
-        return "Taxonomies updated successfully.", 200
+        job = job_manager.submit("reload_taxonomy", {
+            repo_name: partial(reload_taxonomy_task, repo_name, branch, repo_url, taxonomy_dir, mode)})
+        return {"job_id": job.id, "status": job.status.value, "repository": repo_name, "mode": mode}, 202
 
 def check_directory_traversal_attack(folder_name, target_dir, safe_dir=TAXONOMIES_VOLUME):
     """
@@ -110,7 +164,8 @@ def check_directory_traversal_attack(folder_name, target_dir, safe_dir=TAXONOMIE
     :param safe_dir: safe directory that data can be stored
     :return:
     """
-    if os.path.commonprefix(
+    # the folders starting with a dot are the internal folders of the volume
+    if not folder_name or folder_name.startswith('.') or os.path.commonprefix(
             (os.path.realpath(target_dir), safe_dir)) != safe_dir:
         raise ApiException("Invalid repository name: " + folder_name, 400)
 
@@ -8,4 +8,18 @@ search_arguments.add_argument('rank', type=str, required=False)
 search_arguments.add_argument('limit', type=int, required=False)
 
 get_arguments = reqparse.RequestParser()
-get_arguments.add_argument('identifier', type=str, action="append", required=True)
\ No newline at end of file
+get_arguments.add_argument('identifier', type=str, action="append", required=True)
+
+taxonomies_arguments = reqparse.RequestParser()
+taxonomies_arguments.add_argument('offset', type=int, required=False, default=0)
+taxonomies_arguments.add_argument('limit', type=int, required=False, default=100)
+taxonomies_arguments.add_argument('fields', type=str, required=False,
+                                  help="Comma separated list of the fields to return.")
+
+data_arguments = reqparse.RequestParser()
+data_arguments.add_argument('columns', type=str, required=False,
+                            help="Comma separated list of the columns to return, all columns by default.")
+data_arguments.add_argument('after', type=int, required=False,
+                            help="Cursor returned by the previous page, the first page if omitted.")
+data_arguments.add_argument('limit', type=int, required=False, default=100)
+data_arguments.add_argument('format', type=str, required=False, choices=('json', 'ndjson'))
@@ -1,13 +1,31 @@
 import os
 import flask
+import time
 import logging
+import sqlite3
 import subprocess
-from flask_restx import Resource
+from functools import partial
+from flask_restx import Resource, fields
 from tdt_api.restx import api
-from flask import send_from_directory, request, make_response, jsonify
+from flask import send_from_directory, request, make_response, jsonify, Response
 from tdt_api.exception.api_exception import ApiException
 from tdt_api.utils.command_line_utils import runcmd
-from tdt_api.utils.github_utils import check_user_permission, Permissions, init_taxonomy_folder
+from tdt_api.utils import metrics, snapshots
+from tdt_api.utils.init_manager import init_manager, InitStatus
+from tdt_api.utils.taxonomy_index import taxonomy_index, FIELDS as TAXONOMY_FIELDS
+from tdt_api.utils.search_index import search_index, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT
+from tdt_api.utils import sqlite_reader
+from tdt_api.utils.sqlite_reader import Page, TableNotFound, ColumnNotFound, WithoutRowid
+from tdt_api.endpoints.parser import taxonomies_arguments, search_arguments, get_arguments, data_arguments
+from tdt_api.utils.scheduler import get_scheduler, Saturated
+from tdt_api.utils.governor import governor, limits, Rejected, INTERACTIVE, RLTBL_TIMEOUT
+from tdt_api.utils.cgi_utils import CgiProcess, CgiError, read_cgi_headers, iter_cgi_body
+from tdt_api.utils.response_cache import browser_cache, db_version, make_key, make_etag
+from tdt_api.utils.delivery import deliver, etag_matches
+from tdt_api.utils.github_utils import check_user_permission, check_user_permissions, Permissions
+from tdt_api.utils.job_manager import job_manager
+from tdt_api.utils.taxonomy_jobs import init_taxonomy_task
+from tdt_api.utils.warmup import warmup
 from tdt_api.utils.jwt_utils import get_session_info
 
 
@@ -16,19 +34,100 @@ log = logging.getLogger(__name__)
 
 TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
 RLTBL_DB = '.relatable/relatable.db'
+MAX_TAXONOMIES_PAGE_SIZE = 1000
+# Maximum number of queries or identifiers of a single search or get request.
+MAX_BATCH_SIZE = 100
+MAX_DATA_PAGE_SIZE = 10000
+
+check_permissions_model = api.model('CheckPermissions', {
+    'user': fields.String(required=False, example="octocat",
+                          description="GitHub user id, the user of the auth token by default."),
+    'repositories': fields.List(fields.String, required=True, example=["brain-bican/whole_mouse_brain_taxonomy"],
+                                description="Repositories as 'organization/repository'."),
+})
+
+
+@api.route('/ready', methods=['GET'])
+class ReadyEndpoint(Resource):
+
+    def get(self):
+        """
+        Readiness probe
+
+        Answers 200 once the startup warm-up of the taxonomies is complete (or disabled) and 503 until then, with the
+        warm-up state of each taxonomy.
+        """
+        status = warmup.status()
+        return status, 200 if status["ready"] else 503
 
 
 @api.route('/taxonomies', methods=['GET'])
 class TaxonomiesEndpoint(Resource):
 
+    @api.expect(taxonomies_arguments)
     def get(self):
         """
         Taxonomies listing
 
-        Returns the metadata of all registered taxonomies.
+        Returns the metadata of all registered taxonomies: name, branch, commit, init status, DB size, last reload
+        time, title and species. Supports pagination with offset/limit and field selection with fields.
         """
-        response = flask.jsonify("Taxonomies listing")
-        return response
+        args = taxonomies_arguments.parse_args()
+        offset = max(args['offset'] or 0, 0)
+        limit = min(max(args['limit'] or 0, 0), MAX_TAXONOMIES_PAGE_SIZE)
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()] if args['fields'] else None
+        if fields:
+            unknown = set(fields) - set(TAXONOMY_FIELDS) - {'status'}
+            if unknown:
+                raise ApiException(f"Unknown fields: {', '.join(sorted(unknown))}", 400)
+
+        total, taxonomies = taxonomy_index.list(offset, limit)
+        for taxonomy in taxonomies:
+            if init_manager.is_building(taxonomy["name"]):
+                taxonomy["status"] = InitStatus.INITIALIZING.value
+            else:
+                taxonomy["status"] = (InitStatus.READY if taxonomy["initialized"] else InitStatus.NOT_INITIALIZED).value
+        if fields:
+            taxonomies = [{field: taxonomy.get(field) for field in fields} for taxonomy in taxonomies]
+        return {"total": total, "offset": offset, "limit": limit, "taxonomies": taxonomies}
+
+@api.route('/search', methods=['GET'])
+class SearchEndpoint(Resource):
+
+    @api.expect(search_arguments)
+    def get(self):
+        """
+        Search cell sets
+
+        Searches the labels, synonyms and identifiers of the cell sets of all taxonomies. Several query parameters can
+        be given to run a batch of searches at once, the matches are returned per query.
+        """
+        args = search_arguments.parse_args()
+        queries = list(dict.fromkeys(args['query']))
+        if len(queries) > MAX_BATCH_SIZE:
+            raise ApiException(f"At most {MAX_BATCH_SIZE} queries can be searched at once.", 400)
+        limit = min(max(args['limit'] or SEARCH_DEFAULT_LIMIT, 1), SEARCH_MAX_LIMIT)
+        return search_index.search(queries, taxonomy=args['taxonomy'], species=args['species'], rank=args['rank'],
+                                   limit=limit)
+
+
+@api.route('/get', methods=['GET'])
+class GetEndpoint(Resource):
+
+    @api.expect(get_arguments)
+    def get(self):
+        """
+        Get cell sets
+
+        Returns the cell sets with the given identifiers from all taxonomies. Several identifier parameters can be given
+        to look up a batch of cell sets at once.
+        """
+        args = get_arguments.parse_args()
+        identifiers = list(dict.fromkeys(args['identifier']))
+        if len(identifiers) > MAX_BATCH_SIZE:
+            raise ApiException(f"At most {MAX_BATCH_SIZE} identifiers can be requested at once.", 400)
+        return search_index.get(identifiers)
+
 
 @api.route('/session_info/<string:repo_name>', methods=['GET'])
 class GetSessionInfoEndpoint(Resource):
@@ -39,11 +138,11 @@ class GetSessionInfoEndpoint(Resource):
 
         Returns the user, repo_org, and permission level.
         """
-        user, email, repo_org = get_session_info(request)
-        permission, status_code = check_user_permission(repo_org, repo_name, user)
+        session = get_session_info(request)
+        permission, status_code = check_user_permission(session.repo_org, repo_name, session.user)
         return {
-            "user": user,
-            "repo_org": repo_org,
+            "user": session.user,
+            "repo_org": session.repo_org,
             "permission": permission.value,
             "tdt_web": os.getenv('TDT_WEB', '')
         }, status_code
@@ -61,45 +160,170 @@ class CheckPermissionsEndpoint(Resource):
         return permission.value, status_code
 
 
+@api.route('/check_permissions', methods=['POST'])
+class BatchCheckPermissionsEndpoint(Resource):
+
+    @api.expect(check_permissions_model, validate=True)
+    def post(self):
+        """
+        Check user permissions for many repositories.
+
+        Returns the permission level (read, write, no_access) and the GitHub status code of the user for each
+        'organization/repository'. Uncached permissions are fetched from GitHub concurrently.
+        """
+        data = request.get_json()
+        repositories = data.get('repositories')
+        if len(repositories) > MAX_BATCH_SIZE:
+            raise ApiException(f"At most {MAX_BATCH_SIZE} repositories can be checked at once.", 400)
+        pairs = []
+        for repository in repositories:
+            repo_org, _, repo_name = str(repository).partition('/')
+            if not repo_org or not repo_name or '/' in repo_name:
+                raise ApiException(f"Invalid repository '{repository}', expected 'organization/repository'.", 400)
+            pairs.append((repo_org, repo_name))
+        user = data.get('user') or get_session_info(request).user
+
+        results = check_user_permissions(user, pairs)
+        return {
+            "user": user,
+            "permissions": {f"{repo_org}/{repo_name}": {"permission": permission.value, "status": status_code}
+                            for (repo_org, repo_name), (permission, status_code) in results.items()},
+        }
+
+
 @api.route('/browser/<string:taxonomy>/<path:path>', methods=['GET', 'POST'])
 class BrowserEndpoint(Resource):
 
     def get(self, taxonomy, path):
         print(f"browse {taxonomy}/{path}")
-        taxonomy_dir = os.path.join(TAXONOMIES_VOLUME, taxonomy)
-        nanobot_db_path = os.path.join(taxonomy_dir, RLTBL_DB)
+        taxonomy_dir = taxonomy_folder(taxonomy)
+        if init_manager.ensure_initialized(taxonomy, taxonomy_dir) != InitStatus.READY:
+            return init_status_response(taxonomy, taxonomy_dir)
 
-        if not os.path.exists(nanobot_db_path):
-            runcmd("make init", cwd=taxonomy_dir)
-            print(f"Taxonomy {taxonomy} initialized successfully.")
+        session = get_session_info(request)
+        permission, status_code = check_user_permission(session.repo_org, taxonomy, session.user)
 
-        user, email, repo_org = get_session_info(request)
-        permission, status_code = check_user_permission(repo_org, taxonomy, user)
-
-        return rltbl(request,'GET', taxonomy, path, user, permission.to_boolean())
+        response = browse(taxonomy_dir, partial(cached_rltbl, request, taxonomy, path=path, username=session.user,
+                                                readonly=permission.to_boolean()))
+        return deliver(request, response, path)
 
     def post(self, taxonomy, path):
         print(f"browse {taxonomy}/{path}")
-        taxonomy_dir = os.path.join(TAXONOMIES_VOLUME, taxonomy)
-        nanobot_db_path = os.path.join(taxonomy_dir, RLTBL_DB)
-
-        if not os.path.exists(nanobot_db_path):
-            runcmd("make init", cwd=taxonomy_dir)
-            print(f"Taxonomy {taxonomy} initialized successfully.")
+        taxonomy_dir = taxonomy_folder(taxonomy)
+        if init_manager.ensure_initialized(taxonomy, taxonomy_dir) != InitStatus.READY:
+            return init_status_response(taxonomy, taxonomy_dir)
+
+        session = get_session_info(request)
+        permission, status_code = check_user_permission(session.repo_org, taxonomy, session.user)
+
+        browser_cache.invalidate(taxonomy)
+        response = browse(taxonomy_dir, partial(rltbl, request, 'POST', taxonomy, path=path, username=session.user,
+                                                readonly=permission.to_boolean()))
+        response.call_on_close(lambda: browser_cache.invalidate(taxonomy))
+        return deliver(request, response, path)
+
+
+def browse(taxonomy_dir, serve):
+    """
+    Serves a browser request from the current snapshot of the taxonomy. The snapshot is resolved once and leased until
+    the response was sent, so a reload activating a new snapshot meanwhile does not affect the request.
+    :param taxonomy_dir: folder of the taxonomy in the volume
+    :param serve: function returning the response, called with the folder of the snapshot
+    :return: response
+    """
+    lease = snapshots.acquire(taxonomy_dir)
+    try:
+        response = serve(taxonomy_dir=lease.path)
+    except BaseException:
+        lease.release()
+        raise
+    response.call_on_close(lease.release)
+    return response
+
+
+@api.route('/data/<string:taxonomy>/<string:table>', methods=['GET'])
+class DataEndpoint(Resource):
+
+    @api.expect(data_arguments)
+    def get(self, taxonomy, table):
+        """
+        Read table rows
 
-        user, email, repo_org = get_session_info(request)
-        permission, status_code = check_user_permission(repo_org, taxonomy, user)
+        Reads a page of rows of a taxonomy table directly from its relatable database, without running rltbl. Pages
+        are returned in row order, pass the next cursor of a page as after to read the following one. Rows are streamed
+        as a JSON document or as newline delimited JSON (format=ndjson), the next cursor is also sent in the
+        X-Next-Cursor header.
+        """
+        args = data_arguments.parse_args()
+        taxonomy_dir = taxonomy_folder(taxonomy)
+        if init_manager.ensure_initialized(taxonomy, taxonomy_dir) != InitStatus.READY:
+            return init_status_response(taxonomy, taxonomy_dir)
+
+        limit = min(max(args['limit'] if args['limit'] is not None else 100, 0), MAX_DATA_PAGE_SIZE)
+        columns = [column.strip() for column in args['columns'].split(',') if column.strip()] \
+            if args['columns'] else None
+        output_format = args['format'] or ('ndjson' if 'application/x-ndjson' in request.headers.get('Accept', '')
+                                           else 'json')
+        # the database of the current snapshot is kept until the rows were sent, like the browser requests
+        lease = snapshots.acquire(taxonomy_dir)
+        try:
+            try:
+                pool = sqlite_reader.get_pool(taxonomy, os.path.join(lease.path, RLTBL_DB))
+                page = Page(pool, table, columns, args['after'], limit)
+            except TableNotFound:
+                raise ApiException(f"Table {table} not found in taxonomy {taxonomy}.", 404)
+            except ColumnNotFound as e:
+                raise ApiException(f"Unknown columns: {e}", 400)
+            except WithoutRowid:
+                raise ApiException(f"Table {table} is a WITHOUT ROWID table, its rows cannot be read by pages.", 400)
+            except sqlite3.Error as e:
+                log.error(f"Could not read {taxonomy}/{table}: {e}")
+                raise ApiException("The taxonomy database is not available.", 503)
+        except BaseException:
+            lease.release()
+            raise
+
+        if output_format == 'ndjson':
+            response = Response(page.ndjson(), 200, mimetype='application/x-ndjson')
+        else:
+            response = Response(page.json(), 200, mimetype='application/json')
+        if page.next is not None:
+            response.headers['X-Next-Cursor'] = str(page.next)
+        # returns the connection even if the body is never iterated
+        response.call_on_close(page.close)
+        response.call_on_close(lease.release)
+        return response
 
-        return rltbl(request, 'POST', taxonomy, path, user, permission.to_boolean())
 
 @api.route('/init_taxonomy/<string:taxonomy>', methods=['GET'])
 class InitTaxonomyEndpoint(Resource):
 
     def get(self, taxonomy):
+        """
+        Initialize taxonomy
+
+        Starts rebuilding the taxonomy in the background. Use init_status to follow the build.
+        """
         print(f"init {taxonomy}")
-        taxonomy_dir = os.path.join(TAXONOMIES_VOLUME, taxonomy)
-        runcmd("make init", cwd=taxonomy_dir)
-        return "Success"
+        taxonomy_dir = taxonomy_folder(taxonomy)
+        init_manager.submit(taxonomy, taxonomy_dir, force=True)
+        return init_status_response(taxonomy, taxonomy_dir)
+
+
+@api.route('/init_status/<string:taxonomy>', methods=['GET'])
+class InitStatusEndpoint(Resource):
+
+    def get(self, taxonomy):
+        """
+        Taxonomy initialization status
+
+        Returns whether the taxonomy is ready, initializing, failed or not initialized yet.
+        """
+        taxonomy_dir = taxonomy_folder(taxonomy)
+        status = init_manager.status(taxonomy, taxonomy_dir)
+        status_code = 404 if status["status"] == InitStatus.NOT_FOUND else 200
+        status["status"] = status["status"].value
+        return status, status_code
 
 
 @api.route('/add_taxonomy', methods=['POST'])
@@ -112,16 +336,94 @@ class AddTaxonomyEndpoint(Resource):
         if not str(repo_url).endswith(".git"):
             repo_url = repo_url + ".git"
         repo_name = str(repo_url).split("/")[-1].split(".")[0]
+        if not is_taxonomy_name(repo_name):
+            raise ApiException(f"Invalid repository name: {repo_name}", 400)
         taxonomy_dir = os.path.join(TAXONOMIES_VOLUME, repo_name)
         if os.path.exists(taxonomy_dir):
             return {"message": "Repository already cloned and initialized."}, 200
-        else:
-            return init_taxonomy_folder(branch, repo_url, TAXONOMIES_VOLUME, taxonomy_dir)
+        # cloned and initialized by a background job, followed with /admin_api/jobs/<job_id>
+        job = job_manager.submit("add_taxonomy", {
+            repo_name: partial(init_taxonomy_task, repo_name, branch, repo_url, taxonomy_dir)})
+        return {"message": "Repository is being cloned and initialized.", "job_id": job.id,
+                "status": job.status.value}, 202
+
+def is_taxonomy_name(name):
+    """
+    Returns whether the name can be the folder of a taxonomy in the volume. The names starting with a dot are the
+    internal folders of the volume: snapshots, locks, mirrors, jobs and the search index.
+    """
+    return bool(name) and not name.startswith('.') and '/' not in name
+
+
+def taxonomy_folder(taxonomy):
+    """
+    Returns the folder of a taxonomy in the volume.
+    :raises ApiException: 404 if the name is not the one of a taxonomy folder of the volume
+    """
+    taxonomy_dir = os.path.join(TAXONOMIES_VOLUME, taxonomy) if is_taxonomy_name(taxonomy) else None
+    if taxonomy_dir is None or not os.path.isdir(taxonomy_dir):
+        raise ApiException(f"Taxonomy {taxonomy} not found.", 404)
+    return taxonomy_dir
+
+
+def init_status_response(taxonomy, taxonomy_dir):
+    """
+    Reports the initialization status of a taxonomy that is not ready to be browsed.
+    """
+    status = init_manager.status(taxonomy, taxonomy_dir)
+    status_code = {
+        InitStatus.READY: 200,
+        InitStatus.INITIALIZING: 202,
+        InitStatus.FAILED: 503,
+        InitStatus.NOT_FOUND: 404,
+    }.get(status["status"], 500)
+    status["status"] = status["status"].value
+    return status, status_code
+
+
+def cached_rltbl(api_request, taxonomy, taxonomy_dir, path, username, readonly="TRUE"):
+    """
+    Serves read-only GET requests from the browser cache. Cache entries and ETags are bound to the version of the
+    taxonomy's relatable database, so a matching If-None-Match is answered with 304 without running rltbl. The pages of
+    the users with write access are not cached, they get a weak ETag to revalidate them.
+    """
+    version = db_version(taxonomy_dir)
+    if version is None:
+        return rltbl(api_request, 'GET', taxonomy, taxonomy_dir, path, username, readonly)
+
+    key = make_key(taxonomy, path, api_request.query_string.decode('utf-8'), readonly, username, version)
+    etag = make_etag(key)
+    weak = readonly != "TRUE"
+    matched = etag_matches(api_request.if_none_match, etag, weak)
+    if matched:
+        return Response(status=304, headers={'ETag': matched})
+
+    cacheable = not weak and browser_cache.enabled
+    cached = browser_cache.get(key) if cacheable else None
+    if cached is not None:
+        response = Response(cached.body, status=cached.status, headers=cached.headers)
+        response.set_etag(etag)
+        return response
 
-def rltbl(api_request, method, taxonomy, path, username, readonly="TRUE"):
-    """Call Relatable as a CGI script."""
+    generation = browser_cache.generation(taxonomy)
+    response = rltbl(api_request, 'GET', taxonomy, taxonomy_dir, path, username, readonly)
+    if response.status_code == 200:
+        if cacheable:
+            headers = dict(response.headers)
+            headers.pop('Server-Timing', None)
+            response.response = browser_cache.caching_body(key, response.status, headers, response.response,
+                                                           generation)
+        response.set_etag(etag, weak)
+    return response
+
+
+def rltbl(api_request, method, taxonomy, taxonomy_dir, path, username, readonly="TRUE"):
+    """
+    Call Relatable as a CGI script in the given taxonomy folder, the snapshot resolved for the request.
+    The response headers are parsed as they arrive and the body is streamed to the client unchanged.
+    """
     path = f'/{path}'
-    data = api_request.get_data().decode('utf-8')
+    data = api_request.get_data()
 
     env={
         'GATEWAY_INTERFACE': 'CGI/1.1',
@@ -138,38 +440,53 @@ def rltbl(api_request, method, taxonomy, path, username, readonly="TRUE"):
     }
     print("USER is: " + username)
     # print("RLTBL", env, data, type(data))
-    taxonomy_dir = os.path.join(TAXONOMIES_VOLUME, taxonomy)
-    result = subprocess.run(
-        [os.path.join(taxonomy_dir, 'bin/rltbl')],
-        cwd=f'{TAXONOMIES_VOLUME}/{taxonomy}/',
-        env=env,
-        input=data or '',
-        text=True,
-        capture_output=True
-    )
-
-    if result.returncode != 0:
-        log.error("Error running rltbl")
-        log.error("Return code: " + str(result.returncode))
-        log.error("Stderr: " + str(result.stderr))
-        raise ApiException("Error running rltbl", 500)
-
-    status = 200
-    headers = {}
-    body = []
-    reading_headers = True
-    for line in result.stdout.splitlines():
-        if reading_headers and line.strip() == '':
-            reading_headers = False
-            continue
-        if reading_headers:
-            name, value = line.split(': ', 1)
-            if name.lower() == 'status':
-                status = value
-            if name.lower() in ['vary', 'cookie', 'set-cookie']:
-                pass
-            else:
-                headers[name] = value
-        else:
-            body.append(line)
-    return make_response(('\n'.join(body), status, headers))
+    try:
+        slot = get_scheduler(taxonomy).acquire(write=method != 'GET')
+    except Saturated as e:
+        log.warning(str(e))
+        raise ApiException(f"The taxonomy {taxonomy} is busy, please retry later.", 503,
+                           headers={'Retry-After': str(e.retry_after)})
+    metrics.observe_span('rltbl_queue', slot.wait, taxonomy)
+    start = time.perf_counter()
+    try:
+        with metrics.span('rltbl_spawn', taxonomy):
+            output = start_cgi(taxonomy, taxonomy_dir, env, data)
+
+        try:
+            with metrics.span('rltbl_parse', taxonomy):
+                status, headers = read_cgi_headers(output)
+        except (CgiError, ValueError) as e:
+            log.error(f"Error running rltbl: {e}")
+            output.close()
+            raise ApiException("Error running rltbl", 500)
+    except BaseException:
+        slot.release()
+        raise
+
+    response = Response(iter_cgi_body(output), status=status, headers=headers)
+    response.headers['Server-Timing'] = f'queue;dur={slot.wait * 1000:.1f}'
+    # the body is not iterated for HEAD requests or clients gone before the first chunk, rltbl is stopped on close
+    response.call_on_close(output.close)
+    # the taxonomy stays busy until rltbl's output was streamed to the client
+    response.call_on_close(slot.release)
+    response.call_on_close(lambda: metrics.observe_span('rltbl_run', time.perf_counter() - start, taxonomy))
+    return response
+
+
+def start_cgi(taxonomy, taxonomy_dir, env, data):
+    """
+    Starts rltbl as a CGI script once the subprocess governor admits it, with the resource limits of the interactive
+    calls. The governor slot is released when the script is closed.
+    """
+    try:
+        permit = governor.acquire(INTERACTIVE, taxonomy)
+    except Rejected as e:
+        log.warning(str(e))
+        raise ApiException(f"The taxonomy {taxonomy} is busy, please retry later.", 503,
+                           headers={'Retry-After': str(e.retry_after)})
+    try:
+        return CgiProcess(os.path.join(taxonomy_dir, 'bin/rltbl'), f'{taxonomy_dir}/', env, data,
+                          limits=limits(INTERACTIVE), timeout=RLTBL_TIMEOUT or None, permit=permit)
+    except BaseException:
+        permit.release()
+        raise
@@ -4,7 +4,7 @@ from http import HTTPStatus
 class ApiException(Exception):
     default_status_code = HTTPStatus.BAD_REQUEST
 
-    def __init__(self, message, status_code=None, payload=None):
+    def __init__(self, message, status_code=None, payload=None, headers=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
@@ -12,6 +12,7 @@ class ApiException(Exception):
         else:
             self.status_code = ApiException.default_status_code
         self.payload = payload
+        self.headers = headers or {}
 
     def to_dict(self):
         rv = dict(self.payload or ())
@@ -25,7 +25,7 @@ def default_error_handler(e):
 def handle_bad_request(error):
     log.exception(error.message)
 
-    return {'message': error.message}, error.status_code
+    return {'message': error.message}, error.status_code, error.headers
 
 
 @api.errorhandler(ValueError)
@@ -1,44 +1,182 @@
+"""
+Upgrades the taxonomies to a version of the TDT:
+
+    python -m tdt_api.scripts.update_repos --version 2.1.0 --folder /path/to/taxonomies [--parallel 4] [--dry-run]
+
+Repositories are upgraded concurrently. The upgraded ones are recorded in a state file, so that a rerun after a failure
+only upgrades the repositories that are not at the target version yet.
+"""
 import os
+import sys
+import json
+import time
+import shlex
 import logging
+import argparse
+import threading
+from functools import partial
 
 from tdt_api.exception.api_exception import ApiException
 from tdt_api.utils.command_line_utils import runcmd
-from tdt_api.utils.github_utils import init_taxonomy_folder
+from tdt_api.utils.job_manager import JobManager
 
 
 log = logging.getLogger(__name__)
 
-def update_repos(repositories, tdt_version, taxonomies_folder):
+# State file of the upgrades, relative to the taxonomies folder.
+STATE_FILE = '.upgrade_state.json'
+# Number of repositories upgraded at the same time.
+DEFAULT_PARALLELISM = 4
+
+DEFAULT_REPOSITORIES = {
+    "https://github.com/brain-bican/human-brain-cell-atlas_v1_neurons.git": "main",
+    "https://github.com/brain-bican/human-brain-cell-atlas_v1_non-neuronal.git": "main",
+    "https://github.com/brain-bican/whole_mouse_brain_taxonomy.git": "main",
+    "https://github.com/Cellular-Semantics/human-neocortex-non-neuronal-cells.git": "main",
+    "https://github.com/Cellular-Semantics/human-neocortex-mge-derived-interneurons.git": "main",
+    "https://github.com/Cellular-Semantics/human-neocortex-it-projecting-excitatory-neurons.git": "main",
+    "https://github.com/Cellular-Semantics/human-neocortex-deep-layer-excitatory-neurons.git": "main",
+    "https://github.com/Cellular-Semantics/human-neocortex-cge-derived-interneurons.git": "main",
+    "https://github.com/brain-bican/human-neocortex-middle-temporal-gyrus.git": "main",
+    "https://github.com/brain-bican/basal_ganglia_macaque_taxonomy.git": "main",
+    "https://github.com/brain-bican/basal_ganglia_human_taxonomy.git": "main",
+    "https://github.com/brain-bican/basal_ganglia_consensus_taxonomy.git": "main",
+}
+
+
+class UpgradeState:
+    """
+    Versions the repositories were upgraded to, persisted as JSON after every upgrade.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.repositories = dict()
+        if path and os.path.exists(path):
+            with open(path) as file:
+                self.repositories = json.load(file)
+
+    def version(self, repo_name):
+        return self.repositories.get(repo_name, {}).get("version")
+
+    def record(self, repo_name, tdt_version, duration):
+        with self.lock:
+            self.repositories[repo_name] = {"version": tdt_version, "upgraded": time.time(), "duration": duration}
+            if not self.path:
+                return
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.repositories, file, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+
+def plan_upgrade(repositories, tdt_version, taxonomies_folder, state, force=False):
     """
-    Updates taxonomies to the given version of the TDT.
-    :return:
+    Decides what to do with each repository: 'clone' and upgrade it, 'upgrade' it or 'skip' it because it is at the
+    target version already.
+    :return: list of (repository name, repository url, branch, action) tuples
     """
-    for repo_url in repositories:
+    plan = []
+    for repo_url, branch in repositories.items():
         if not str(repo_url).endswith(".git"):
             repo_url = repo_url + ".git"
         repo_name = str(repo_url).split("/")[-1].split(".")[0]
         taxonomy_dir = os.path.join(taxonomies_folder, repo_name)
-
         if not os.path.exists(taxonomy_dir):
-            log.info(f"Taxonomy {repo_name} does not exist. Initializing...")
-            # Clone the repository
-            runcmd(f"git clone {repo_url}", cwd=taxonomies_folder)
+            action = 'clone'
+        elif not force and state.version(repo_name) == tdt_version and run_sh_version(taxonomy_dir) == tdt_version:
+            action = 'skip'
+        else:
+            action = 'upgrade'
+        plan.append((repo_name, repo_url, branch, action))
+    return plan
+
 
-            # Navigate to the branch
-            runcmd(f"git checkout {repositories[repo_url]}", cwd=taxonomy_dir, supress_exceptions=True)
+def update_repos(repositories, tdt_version, taxonomies_folder, runner=None, state_file=None, dry_run=False,
+                 force=False):
+    """
+    Updates taxonomies to the given version of the TDT. Each repository is upgraded by a task of a background job, the
+    job log records the commands run for each of them.
+    :param repositories: dictionary of repository url to branch
+    :param tdt_version: TDT version to upgrade to
+    :param taxonomies_folder: folder of the taxonomies
+    :param runner: job manager running the upgrades, its number of workers is the parallelism
+    :param state_file: state file of the upgrades, defaults to STATE_FILE in the taxonomies folder
+    :param dry_run: only report what would be done
+    :param force: upgrade the repositories that are at the target version already
+    :return: summary of each repository: name, action, status, duration and error
+    """
+    state = UpgradeState(state_file if state_file is not None else os.path.join(taxonomies_folder, STATE_FILE))
+    plan = plan_upgrade(repositories, tdt_version, taxonomies_folder, state, force)
+    if dry_run:
+        return [summary_row(repo_name, action, 'skipped' if action == 'skip' else 'planned')
+                for repo_name, repo_url, branch, action in plan]
 
-            # Run 'make init'
-            # runcmd(f"bash run.sh make init", cwd=taxonomy_dir)
-            log.info(f"Taxonomy {repo_name} initialized successfully.")
+    tasks = {repo_name: partial(upgrade_taxonomy_task, repo_url, branch, tdt_version, taxonomies_folder, state)
+             for repo_name, repo_url, branch, action in plan if action != 'skip'}
+    runner = runner or JobManager(max_workers=DEFAULT_PARALLELISM, db_path='')
+    job = runner.submit("update_repos", tasks)
+    job.wait()
+    log.info(f"Update to TDT version {tdt_version} finished with status {job.status.value}.")
 
-        update_run_sh(taxonomy_dir, tdt_version)
+    summary = []
+    for repo_name, repo_url, branch, action in plan:
+        task = job.tasks.get(repo_name)
+        if task is None:
+            summary.append(summary_row(repo_name, action, 'skipped'))
+        else:
+            summary.append(summary_row(repo_name, action, task["status"].value, task["duration"], task["error"]))
+    return summary
 
-        runcmd("bash run.sh make upgrade", cwd=taxonomy_dir)
-        # runcmd(f"git commit -a --message 'TDT upgrade to v{tdt_version}'", cwd=taxonomy_dir)
-        # runcmd("git push", cwd=taxonomy_dir)
 
-        log.info(f"Taxonomy {repo_name} updated to TDT version {tdt_version}.")
-    return "Taxonomies updated successfully.", 200
+def summary_row(repo_name, action, status, duration=None, error=None):
+    return {"repository": repo_name, "action": action, "status": status, "duration": duration, "error": error}
+
+
+def upgrade_taxonomy_task(repo_url, branch, tdt_version, taxonomies_folder, state=None):
+    """
+    Clones the taxonomy if needed and upgrades it to the given version of the TDT.
+    """
+    started = time.time()
+    repo_name = str(repo_url).split("/")[-1].split(".")[0]
+    taxonomy_dir = os.path.join(taxonomies_folder, repo_name)
+
+    if not os.path.exists(taxonomy_dir):
+        log.info(f"Taxonomy {repo_name} does not exist. Initializing...")
+        # Clone the repository
+        runcmd(shlex.join(["git", "clone", repo_url, repo_name]), cwd=taxonomies_folder, taxonomy=repo_name)
+
+        # Navigate to the branch
+        runcmd(shlex.join(["git", "checkout", branch]), cwd=taxonomy_dir, supress_exceptions=True, taxonomy=repo_name)
+
+        # Run 'make init'
+        # runcmd(f"bash run.sh make init", cwd=taxonomy_dir)
+        log.info(f"Taxonomy {repo_name} initialized successfully.")
+
+    update_run_sh(taxonomy_dir, tdt_version)
+
+    runcmd("bash run.sh make upgrade", cwd=taxonomy_dir, taxonomy=repo_name)
+    # runcmd(f"git commit -a --message 'TDT upgrade to v{tdt_version}'", cwd=taxonomy_dir)
+    # runcmd("git push", cwd=taxonomy_dir)
+
+    if state is not None:
+        state.record(repo_name, tdt_version, time.time() - started)
+    log.info(f"Taxonomy {repo_name} updated to TDT version {tdt_version}.")
+
+
+def run_sh_version(taxonomy_dir):
+    """
+    Returns the TDT version run.sh uses, None if it can't be read.
+    """
+    try:
+        with open(os.path.join(taxonomy_dir, 'run.sh')) as file:
+            for line in file:
+                if line.startswith("IMAGE=${IMAGE:-taxonomy-development-tools:"):
+                    return line.strip()[len("IMAGE=${IMAGE:-taxonomy-development-tools:"):].rstrip('}')
+    except OSError:
+        pass
+    return None
 
 
 def update_run_sh(taxonomy_dir, tdt_version):
@@ -59,7 +197,7 @@ def update_run_sh(taxonomy_dir, tdt_version):
             for line in lines:
                 if line.startswith("IMAGE=${IMAGE:-taxonomy-development-tools"):
                     file.write("IMAGE=${IMAGE:-taxonomy-development-tools:" + tdt_version + "}\n")
-                if " -ti " in line:
+                elif " -ti " in line:
                     # don't run docker interactively and with tty
                     file.write(line.replace(' -ti ', ' '))
                 else:
@@ -69,19 +207,51 @@ def update_run_sh(taxonomy_dir, tdt_version):
         raise ApiException("An error occurred while updating run.sh.", 500)
 
 
-repositories = {
-    "https://github.com/brain-bican/human-brain-cell-atlas_v1_neurons.git": "main",
-    "https://github.com/brain-bican/human-brain-cell-atlas_v1_non-neuronal.git": "main",
-    "https://github.com/brain-bican/whole_mouse_brain_taxonomy.git": "main",
-    "https://github.com/Cellular-Semantics/human-neocortex-non-neuronal-cells.git": "main",
-    "https://github.com/Cellular-Semantics/human-neocortex-mge-derived-interneurons.git": "main",
-    "https://github.com/Cellular-Semantics/human-neocortex-it-projecting-excitatory-neurons.git": "main",
-    "https://github.com/Cellular-Semantics/human-neocortex-deep-layer-excitatory-neurons.git": "main",
-    "https://github.com/Cellular-Semantics/human-neocortex-cge-derived-interneurons.git": "main",
-    "https://github.com/brain-bican/human-neocortex-middle-temporal-gyrus.git": "main",
-    "https://github.com/brain-bican/basal_ganglia_macaque_taxonomy.gi": "main",
-    "https://github.com/brain-bican/basal_ganglia_human_taxonomy.git": "main",
-    "https://github.com/brain-bican/basal_ganglia_consensus_taxonomy.git": "main",
-}
+def print_summary(summary, output=None):
+    output = output or sys.stdout
+    print(f"\n{'repository':<60}{'action':<10}{'status':<12}{'seconds':>9}  error", file=output)
+    for row in summary:
+        duration = f"{row['duration']:.1f}" if row['duration'] is not None else '-'
+        error = (row['error'] or '').strip().splitlines()
+        print(f"{row['repository']:<60}{row['action']:<10}{row['status']:<12}{duration:>9}  "
+              f"{error[0] if error else ''}", file=output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upgrades the taxonomies to a version of the TDT.")
+    parser.add_argument('--version', required=True, help="TDT version to upgrade to, e.g. 2.1.0.")
+    parser.add_argument('--folder', default=os.getenv('TAXONOMIES_VOLUME'), help="Folder of the taxonomies, "
+                        "TAXONOMIES_VOLUME by default.")
+    parser.add_argument('--repositories', help="JSON file mapping the repository urls to their branch. Defaults to "
+                        "the deployed taxonomies.")
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLELISM,
+                        help="Number of repositories upgraded at the same time.")
+    parser.add_argument('--state', help=f"State file of the upgrades, {STATE_FILE} in the folder by default.")
+    parser.add_argument('--dry-run', action='store_true', help="Only print what would be upgraded.")
+    parser.add_argument('--force', action='store_true', help="Upgrade the repositories that are at the target "
+                        "version already.")
+    args = parser.parse_args(argv)
+    if not args.folder:
+        parser.error("--folder is required when TAXONOMIES_VOLUME is not set")
+    if args.parallel < 1:
+        parser.error("--parallel must be positive")
+
+    repositories = DEFAULT_REPOSITORIES
+    if args.repositories:
+        with open(args.repositories) as file:
+            repositories = json.load(file)
+
+    logging.basicConfig(level=logging.INFO)
+    runner = JobManager(max_workers=args.parallel, db_path='')
+    try:
+        summary = update_repos(repositories, args.version, args.folder, runner=runner, state_file=args.state,
+                               dry_run=args.dry_run, force=args.force)
+    finally:
+        runner.shutdown()
+    print_summary(summary)
+    failed = [row for row in summary if row["status"] not in ('succeeded', 'skipped', 'planned')]
+    return 1 if failed else 0
+
 
-update_repos(repositories, "2.1.0", "/Users/hk9/Downloads/tdt_cloud_rltbl")
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import os
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+
+log = logging.getLogger(__name__)
+
+# Size of the chunks relayed from a CGI script to the client.
+CGI_CHUNK_SIZE = int(os.getenv('CGI_CHUNK_SIZE', '65536'))
+# Response headers of the CGI script that are not passed on to the client.
+DROPPED_HEADERS = {'vary', 'cookie', 'set-cookie'}
+
+
+class CgiError(Exception):
+    pass
+
+
+class CgiProcess:
+    """
+    A CGI script running in a subprocess, exposing its stdout as a binary stream.
+    The request body is fed from a separate thread so that large requests and responses can't deadlock on the pipes,
+    and stderr is spooled to a temporary file instead of being held in memory. The script runs in its own process
+    group, which is killed if it runs longer than the timeout.
+    """
+
+    def __init__(self, command, cwd, env, data=b'', limits=(), timeout=None, permit=None):
+        """
+        :param limits: command prefix applying the resource limits of the script, see governor.limits
+        :param timeout: seconds the script may run, None for no limit
+        :param permit: governor permit released with the exit status of the script once it was closed
+        """
+        self.command = command
+        self.permit = permit
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [*limits, command],
+            cwd=cwd,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self.stderr,
+            start_new_session=True,
+        )
+        self.eof = False
+        self.timed_out = False
+        self.returncode = None
+        self.timer = None
+        if timeout:
+            self.timer = threading.Timer(timeout, self._timeout, args=(timeout,))
+            self.timer.daemon = True
+            self.timer.start()
+        self.writer = threading.Thread(target=self._write_input, args=(data,), daemon=True)
+        self.writer.start()
+
+    def readline(self):
+        line = self.process.stdout.readline()
+        self.eof = not line
+        return line
+
+    def read(self, size=CGI_CHUNK_SIZE):
+        chunk = self.process.stdout.read1(size)
+        self.eof = not chunk
+        return chunk
+
+    def close(self):
+        """
+        Waits for the script to exit, or kills it if its output was not fully consumed (e.g. the client went away).
+        Closing the script again returns the same status.
+        :return: exit status of the script, non-zero if its output may be incomplete
+        """
+        if self.returncode is not None:
+            return self.returncode
+        killed = not self.eof and self.process.poll() is None
+        if killed:
+            self._kill()
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if self.timer is not None:
+            self.timer.cancel()
+        self.writer.join()
+        if returncode != 0 and self.eof:
+            log.error(f"Error running {self.command}")
+            log.error("Return code: " + str(returncode))
+            log.error("Stderr: " + self.stderr_tail())
+        self.stderr.close()
+        if self.permit is not None:
+            self.permit.release(returncode, self.timed_out, killed)
+        self.returncode = returncode
+        return returncode
+
+    def stderr_tail(self, size=4096):
+        self.stderr.seek(0, os.SEEK_END)
+        self.stderr.seek(max(0, self.stderr.tell() - size))
+        return self.stderr.read().decode('utf-8', errors='replace')
+
+    def _timeout(self, timeout):
+        if self.process.poll() is None:
+            log.warning(f"Killing {self.command} after {timeout:.0f} seconds.")
+            self.timed_out = True
+            self._kill()
+
+    def _kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _write_input(self, data):
+        try:
+            if data:
+                self.process.stdin.write(data)
+            self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+
+def read_cgi_headers(stream):
+    """
+    Reads the CGI response headers from the given stream, leaving the stream positioned at the start of the body.
+    :param stream: binary stream providing readline()
+    :return: status and headers of the response
+    """
+    status = 200
+    headers = {}
+    line = stream.readline()
+    if not line:
+        raise CgiError("CGI script produced no output")
+    while line and line.strip():
+        name, value = line.decode('utf-8').rstrip('\r\n').split(': ', 1)
+        if name.lower() == 'status':
+            status = value
+        if name.lower() not in DROPPED_HEADERS:
+            headers[name] = value
+        line = stream.readline()
+    return status, headers
+
+
+def iter_cgi_body(stream, chunk_size=CGI_CHUNK_SIZE):
+    """
+    Relays the remaining bytes of the stream unchanged and closes it once the body is consumed or the client goes away.
+    The headers are already sent when the script fails, so a failure is raised at the end of the body instead: the
+    server then aborts the response rather than completing a truncated one.
+    :param stream: binary stream providing read() and close(), close() returning a non-zero status if the output is
+    incomplete
+    :param chunk_size: maximum size of the yielded chunks
+    :return: generator of body chunks
+    :raises CgiError: if the script exited with a non-zero status
+    """
+    returncode = None
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        returncode = stream.close()
+    if returncode:
+        raise CgiError(f"CGI script exited with status {returncode} after its headers were sent")
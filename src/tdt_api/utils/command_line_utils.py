@@ -1,24 +1,358 @@
-import subprocess
+import os
+import time
+import shlex
+import signal
+import asyncio
 import logging
+import selectors
+import subprocess
+from collections import deque, namedtuple
+
+from tdt_api.utils import snapshots
+from tdt_api.utils.metrics import span
+from tdt_api.utils.job_manager import current_task
+from tdt_api.utils.governor import governor, limits as governor_limits, BACKGROUND
+
+# Seconds a command may run before its process group is killed. 0 disables the timeout.
+COMMAND_TIMEOUT = float(os.getenv('COMMAND_TIMEOUT', '3600'))
+# Seconds a command may run without writing any output before its process group is killed. 0 disables the timeout.
+COMMAND_IDLE_TIMEOUT = float(os.getenv('COMMAND_IDLE_TIMEOUT', '900'))
+# Characters of stdout and of stderr kept in memory per command, older output is dropped.
+COMMAND_MAX_OUTPUT = int(os.getenv('COMMAND_MAX_OUTPUT', str(8 * 1024 * 1024)))
+# Seconds between the SIGTERM and the SIGKILL of a timed out command.
+COMMAND_KILL_GRACE = float(os.getenv('COMMAND_KILL_GRACE', '5'))
+
+# longest line passed to the output callback, longer lines are split
+MAX_LINE_LENGTH = 64 * 1024
+READ_SIZE = 64 * 1024
+
+CommandResult = namedtuple('CommandResult', ['returncode', 'stdout', 'stderr', 'duration', 'timed_out'])
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class OutputBuffer:
+    """
+    Keeps the last max_size characters of the output of a stream and splits it into lines.
+    """
+
+    def __init__(self, max_size=COMMAND_MAX_OUTPUT):
+        self.max_size = max_size
+        self.chunks = deque()
+        self.size = 0
+        self.dropped = 0
+        self.partial = b''
+
+    def feed(self, data):
+        """
+        Adds output read from the stream.
+        :return: list of the lines completed by the data
+        """
+        self.partial += data
+        lines = []
+        while True:
+            end = self.partial.find(b'\n')
+            if end < 0:
+                if len(self.partial) < MAX_LINE_LENGTH:
+                    break
+                end = MAX_LINE_LENGTH - 1
+            lines.append(self.partial[:end + 1].decode('utf-8', errors='replace'))
+            self.partial = self.partial[end + 1:]
+        for line in lines:
+            self._append(line)
+        return lines
+
+    def close(self):
+        """
+        Flushes the last line, if not terminated by a new line.
+        :return: list of the remaining lines
+        """
+        if not self.partial:
+            return []
+        line = self.partial.decode('utf-8', errors='replace')
+        self.partial = b''
+        self._append(line)
+        return [line]
+
+    def text(self):
+        return ''.join(self.chunks)
+
+    def _append(self, line):
+        self.chunks.append(line)
+        self.size += len(line)
+        while self.size > self.max_size and len(self.chunks) > 1:
+            dropped = self.chunks.popleft()
+            self.size -= len(dropped)
+            self.dropped += len(dropped)
+
+
+def log_output(supress_logs=False):
+    """
+    Returns the default output callback, logging stdout lines as info and stderr lines as errors.
+    """
+    def callback(stream, line):
+        if stream == 'stdout':
+            log_info('OUT: ' + line.rstrip('\n'), supress_logs)
+        else:
+            log_error('Error: ' + line.rstrip('\n'), supress_logs)
+    return callback
+
+
+def run_command(cmd, cwd=None, on_output=None, timeout=None, idle_timeout=None, max_output=COMMAND_MAX_OUTPUT,
+                on_start=None, limits=()):
+    """
+    Runs a shell command in its own process group, passing its output to the callback line by line as it is written.
+    Commands exceeding the wall-clock or the idle timeout are killed with their whole process group.
+    :param cmd: command to run
+    :param cwd: folder to run the command in
+    :param on_output: function called with the stream name ('stdout' or 'stderr') and each line of output
+    :param timeout: seconds the command may run, COMMAND_TIMEOUT by default, 0 for no limit
+    :param idle_timeout: seconds the command may run without output, COMMAND_IDLE_TIMEOUT by default, 0 for no limit
+    :param max_output: characters of each stream kept in the result
+    :param on_start: function called with the Popen object once the command started
+    :param limits: command prefix applying the resource limits of the command, see governor.limits
+    :return: CommandResult
+    """
+    cmd = limited(cmd, limits)
+    timeout = COMMAND_TIMEOUT if timeout is None else timeout
+    idle_timeout = COMMAND_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+    started = time.monotonic()
+    process = subprocess.Popen([cmd], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               cwd=cwd, shell=True, start_new_session=True)
+    if on_start is not None:
+        on_start(process)
+    buffers = {'stdout': OutputBuffer(max_output), 'stderr': OutputBuffer(max_output)}
+    timed_out = False
+    last_output = started
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(process.stderr, selectors.EVENT_READ, 'stderr')
+        try:
+            while selector.get_map():
+                wait = _next_deadline(started, last_output, timeout, idle_timeout)
+                if wait is not None and wait <= 0:
+                    timed_out = True
+                    break
+                for key, _ in selector.select(wait):
+                    data = os.read(key.fileobj.fileno(), READ_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        lines = buffers[key.data].close()
+                    else:
+                        last_output = time.monotonic()
+                        lines = buffers[key.data].feed(data)
+                    if on_output is not None:
+                        for line in lines:
+                            on_output(key.data, line)
+            if not timed_out:
+                wait = _next_deadline(started, None, timeout, 0)
+                try:
+                    process.wait(wait)
+                except subprocess.TimeoutExpired:
+                    timed_out = True
+        finally:
+            if timed_out or process.poll() is None:
+                kill_process_group(process)
+            process.stdout.close()
+            process.stderr.close()
+    return CommandResult(process.returncode, buffers['stdout'].text(), buffers['stderr'].text(),
+                         time.monotonic() - started, timed_out)
+
+
+async def run_command_async(cmd, cwd=None, on_output=None, timeout=None, idle_timeout=None,
+                            max_output=COMMAND_MAX_OUTPUT, on_start=None, limits=()):
+    """
+    asyncio variant of run_command, so that many commands can be supervised from one event loop.
+    :return: CommandResult
+    """
+    cmd = limited(cmd, limits)
+    timeout = COMMAND_TIMEOUT if timeout is None else timeout
+    idle_timeout = COMMAND_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_shell(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                                    stderr=subprocess.PIPE, cwd=cwd, start_new_session=True)
+    if on_start is not None:
+        on_start(process)
+    buffers = {'stdout': OutputBuffer(max_output), 'stderr': OutputBuffer(max_output)}
+    last_output = started
+
+    async def read(name, stream):
+        nonlocal last_output
+        while True:
+            data = await stream.read(READ_SIZE)
+            lines = buffers[name].feed(data) if data else buffers[name].close()
+            if data:
+                last_output = time.monotonic()
+            if on_output is not None:
+                for line in lines:
+                    on_output(name, line)
+            if not data:
+                return
 
+    readers = asyncio.gather(read('stdout', process.stdout), read('stderr', process.stderr), process.wait())
+    timed_out = False
+    try:
+        while True:
+            wait = _next_deadline(started, last_output, timeout, idle_timeout)
+            if wait is not None and wait <= 0:
+                timed_out = True
+                break
+            done, _ = await asyncio.wait({readers}, timeout=wait)
+            if done:
+                break
+    finally:
+        if timed_out or process.returncode is None:
+            await _kill_process_group_async(process)
+            readers.cancel()
+            try:
+                await readers
+            except (asyncio.CancelledError, Exception):
+                pass
+    return CommandResult(process.returncode, buffers['stdout'].text(), buffers['stderr'].text(),
+                         time.monotonic() - started, timed_out)
 
-def runcmd(cmd, supress_exceptions=False, cwd=None, supress_logs=False):
+
+def _next_deadline(started, last_output, timeout, idle_timeout):
+    """
+    Returns the seconds until the first timeout expires, None without timeouts.
+    """
+    now = time.monotonic()
+    waits = []
+    if timeout:
+        waits.append(started + timeout - now)
+    if idle_timeout and last_output is not None:
+        waits.append(last_output + idle_timeout - now)
+    return min(waits) if waits else None
+
+
+def limited(cmd, limits):
+    """
+    Wraps a shell command so that the whole command, not only its first program, runs with the given limits.
+    :param cmd: shell command
+    :param limits: command prefix applying resource limits, see governor.limits
+    :return: shell command
+    """
+    if not limits:
+        return cmd
+    return shlex.join([*limits, '/bin/sh', '-c', cmd])
+
+
+def kill_process_group(process, grace=COMMAND_KILL_GRACE):
+    """
+    Terminates the process group of the command, and kills it if it is still running after the grace period.
+    """
+    _signal_group(process, signal.SIGTERM)
+    try:
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        _signal_group(process, signal.SIGKILL)
+        process.wait()
+
+
+async def _kill_process_group_async(process, grace=COMMAND_KILL_GRACE):
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), grace)
+    except asyncio.TimeoutError:
+        _signal_group(process, signal.SIGKILL)
+        await process.wait()
+
+
+def _signal_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def runcmd(cmd, supress_exceptions=False, cwd=None, supress_logs=False, timeout=None, idle_timeout=None,
+           on_output=None, taxonomy=None):
     """
     Runs the given command in the command line.
     :param cmd: command to run
     :param supress_exceptions: flag to suppress the exception on failure
     :param supress_logs: flag to suppress the logs in the output
+    :param timeout: seconds the command may run, COMMAND_TIMEOUT by default
+    :param idle_timeout: seconds the command may run without output, COMMAND_IDLE_TIMEOUT by default
+    :param on_output: function called with the stream name and each line of output, logs the lines by default
+    :param taxonomy: taxonomy the command works on, the taxonomy of the cwd folder by default
+    :return: output of the command
+    """
+    # inside a job task the command is recorded as a step of the task, and is not started if the job was cancelled
+    task = current_task()
+    if task is not None:
+        task.check_cancelled()
+    taxonomy = taxonomy or command_taxonomy(cwd)
+    # commands wait for a slot of the subprocess governor, behind the interactive rltbl calls
+    permit = governor.acquire(BACKGROUND, taxonomy)
+    result = None
+    try:
+        log_info("RUNNING: {}".format(cmd), supress_logs)
+        started = time.time()
+        # one span per program (runcmd:make, runcmd:git...), labelled with the taxonomy
+        with span('runcmd:' + cmd.split(' ', 1)[0], taxonomy or ''):
+            try:
+                result = run_command(cmd, cwd=cwd, on_output=on_output or log_output(supress_logs), timeout=timeout,
+                                     idle_timeout=idle_timeout, on_start=_task_process(task),
+                                     limits=governor_limits(BACKGROUND))
+            finally:
+                if task is not None:
+                    task.process = None
+    finally:
+        # processes of cancelled jobs are killed on purpose
+        killed = task is not None and task.job.cancel_requested
+        permit.release(result.returncode if result else None, result is not None and result.timed_out, killed)
+    if task is not None:
+        task.add_step(cmd, result.returncode, started, result.duration, result.stdout, result.stderr)
+    return _check_result(cmd, result, supress_exceptions)
+
+
+async def runcmd_async(cmd, supress_exceptions=False, cwd=None, supress_logs=False, timeout=None, idle_timeout=None,
+                       on_output=None, taxonomy=None):
+    """
+    asyncio variant of runcmd.
     :return: output of the command
     """
-    log_info("RUNNING: {}".format(cmd), supress_logs)
-    p = subprocess.Popen([cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, shell=True, universal_newlines=True)
-    (out, err) = p.communicate()
-    log_info('OUT: {}'.format(out), supress_logs)
-    if err:
-        log_error("Error: " + err, supress_logs)
-    if not supress_exceptions and p.returncode != 0:
-        raise Exception('Failed: {}: {}'.format(cmd, err))
-    return out
+    taxonomy = taxonomy or command_taxonomy(cwd)
+    permit = await governor.acquire_async(BACKGROUND, taxonomy)
+    result = None
+    try:
+        log_info("RUNNING: {}".format(cmd), supress_logs)
+        with span('runcmd:' + cmd.split(' ', 1)[0], taxonomy or ''):
+            result = await run_command_async(cmd, cwd=cwd, on_output=on_output or log_output(supress_logs),
+                                             timeout=timeout, idle_timeout=idle_timeout,
+                                             limits=governor_limits(BACKGROUND))
+    finally:
+        permit.release(result.returncode if result else None, result is not None and result.timed_out)
+    return _check_result(cmd, result, supress_exceptions)
+
+
+def command_taxonomy(cwd):
+    """
+    Returns the taxonomy of the folder a command runs in, which may be a snapshot of the taxonomy.
+    """
+    return snapshots.taxonomy_name(str(cwd).rstrip('/')) if cwd else None
+
+
+def _task_process(task):
+    if task is None:
+        return None
+
+    def on_start(process):
+        task.process = process
+    return on_start
+
+
+def _check_result(cmd, result, supress_exceptions):
+    if result.timed_out:
+        if not supress_exceptions:
+            raise CommandTimeout('Timed out: {} after {:.0f} seconds: {}'.format(cmd, result.duration,
+                                                                                 result.stderr[-4096:]))
+    elif not supress_exceptions and result.returncode != 0:
+        raise Exception('Failed: {}: {}'.format(cmd, result.stderr))
+    return result.stdout
 
 
 def log_info(msg, supress_logs=False):
@@ -38,4 +372,4 @@ def log_error(msg, supress_logs=False):
     :param supress_logs: flag to suppress the logs in the output
     """
     if not supress_logs:
-        logging.error(msg)
\ No newline at end of file
+        logging.error(msg)
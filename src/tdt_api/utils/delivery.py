@@ -0,0 +1,167 @@
+import os
+import zlib
+import logging
+from itertools import chain
+
+from werkzeug.http import quote_etag
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# Compress the browser responses for the clients accepting gzip or brotli.
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Responses smaller than this many bytes are sent uncompressed.
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+# gzip compression level (1-9).
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+# brotli quality (0-11), brotli is offered only when the module is installed.
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+# Seconds the browsers may reuse the static assets of rltbl (scripts, style sheets, fonts, images) without asking.
+BROWSER_ASSET_MAX_AGE = int(os.getenv('BROWSER_ASSET_MAX_AGE', '86400'))
+
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'}
+ASSET_EXTENSIONS = {'.css', '.js', '.mjs', '.map', '.woff', '.woff2', '.ttf', '.png', '.jpg', '.jpeg', '.gif', '.svg',
+                    '.ico'}
+ENCODINGS = ('br', 'gzip')
+
+PAGE_CACHE_CONTROL = 'private, no-cache'
+POST_CACHE_CONTROL = 'no-store'
+
+
+def negotiate_encoding(accept_encodings):
+    """
+    Selects the content coding of the response from the Accept-Encoding header of the request.
+    :param accept_encodings: werkzeug Accept of the request (request.accept_encodings)
+    :return: 'br', 'gzip' or None for the identity coding
+    """
+    offered = [encoding for encoding in ENCODINGS if encoding != 'br' or brotli is not None]
+    best = accept_encodings.best_match(offered)
+    return best if best in offered else None
+
+
+def is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES or
+                               mimetype.endswith('+json') or mimetype.endswith('+xml'))
+
+
+def is_asset(path):
+    return os.path.splitext(path)[1].lower() in ASSET_EXTENSIONS
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses the body chunks as they are produced. Every chunk is flushed, so that the client can render the
+    beginning of a page while rltbl is still writing the rest of it.
+    :param chunks: iterable of body chunks, closed once the body is consumed or the client goes away
+    :param encoding: 'br' or 'gzip'
+    :return: iterable of compressed chunks
+    """
+    return ClosingIterator(_compress(chunks, encoding), _closer(chunks))
+
+
+def _compress(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        # wbits 16 + 15 writes the gzip header and trailer
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    for chunk in chunks:
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+def peek_body(chunks, size):
+    """
+    Reads the body chunks until size bytes are available or the body ends, without consuming the rest of the body.
+    :return: whether the body is shorter than size, and the chunks of the complete body
+    """
+    iterator = iter(chunks)
+    head = []
+    read = 0
+    while read < size:
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return True, head
+        head.append(chunk)
+        read += len(chunk)
+    return False, ClosingIterator(chain(head, iterator), _closer(chunks))
+
+
+def _closer(chunks):
+    close = getattr(chunks, 'close', None)
+    return [close] if close is not None else []
+
+
+def etag_matches(if_none_match, etag, weak=False):
+    """
+    Checks an If-None-Match header against the ETag of the identity representation. The tags sent for compressed
+    representations carry the coding as a suffix and match as well.
+    :param if_none_match: werkzeug ETags of the request
+    :param etag: unquoted ETag of the identity representation
+    :param weak: whether etag is a weak validator
+    :return: quoted ETag of the matching representation, None if the header does not match
+    """
+    if if_none_match.star_tag:
+        return quote_etag(etag, weak)
+    for tag in if_none_match.as_set(include_weak=True):
+        base, _, encoding = tag.rpartition('-')
+        if tag == etag or (base == etag and encoding in ENCODINGS):
+            return quote_etag(tag, weak)
+    return None
+
+
+def deliver(api_request, response, path):
+    """
+    Prepares a browser response for the client: sets its Cache-Control header and compresses the body with the coding
+    negotiated with the client when it is large enough. Compressed bodies are streamed, and their ETag is suffixed by
+    the coding, since their bytes differ from the identity representation.
+    :param api_request: request
+    :param response: response of rltbl, or of the browser cache
+    :param path: path of the requested page or asset
+    :return: response
+    """
+    if 'Cache-Control' not in response.headers:
+        if api_request.method != 'GET':
+            response.headers['Cache-Control'] = POST_CACHE_CONTROL
+        elif is_asset(path) and BROWSER_ASSET_MAX_AGE > 0:
+            response.headers['Cache-Control'] = f'public, max-age={BROWSER_ASSET_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = PAGE_CACHE_CONTROL
+    if not COMPRESSION_ENABLED:
+        return response
+    if response.status_code == 304:
+        response.vary.add('Accept-Encoding')
+        return response
+    if (response.status_code < 200 or response.status_code == 204 or 'Content-Encoding' in response.headers or
+            not is_compressible(response.mimetype)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(api_request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.content_length is not None and response.content_length < COMPRESSION_MIN_SIZE:
+        return response
+    complete, chunks = peek_body(response.response, COMPRESSION_MIN_SIZE)
+    if complete:
+        # the whole body was read, it is too small to be worth compressing
+        response.response = chunks
+        return response
+
+    response.response = compress_chunks(chunks, encoding)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+# Seconds to wait for GitHub to connect and to answer.
+GITHUB_TIMEOUT = float(os.getenv('GITHUB_TIMEOUT', '10'))
+# Number of keep-alive connections and of concurrent requests made for a single call.
+GITHUB_POOL_SIZE = int(os.getenv('GITHUB_POOL_SIZE', '10'))
+# Longest time a call waits for the rate limit to reset before it gives up.
+GITHUB_MAX_RATE_LIMIT_WAIT = float(os.getenv('GITHUB_MAX_RATE_LIMIT_WAIT', '10'))
+# Number of responses kept for conditional (If-None-Match) requests.
+GITHUB_ETAG_CACHE_SIZE = int(os.getenv('GITHUB_ETAG_CACHE_SIZE', '2000'))
+
+GitHubResponse = namedtuple('GitHubResponse', ['status_code', 'data'])
+
+
+class GitHubUnavailable(Exception):
+    """
+    GitHub could not be reached or the rate limit did not reset in time.
+    """
+    pass
+
+
+class GitHubClient:
+    """
+    GitHub REST API client sharing a pool of keep-alive connections between threads. GET responses are revalidated
+    with If-None-Match, which GitHub answers with 304 without counting the request against the rate limit, and the
+    rate limit reported by GitHub is tracked so that calls wait for the reset instead of failing.
+    """
+
+    def __init__(self, base_url=GITHUB_API_URL, timeout=GITHUB_TIMEOUT, pool_size=GITHUB_POOL_SIZE,
+                 max_rate_limit_wait=GITHUB_MAX_RATE_LIMIT_WAIT, etag_cache_size=GITHUB_ETAG_CACHE_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_rate_limit_wait = max_rate_limit_wait
+        self.etag_cache_size = etag_cache_size
+        self.etags = OrderedDict()
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = 0
+        self.lock = threading.Lock()
+        self._session = None
+        self._executor = None
+
+    @property
+    def session(self):
+        with self.lock:
+            if self._session is None:
+                session = requests.Session()
+                retries = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=['GET'])
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retries)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    @property
+    def executor(self):
+        with self.lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="github")
+            return self._executor
+
+    def get(self, path):
+        """
+        Sends a conditional GET request to the GitHub API.
+        :param path: API path, e.g. /orgs/{org}/members/{user}
+        :return: status code and decoded JSON body (None if the response has no body)
+        :raises GitHubUnavailable: if GitHub can't be reached or the rate limit is exhausted
+        """
+        url = self.base_url + path
+        for attempt in range(2):
+            self._wait_for_rate_limit()
+            headers = {
+                'Authorization': f'token {os.getenv("GITHUB_TOKEN")}',
+                'Accept': 'application/vnd.github.v3+json'
+            }
+            with self.lock:
+                cached = self.etags.get(url)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                log.error(f"GitHub request {path} failed: {e}")
+                raise GitHubUnavailable(str(e))
+            self._track_rate_limit(response)
+
+            if response.status_code == 304 and cached is not None:
+                with self.lock:
+                    self.etags.move_to_end(url)
+                return cached[1]
+            if response.status_code in (403, 429) and self._is_rate_limited(response):
+                log.warning(f"GitHub rate limit exceeded on {path}.")
+                continue
+
+            result = GitHubResponse(response.status_code, _json(response))
+            etag = response.headers.get('ETag')
+            if etag and response.status_code < 500:
+                with self.lock:
+                    self.etags[url] = (etag, result)
+                    self.etags.move_to_end(url)
+                    while len(self.etags) > self.etag_cache_size:
+                        self.etags.popitem(last=False)
+            return result
+        raise GitHubUnavailable("GitHub rate limit exceeded.")
+
+    def is_member_of_any_org(self, orgs, user_id):
+        """
+        Checks the organizations concurrently and returns as soon as one of them reports the user as a member.
+        :param orgs: GitHub organization names
+        :param user_id: GitHub user id
+        :return: True if the user is a member of any organization, False otherwise
+        """
+        futures = [self.executor.submit(self.get, f'/orgs/{org}/members/{user_id}') for org in orgs]
+        try:
+            for future in as_completed(futures):
+                try:
+                    if future.result().status_code == 204:
+                        return True
+                except GitHubUnavailable:
+                    pass
+            return False
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        with self.lock:
+            session, self._session = self._session, None
+            executor, self._executor = self._executor, None
+        if session is not None:
+            session.close()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _wait_for_rate_limit(self):
+        with self.lock:
+            exhausted = self.rate_limit_remaining == 0
+            wait = self.rate_limit_reset - time.time()
+        if not exhausted or wait <= 0:
+            return
+        if wait > self.max_rate_limit_wait:
+            raise GitHubUnavailable(f"GitHub rate limit exhausted for another {int(wait)} seconds.")
+        log.warning(f"Waiting {wait:.1f} seconds for the GitHub rate limit to reset.")
+        time.sleep(wait)
+
+    def _track_rate_limit(self, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        retry_after = response.headers.get('Retry-After')
+        with self.lock:
+            if remaining is not None:
+                self.rate_limit_remaining = int(remaining)
+            if reset is not None:
+                self.rate_limit_reset = int(reset)
+            if retry_after is not None and response.status_code in (403, 429):
+                self.rate_limit_remaining = 0
+                self.rate_limit_reset = time.time() + int(retry_after)
+
+    @staticmethod
+    def _is_rate_limited(response):
+        return response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers
+
+
+def _json(response):
+    if not response.content:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+github_client = GitHubClient()
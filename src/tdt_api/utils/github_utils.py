@@ -1,19 +1,38 @@
 import os
-import requests
+import json
+import shutil
+import fnmatch
+from concurrent.futures import as_completed
 import logging
 from enum import Enum
 
+from tdt_api.utils import snapshots
 from tdt_api.utils.command_line_utils import runcmd
+from tdt_api.utils.locks import taxonomy_lock
+from tdt_api.utils.github_client import github_client, GitHubUnavailable
 
-from cachetools import TTLCache, cached
+from tdt_api.utils.metrics import timed
+from tdt_api.utils.taxonomy_index import taxonomy_index
+from tdt_api.utils.permission_cache import PermissionCache, POSITIVE, NEGATIVE
 
 log = logging.getLogger(__name__)
 
-# Create a cache with a time-to-live of 600 seconds (10 minutes)
-cache = TTLCache(maxsize=100, ttl=600)
-
 DEFAULT_USER = "visitor"
 
+RLTBL_DB = '.relatable/relatable.db'
+# Changed files matching these patterns don't require the taxonomy to be rebuilt on an incremental reload.
+RELOAD_SKIP_BUILD_PATTERNS = os.getenv('RELOAD_SKIP_BUILD_PATTERNS', '*.md,docs/*,.github/*,LICENSE').split(',')
+# How taxonomy repositories are cloned: 'full', 'shallow' (single branch, GIT_CLONE_DEPTH commits), 'blobless'
+# (partial clone fetching file contents on demand) or 'reference' (borrows objects from a local bare mirror).
+GIT_CLONE_STRATEGY = os.getenv('GIT_CLONE_STRATEGY', 'full')
+GIT_CLONE_DEPTH = int(os.getenv('GIT_CLONE_DEPTH', '1'))
+# Folder under the taxonomies volume holding the bare mirrors used by the 'reference' strategy.
+MIRRORS_FOLDER = '.mirrors'
+# Organizations with at least this many uncached repositories in a batch permission check are looked up first: the
+# owners of an organization have write access to all of its repositories, which answers them with a single call.
+PERMISSION_ORG_LOOKUP_MIN = int(os.getenv('PERMISSION_ORG_LOOKUP_MIN', '3'))
+CLONE_STRATEGIES = ('full', 'shallow', 'blobless', 'reference')
+
 
 class Permissions(Enum):
     READ = 'read'
@@ -27,26 +46,151 @@ class Permissions(Enum):
             return "FALSE"
 
 
-def init_taxonomy_folder(branch, repo_url, taxonomies_volume, taxonomy_dir):
+def init_taxonomy_folder(branch, repo_url, taxonomies_volume, taxonomy_dir, strategy=None):
     try:
-        # Clone the repository
-        runcmd(f"git clone {repo_url}", cwd=taxonomies_volume)
-
-        # Navigate to the branch
-        runcmd(f"git checkout {branch}", cwd=taxonomy_dir, supress_exceptions=True)
-
-        # Run 'make init'
-        runcmd(f"make init", cwd=taxonomy_dir)
+        create_taxonomy_folder(branch, repo_url, taxonomies_volume, taxonomy_dir, strategy)
 
         return {"message": "Repository cloned and initialized successfully."}, 200
     except Exception as e:
         log.error(f"An error occurred: {e}")
         return {"message": "An error occurred while processing the request."}, 500
 
-@cached(cache)
+
+@timed('init_taxonomy_folder', lambda branch, repo_url, taxonomies_volume, taxonomy_dir, strategy=None:
+       snapshots.taxonomy_name(taxonomy_dir))
+def create_taxonomy_folder(branch, repo_url, taxonomies_volume, taxonomy_dir, strategy=None):
+    """
+    Clones the taxonomy repository and initializes it. Raises an exception if any of the steps fail.
+    :param branch: branch to check out
+    :param repo_url: repository url
+    :param taxonomies_volume: folder the repository is cloned into
+    :param taxonomy_dir: folder of the cloned taxonomy
+    :param strategy: clone strategy, defaults to GIT_CLONE_STRATEGY
+    """
+    strategy = strategy or GIT_CLONE_STRATEGY
+    # Clone the repository
+    runcmd(clone_command(branch, repo_url, taxonomies_volume, taxonomy_dir, strategy), cwd=taxonomies_volume,
+           taxonomy=snapshots.taxonomy_name(taxonomy_dir))
+
+    if strategy == 'full':
+        # Navigate to the branch
+        runcmd(f"git checkout {branch}", cwd=taxonomy_dir, supress_exceptions=True)
+
+    # Run 'make init'
+    runcmd(f"make init", cwd=taxonomy_dir)
+
+
+def clone_command(branch, repo_url, taxonomies_volume, taxonomy_dir, strategy=None):
+    """
+    Returns the git command that clones the repository with the given strategy. Apart from 'full', the strategies
+    clone the given branch only.
+    :param branch: branch to clone
+    :param repo_url: repository url
+    :param taxonomies_volume: folder of the taxonomies
+    :param taxonomy_dir: folder to clone into
+    :param strategy: one of CLONE_STRATEGIES, defaults to GIT_CLONE_STRATEGY
+    :return: git clone command
+    """
+    strategy = strategy or GIT_CLONE_STRATEGY
+    if strategy not in CLONE_STRATEGIES:
+        raise ValueError(f"Unknown clone strategy '{strategy}', expected one of {', '.join(CLONE_STRATEGIES)}.")
+    if strategy == 'shallow':
+        return f"git clone --depth {GIT_CLONE_DEPTH} --single-branch --branch {branch} {repo_url} {taxonomy_dir}"
+    if strategy == 'blobless':
+        return f"git clone --filter=blob:none --branch {branch} {repo_url} {taxonomy_dir}"
+    if strategy == 'reference':
+        mirror_dir = update_mirror(repo_url, taxonomies_volume)
+        return f"git clone --reference {mirror_dir} --branch {branch} {repo_url} {taxonomy_dir}"
+    return f"git clone {repo_url} {taxonomy_dir}"
+
+
+def update_mirror(repo_url, taxonomies_volume):
+    """
+    Creates or refreshes the local bare mirror of the repository that 'reference' clones borrow their objects from.
+    Clones depend on the mirror's objects, so the mirror is never pruned or garbage collected.
+    :param repo_url: repository url
+    :param taxonomies_volume: folder of the taxonomies
+    :return: folder of the mirror
+    """
+    repo_name = str(repo_url).split("/")[-1].split(".")[0]
+    mirror_dir = os.path.join(taxonomies_volume, MIRRORS_FOLDER, repo_name + ".git")
+    with taxonomy_lock(f"{MIRRORS_FOLDER}/{repo_name}"):
+        if os.path.isdir(mirror_dir):
+            runcmd("git fetch --quiet origin", cwd=mirror_dir, taxonomy=repo_name)
+        else:
+            os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+            runcmd(f"git clone --quiet --mirror {repo_url} {mirror_dir}", taxonomy=repo_name)
+            runcmd("git config gc.auto 0", cwd=mirror_dir, taxonomy=repo_name)
+    return mirror_dir
+
+
+@timed('update_taxonomy_folder', lambda branch, repo_url, taxonomies_volume, taxonomy_dir:
+       os.path.basename(taxonomy_dir))
+def update_taxonomy_folder(branch, repo_url, taxonomies_volume, taxonomy_dir):
+    """
+    Incrementally reloads a cloned taxonomy. Only the given branch is fetched and the update is prepared in a new
+    snapshot of the taxonomy, which replaces the served snapshot once it is ready. The taxonomy is only rebuilt if a
+    changed file is a build input (see RELOAD_SKIP_BUILD_PATTERNS).
+    :param branch: branch to reload
+    :param repo_url: repository url
+    :param taxonomies_volume: folder of the taxonomies
+    :param taxonomy_dir: folder of the taxonomy to reload
+    :return: summary of the reload
+    """
+    if os.path.exists(os.path.join(taxonomy_dir, '.git', 'objects', 'info', 'alternates')):
+        update_mirror(repo_url, taxonomies_volume)
+    depth = f"--depth {GIT_CLONE_DEPTH} " if os.path.exists(os.path.join(taxonomy_dir, '.git', 'shallow')) else ""
+    runcmd(f"git fetch {depth}{repo_url} {branch}", cwd=taxonomy_dir)
+    previous = runcmd("git rev-parse HEAD", cwd=taxonomy_dir).strip()
+    current = runcmd("git rev-parse FETCH_HEAD", cwd=taxonomy_dir).strip()
+    initialized = os.path.exists(os.path.join(taxonomy_dir, RLTBL_DB))
+    summary = {"previous": previous, "current": current, "changed_files": 0, "rebuilt": False}
+    if previous == current and initialized:
+        log.info(f"Taxonomy {taxonomy_dir} is already at {current}.")
+        return summary
+
+    changed_files = runcmd(f"git diff --name-only {previous} {current}", cwd=taxonomy_dir).split()
+    rebuild = not initialized or any(not _skip_build(path) for path in changed_files)
+    summary["changed_files"] = len(changed_files)
+    summary["rebuilt"] = rebuild
+
+    def prepare(snapshot_dir):
+        runcmd(f"git checkout -q -f -B {branch} {current}", cwd=snapshot_dir)
+        if rebuild:
+            shutil.rmtree(os.path.join(snapshot_dir, os.path.dirname(RLTBL_DB)), ignore_errors=True)
+            runcmd("make init", cwd=snapshot_dir)
+
+    snapshots.build(taxonomy_dir, prepare)
+    log.info(f"Taxonomy {taxonomy_dir} reloaded from {previous} to {current}.")
+    return summary
+
+
+def _skip_build(path):
+    return any(fnmatch.fnmatch(path, pattern.strip()) for pattern in RELOAD_SKIP_BUILD_PATTERNS if pattern.strip())
+
+
+def _span_taxonomy(repo_org, repo_name, user_id):
+    # the repository comes from the client, only the deployed taxonomies are used as labels to bound the series
+    return repo_name if taxonomy_index.get(repo_name) is not None else ''
+
+
+@timed('check_user_permission', _span_taxonomy)
 def check_user_permission(repo_org:str, repo_name: str, user_id: str) -> tuple[Permissions, int]:
     """
-    Check the permission of the user in the given repository.
+    Check the permission of the user in the given repository. Results are served from the permission cache.
+
+    :param repo_org: GitHub organization name
+    :param repo_name: GitHub repository name
+    :param user_id: GitHub user id
+    :return: Permission of the user in the repository: read, write, no_access
+    """
+    return permission_cache.get(repo_org, repo_name, user_id)
+
+
+@timed('github_permission', _span_taxonomy)
+def fetch_user_permission(repo_org:str, repo_name: str, user_id: str) -> tuple[Permissions, int]:
+    """
+    Fetch the permission of the user in the given repository from GitHub.
 
     :param repo_org: GitHub organization name
     :param repo_name: GitHub repository name
@@ -56,43 +200,128 @@ def check_user_permission(repo_org:str, repo_name: str, user_id: str) -> tuple[P
     permission = Permissions.NO_ACCESS
     status_code = 403
     if repo_org and user_id != DEFAULT_USER:
-        github_token = os.getenv('GITHUB_TOKEN')
-        headers = {
-            'Authorization': f'token {github_token}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        url = f'https://api.github.com/repos/{repo_org}/{repo_name}/collaborators/{user_id}/permission'
-        response = requests.get(url, headers=headers)
+        try:
+            response = github_client.get(f'/repos/{repo_org}/{repo_name}/collaborators/{user_id}/permission')
+        except GitHubUnavailable as e:
+            log.error(f"Permission of {user_id} on {repo_org}/{repo_name} could not be checked: {e}")
+            return permission, 503
         if response.status_code == 200:
-            permission = response.json().get('user').get('permissions')
+            permission = response.data.get('user').get('permissions')
             if permission.get("push", False):
                 permission = Permissions.WRITE
             else:
                 permission = Permissions.READ
         else:
-            print(response.json())
-            log.error(f"An error occurred: {response.json()}")
+            log.error(f"An error occurred: {response.data}")
         status_code = response.status_code
     return permission, status_code
 
 
+def check_user_permissions(user_id: str, repositories) -> dict:
+    """
+    Checks the permissions of the user in many repositories at once. Cached permissions are returned directly, the
+    others are fetched from GitHub concurrently. For organizations with many uncached repositories the user's role in
+    the organization is looked up first, and the repositories of the organizations the user owns are answered without
+    further calls.
+
+    :param user_id: GitHub user id
+    :param repositories: list of (organization, repository) pairs
+    :return: dictionary of (organization, repository) to the permission and status code
+    """
+    results = dict()
+    misses = dict()
+    for repo_org, repo_name in dict.fromkeys(repositories):
+        cached = permission_cache.get_cached(repo_org, repo_name, user_id)
+        if cached is not None:
+            results[(repo_org, repo_name)] = cached
+        else:
+            misses.setdefault(repo_org, []).append(repo_name)
+    if not misses:
+        return results
+
+    executor = github_client.executor
+    pending = []
+    role_lookups = dict()
+    for repo_org, repo_names in misses.items():
+        if repo_org and user_id != DEFAULT_USER and len(repo_names) >= PERMISSION_ORG_LOOKUP_MIN:
+            role_lookups[executor.submit(org_role_cache.get, repo_org, user_id)] = repo_org
+        else:
+            pending.extend((repo_org, repo_name, executor.submit(_check_permission, repo_org, repo_name, user_id))
+                           for repo_name in repo_names)
+    for future in as_completed(role_lookups):
+        repo_org = role_lookups[future]
+        role, status_code = future.result()
+        if role == 'admin':
+            for repo_name in misses[repo_org]:
+                results[(repo_org, repo_name)] = permission_cache.put((repo_org, repo_name, user_id),
+                                                                      (Permissions.WRITE, 200))
+        else:
+            pending.extend((repo_org, repo_name, executor.submit(_check_permission, repo_org, repo_name, user_id))
+                           for repo_name in misses[repo_org])
+    for repo_org, repo_name, future in pending:
+        results[(repo_org, repo_name)] = future.result()
+    return results
+
+
+def _check_permission(repo_org, repo_name, user_id):
+    try:
+        return permission_cache.get(repo_org, repo_name, user_id)
+    except Exception as e:
+        log.error(f"Permission of {user_id} on {repo_org}/{repo_name} could not be checked: {e}")
+        return Permissions.NO_ACCESS, 503
+
+
+@timed('github_org_role')
+def fetch_org_role(repo_org: str, user_id: str) -> tuple:
+    """
+    Fetch the role (admin or member) of the user in the given organization from GitHub.
+
+    :param repo_org: GitHub organization name
+    :param user_id: GitHub user id
+    :return: role of the user, None if the user is not an active member, and the status code
+    """
+    try:
+        response = github_client.get(f'/orgs/{repo_org}/memberships/{user_id}')
+    except GitHubUnavailable as e:
+        log.error(f"Role of {user_id} in {repo_org} could not be checked: {e}")
+        return None, 503
+    except Exception as e:
+        log.error(f"Role of {user_id} in {repo_org} could not be checked: {e}")
+        return None, 500
+    if response.status_code == 200 and (response.data or {}).get('state') == 'active':
+        return response.data.get('role'), 200
+    return None, response.status_code
+
+
 def is_user_member_of_org(orgs, user_id):
     """
-    Check if the user is a member of any of the given organizations.
+    Check if the user is a member of any of the given organizations. The organizations are checked concurrently.
 
     :param orgs: List of GitHub organization names
     :param user_id: GitHub user id
     :return: True if the user is a member of any organization, False otherwise
     """
-    github_token = os.getenv('GITHUB_TOKEN')
-    headers = {
-        'Authorization': f'token {github_token}',
-        'Accept': 'application/vnd.github.v3+json'
-    }
-
-    for org in orgs:
-        url = f'https://api.github.com/orgs/{org}/members/{user_id}'
-        response = requests.get(url, headers=headers)
-        if response.status_code == 204:
-            return True
-    return False
+    return github_client.is_member_of_any_org(orgs, user_id)
+
+
+def classify_permission(result):
+    """
+    Classifies a permission check for caching: granted permissions and definitive 'no access' answers are cached with
+    their own TTLs, transient errors (rate limits, GitHub unavailable) are not cached.
+    """
+    permission, status_code = result
+    if status_code == 200:
+        return POSITIVE
+    if status_code in (403, 404):
+        return NEGATIVE
+    return None
+
+
+org_role_cache = PermissionCache(fetch_org_role, classify_permission)
+
+permission_cache = PermissionCache(
+    fetch_user_permission,
+    classify_permission,
+    encode=lambda result: json.dumps([result[0].value, result[1]]),
+    decode=lambda value: (Permissions(json.loads(value)[0]), json.loads(value)[1]),
+)
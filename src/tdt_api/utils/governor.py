@@ -0,0 +1,286 @@
+import os
+import time
+import fcntl
+import asyncio
+import logging
+import threading
+from functools import partial
+from collections import defaultdict
+
+from tdt_api.utils.locks import LOCKS_FOLDER
+
+log = logging.getLogger(__name__)
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+# Subprocesses (rltbl calls and build commands) running at the same time in all the server workers. 0 for no limit.
+SUBPROCESS_MAX = int(os.getenv('SUBPROCESS_MAX', '64'))
+# Subprocesses of a single taxonomy running at the same time. 0 for no limit.
+SUBPROCESS_MAX_PER_TAXONOMY = int(os.getenv('SUBPROCESS_MAX_PER_TAXONOMY', '16'))
+# Slots of SUBPROCESS_MAX that only interactive rltbl calls can use, builds and other commands are limited to the rest.
+SUBPROCESS_INTERACTIVE_RESERVE = int(os.getenv('SUBPROCESS_INTERACTIVE_RESERVE', '8'))
+# Seconds an rltbl call waits for a subprocess slot before it is answered with 503. Builds wait for their turn.
+SUBPROCESS_QUEUE_TIMEOUT = float(os.getenv('SUBPROCESS_QUEUE_TIMEOUT', '10'))
+# Seconds an rltbl call may run before its process group is killed. 0 for no limit.
+RLTBL_TIMEOUT = float(os.getenv('RLTBL_TIMEOUT', '600'))
+# Address space (bytes) and CPU time (seconds) limits of each rltbl process. 0 for no limit.
+RLTBL_MEMORY_LIMIT = int(os.getenv('RLTBL_MEMORY_LIMIT', '0'))
+RLTBL_CPU_LIMIT = int(os.getenv('RLTBL_CPU_LIMIT', '0'))
+# Address space (bytes) and CPU time (seconds) limits of each build command (make, git...). 0 for no limit.
+BUILD_MEMORY_LIMIT = int(os.getenv('BUILD_MEMORY_LIMIT', '0'))
+BUILD_CPU_LIMIT = int(os.getenv('BUILD_CPU_LIMIT', '0'))
+# Niceness added to the build commands, so that the rltbl calls get the CPU first.
+BUILD_NICE = int(os.getenv('BUILD_NICE', '10'))
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+# seconds between the soft and the hard CPU limit, the process is sent SIGXCPU at the first and SIGKILL at the second
+CPU_LIMIT_GRACE = 5
+# folder of the lock files of the subprocess slots, under the lock folder of the volume
+SLOTS_FOLDER = 'subprocesses'
+# subfolders of the slots of the whole server and of the slots of each taxonomy, which can't collide with each other
+GLOBAL_SLOTS = 'global'
+TAXONOMY_SLOTS = 'taxonomy'
+# lock file held shared by the interactive calls waiting for a slot
+INTERACTIVE_WAITING = f'{GLOBAL_SLOTS}/interactive-waiting'
+# seconds between the attempts to take a slot held by another worker process
+POLL_MIN = 0.005
+POLL_MAX = 0.1
+
+
+class Rejected(Exception):
+    """
+    No subprocess slot became free in time.
+    """
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class Permit:
+    """
+    Slot of a running subprocess. Release is idempotent.
+    """
+
+    def __init__(self, governor, priority, taxonomy, slots=()):
+        self.governor = governor
+        self.priority = priority
+        self.taxonomy = taxonomy
+        self.slots = slots
+        self.released = False
+
+    def release(self, returncode=None, timed_out=False, killed=False):
+        """
+        Frees the slot and counts the processes killed by a timeout or by a signal (resource limit, OOM killer).
+        :param returncode: exit status of the process, negative if it was ended by a signal
+        :param timed_out: the process was killed because it exceeded its timeout
+        :param killed: the process was killed by the server for another reason, e.g. the client went away
+        """
+        self.governor._release(self, returncode, timed_out, killed)
+
+
+class Governor:
+    """
+    Bounds the subprocesses: globally, per taxonomy and for the background commands, which leave
+    SUBPROCESS_INTERACTIVE_RESERVE slots to the interactive ones. Waiting interactive calls are admitted before
+    waiting background commands.
+    With a lock folder, the slots are lock files that a permit holds an flock() on, so that the limits apply to all the
+    worker processes of the server together: background commands only take the first max_background slots, and back off
+    while an interactive call of any worker waits for a slot. Without it, the limits apply to this process only.
+    """
+
+    def __init__(self, max_processes=SUBPROCESS_MAX, max_per_taxonomy=SUBPROCESS_MAX_PER_TAXONOMY,
+                 interactive_reserve=SUBPROCESS_INTERACTIVE_RESERVE, queue_timeout=SUBPROCESS_QUEUE_TIMEOUT,
+                 lock_dir=None):
+        self.max_processes = max_processes
+        self.max_per_taxonomy = max_per_taxonomy
+        self.max_background = max(1, max_processes - interactive_reserve) if max_processes > 0 else 0
+        self.queue_timeout = queue_timeout
+        self.lock_dir = lock_dir
+        self.condition = threading.Condition()
+        self.running = {priority: 0 for priority in PRIORITIES}
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self.taxonomies = defaultdict(int)
+        self.admitted = {priority: 0 for priority in PRIORITIES}
+        self.rejected = {priority: 0 for priority in PRIORITIES}
+        self.killed = {(priority, reason): 0 for priority in PRIORITIES for reason in ('timeout', 'signal')}
+
+    def acquire(self, priority=BACKGROUND, taxonomy=None, timeout=None):
+        """
+        Waits for a subprocess slot.
+        :param priority: INTERACTIVE or BACKGROUND
+        :param taxonomy: taxonomy the process works on, if any
+        :param timeout: seconds to wait, SUBPROCESS_QUEUE_TIMEOUT for interactive calls and no limit for background
+        commands by default
+        :return: Permit to release once the process exited
+        :raises Rejected: if no slot became free in time
+        """
+        if timeout is None and priority == INTERACTIVE:
+            timeout = self.queue_timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        waiting_file = None
+        delay = POLL_MIN
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    slots = self._lock_slots(priority, taxonomy) if self._can_run(priority, taxonomy) else None
+                    if slots is not None:
+                        break
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        self.rejected[priority] += 1
+                        raise Rejected(f"Too many running subprocesses{f' for {taxonomy}' if taxonomy else ''}.",
+                                       max(1, round(timeout)))
+                    if self.lock_dir:
+                        if priority == INTERACTIVE and waiting_file is None:
+                            waiting_file = self._open(INTERACTIVE_WAITING)
+                            fcntl.flock(waiting_file, fcntl.LOCK_SH)
+                        # the permits of this process notify their release, the slots of the other ones are polled
+                        remaining = delay if remaining is None else min(delay, remaining)
+                        delay = min(delay * 2, POLL_MAX)
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting[priority] -= 1
+                if waiting_file is not None:
+                    waiting_file.close()
+            self.running[priority] += 1
+            if taxonomy:
+                self.taxonomies[taxonomy] += 1
+            self.admitted[priority] += 1
+        return Permit(self, priority, taxonomy, slots)
+
+    async def acquire_async(self, priority=BACKGROUND, taxonomy=None, timeout=None):
+        """
+        asyncio variant of acquire, waiting in a thread of the default executor.
+        :return: Permit to release once the process exited
+        """
+        future = asyncio.get_running_loop().run_in_executor(None, partial(self.acquire, priority, taxonomy, timeout))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the slot may still be granted to the cancelled caller
+            future.add_done_callback(lambda done: done.cancelled() or done.exception() or done.result().release())
+            raise
+
+    def stats(self):
+        with self.condition:
+            return {
+                "running": dict(self.running),
+                "waiting": dict(self.waiting),
+                "admitted": dict(self.admitted),
+                "rejected": dict(self.rejected),
+                "killed": dict(self.killed),
+            }
+
+    def _can_run(self, priority, taxonomy):
+        if self.max_processes > 0 and sum(self.running.values()) >= self.max_processes:
+            return False
+        if taxonomy and self.max_per_taxonomy > 0 and self.taxonomies.get(taxonomy, 0) >= self.max_per_taxonomy:
+            return False
+        if priority == BACKGROUND:
+            if self.max_background > 0 and self.running[BACKGROUND] >= self.max_background:
+                return False
+            # interactive calls go first
+            if self.waiting[INTERACTIVE]:
+                return False
+        return True
+
+    def _lock_slots(self, priority, taxonomy):
+        """
+        Takes the lock files of a global slot and of a slot of the taxonomy. A lock file is opened per permit, so the
+        permits of this process exclude each other like those of the other processes.
+        :return: locked slot files, or None if a slot is missing
+        """
+        if not self.lock_dir:
+            return ()
+        if priority == BACKGROUND and self._interactive_waiting():
+            return None
+        slots = []
+        if self.max_processes > 0:
+            # interactive calls take the reserved slots first, leaving the shared ones to the background commands
+            indexes = range(self.max_background) if priority == BACKGROUND else reversed(range(self.max_processes))
+            slots.append(self._lock_any(f'{GLOBAL_SLOTS}/slot-{index}' for index in indexes))
+        if taxonomy and self.max_per_taxonomy > 0:
+            name = taxonomy.replace('/', '_')
+            slots.append(self._lock_any(f'{TAXONOMY_SLOTS}/{name}/slot-{index}'
+                                        for index in range(self.max_per_taxonomy)))
+        if None in slots:
+            for slot in slots:
+                if slot is not None:
+                    slot.close()
+            return None
+        return tuple(slots)
+
+    def _lock_any(self, names):
+        for name in names:
+            slot = self._open(name)
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                slot.close()
+        return None
+
+    def _interactive_waiting(self):
+        with self._open(INTERACTIVE_WAITING) as waiting_file:
+            try:
+                fcntl.flock(waiting_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        return False
+
+    def _open(self, name):
+        path = os.path.join(self.lock_dir, name + '.lock')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, 'a')
+
+    def _release(self, permit, returncode, timed_out, killed):
+        with self.condition:
+            if permit.released:
+                return
+            permit.released = True
+            for slot in permit.slots:
+                # closing the file releases its lock
+                slot.close()
+            self.running[permit.priority] -= 1
+            if permit.taxonomy:
+                self.taxonomies[permit.taxonomy] -= 1
+                if not self.taxonomies[permit.taxonomy]:
+                    del self.taxonomies[permit.taxonomy]
+            if timed_out:
+                self.killed[(permit.priority, 'timeout')] += 1
+            elif returncode is not None and returncode < 0 and not killed:
+                self.killed[(permit.priority, 'signal')] += 1
+                log.warning(f"{permit.priority} subprocess{f' of {permit.taxonomy}' if permit.taxonomy else ''} was "
+                            f"killed by signal {-returncode}.")
+            self.condition.notify_all()
+
+
+def limits(priority, cpu=True):
+    """
+    Returns the command prefix applying the resource limits of the priority class: nice for the niceness and prlimit
+    for the memory and CPU time limits. These programs set the limits and exec the command, so that no Python code runs
+    in the child between fork and exec, which could deadlock in a multi-threaded server worker.
+    :param priority: INTERACTIVE or BACKGROUND
+    :param cpu: apply the CPU time limit, which is not meaningful for long-lived processes
+    :return: list of arguments to put before the command, empty if the class has no limits
+    """
+    memory_limit, cpu_limit, nice = (RLTBL_MEMORY_LIMIT, RLTBL_CPU_LIMIT, 0) if priority == INTERACTIVE \
+        else (BUILD_MEMORY_LIMIT, BUILD_CPU_LIMIT, BUILD_NICE)
+    cpu_limit = cpu_limit if cpu else 0
+    prefix = []
+    if nice:
+        prefix += ['nice', '-n', str(nice)]
+    if memory_limit or cpu_limit:
+        prefix.append('prlimit')
+        if memory_limit:
+            prefix.append(f'--as={memory_limit}')
+        if cpu_limit:
+            prefix.append(f'--cpu={cpu_limit}:{cpu_limit + CPU_LIMIT_GRACE}')
+        prefix.append('--')
+    return prefix
+
+
+governor = Governor(lock_dir=os.path.join(TAXONOMIES_VOLUME, LOCKS_FOLDER, SLOTS_FOLDER) if TAXONOMIES_VOLUME else None)
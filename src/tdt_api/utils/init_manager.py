@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from tdt_api.utils import snapshots
+from tdt_api.utils.command_line_utils import runcmd
+from tdt_api.utils.locks import taxonomy_lock
+from tdt_api.utils.taxonomy_index import taxonomy_index
+
+log = logging.getLogger(__name__)
+
+# Number of 'make init' builds that can run at the same time.
+TAXONOMY_INIT_WORKERS = int(os.getenv('TAXONOMY_INIT_WORKERS', '2'))
+# Seconds a browser request waits for a running build before it is answered with 202.
+TAXONOMY_INIT_WAIT = float(os.getenv('TAXONOMY_INIT_WAIT', '30'))
+# Seconds to wait before a failed build of a taxonomy is attempted again.
+TAXONOMY_INIT_RETRY_INTERVAL = float(os.getenv('TAXONOMY_INIT_RETRY_INTERVAL', '300'))
+
+RLTBL_DB = '.relatable/relatable.db'
+
+
+class InitStatus(Enum):
+    READY = 'ready'
+    INITIALIZING = 'initializing'
+    FAILED = 'failed'
+    NOT_INITIALIZED = 'not_initialized'
+    NOT_FOUND = 'not_found'
+
+
+class TaxonomyInitManager:
+    """
+    Runs 'make init' for taxonomies on a bounded background executor, at most one build per taxonomy at a time.
+    Concurrent callers share the future of the running build and failed builds are not retried until the retry
+    interval has passed.
+    """
+
+    def __init__(self, max_workers=TAXONOMY_INIT_WORKERS, retry_interval=TAXONOMY_INIT_RETRY_INTERVAL):
+        self.max_workers = max_workers
+        self.retry_interval = retry_interval
+        self.executor = None
+        self.builds = dict()
+        self.started = dict()
+        self.failures = dict()
+        self.lock = threading.Lock()
+
+    def submit(self, taxonomy, taxonomy_dir, force=False):
+        """
+        Starts building the taxonomy unless a build is already running, the taxonomy is already initialized or its
+        last build failed recently.
+        :param taxonomy: taxonomy name
+        :param taxonomy_dir: taxonomy folder
+        :param force: rebuild even if the taxonomy is already initialized or its last build failed recently
+        :return: future of the running build or None if no build is running
+        """
+        with self.lock:
+            future = self.builds.get(taxonomy)
+            if future is not None:
+                return future
+            if not os.path.isdir(taxonomy_dir):
+                return None
+            if not force and is_initialized(taxonomy_dir):
+                return None
+            failure = self.failures.get(taxonomy)
+            if not force and failure is not None and time.time() - failure[0] < self.retry_interval:
+                return None
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="taxonomy-init")
+            future = self.executor.submit(self._build, taxonomy, taxonomy_dir, force)
+            self.builds[taxonomy] = future
+            self.started[taxonomy] = time.time()
+            return future
+
+    def ensure_initialized(self, taxonomy, taxonomy_dir, wait=TAXONOMY_INIT_WAIT):
+        """
+        Makes sure the taxonomy is initialized, starting a build if needed and waiting for it up to wait seconds.
+        :param taxonomy: taxonomy name
+        :param taxonomy_dir: taxonomy folder
+        :param wait: seconds to wait for the build to finish
+        :return: initialization status of the taxonomy
+        """
+        if is_initialized(taxonomy_dir):
+            return InitStatus.READY
+        future = self.submit(taxonomy, taxonomy_dir)
+        if future is not None:
+            try:
+                future.result(timeout=wait)
+            except TimeoutError:
+                return InitStatus.INITIALIZING
+            except Exception:
+                pass
+        return self.status(taxonomy, taxonomy_dir)["status"]
+
+    def status(self, taxonomy, taxonomy_dir):
+        """
+        Returns the initialization status of the taxonomy.
+        :param taxonomy: taxonomy name
+        :param taxonomy_dir: taxonomy folder
+        :return: status dictionary
+        """
+        with self.lock:
+            building = taxonomy in self.builds
+            started = self.started.get(taxonomy)
+            failure = self.failures.get(taxonomy)
+        result = {"taxonomy": taxonomy, "started": started}
+        if building:
+            result["status"] = InitStatus.INITIALIZING
+        elif not os.path.isdir(taxonomy_dir):
+            result["status"] = InitStatus.NOT_FOUND
+        elif failure is not None:
+            result["status"] = InitStatus.FAILED
+            result["error"] = failure[1]
+            result["retry_after"] = max(0, int(failure[0] + self.retry_interval - time.time()))
+        elif is_initialized(taxonomy_dir):
+            result["status"] = InitStatus.READY
+        else:
+            result["status"] = InitStatus.NOT_INITIALIZED
+        return result
+
+    def is_building(self, taxonomy):
+        with self.lock:
+            return taxonomy in self.builds
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _build(self, taxonomy, taxonomy_dir, force=False):
+        try:
+            with taxonomy_lock(taxonomy):
+                # the folder may have been initialized by a clone or reload holding the lock
+                if not force and is_initialized(taxonomy_dir):
+                    return
+                log.info(f"Initializing taxonomy {taxonomy}...")
+                if is_initialized(taxonomy_dir):
+                    # a served taxonomy is rebuilt in a new snapshot
+                    snapshots.build(taxonomy_dir, lambda snapshot_dir: runcmd("make init", cwd=snapshot_dir))
+                else:
+                    runcmd("make init", cwd=taxonomy_dir)
+        except Exception as e:
+            log.error(f"Initialization of taxonomy {taxonomy} failed: {e}")
+            with self.lock:
+                self.failures[taxonomy] = (time.time(), str(e))
+            raise
+        else:
+            with self.lock:
+                self.failures.pop(taxonomy, None)
+            log.info(f"Taxonomy {taxonomy} initialized successfully.")
+        finally:
+            with self.lock:
+                self.builds.pop(taxonomy, None)
+            taxonomy_index.update(taxonomy)
+
+
+def is_initialized(taxonomy_dir):
+    return os.path.exists(os.path.join(taxonomy_dir, RLTBL_DB))
+
+
+init_manager = TaxonomyInitManager()
@@ -0,0 +1,424 @@
+import os
+import json
+import time
+import uuid
+import signal
+import socket
+import sqlite3
+import logging
+import threading
+from enum import Enum
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+# Number of job tasks (e.g. repositories being cloned and initialized) that run at the same time.
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+# Number of finished jobs kept for status queries.
+JOB_HISTORY_SIZE = int(os.getenv('JOB_HISTORY_SIZE', '100'))
+# SQLite file the jobs are persisted to, so that they survive restarts and can be polled from any worker process.
+JOB_DB = os.getenv('JOB_DB', os.path.join(TAXONOMIES_VOLUME, '.jobs', 'jobs.db') if TAXONOMIES_VOLUME else '')
+# Characters of the output of each step kept in the job log (the end of the output is kept).
+JOB_STEP_OUTPUT_LIMIT = int(os.getenv('JOB_STEP_OUTPUT_LIMIT', '65536'))
+
+
+class JobStatus(Enum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    # the process running the job stopped before the job finished
+    INTERRUPTED = 'interrupted'
+
+
+ACTIVE_STATUSES = {JobStatus.PENDING, JobStatus.RUNNING}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    A background operation made of independent tasks, e.g. one task per repository. Each task records the commands
+    it ran as steps, with their output and duration.
+    """
+
+    def __init__(self, name, task_names, job_id=None, created=None, owner=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.created = created or time.time()
+        self.finished = None if task_names else self.created
+        self.owner = owner or process_id()
+        self.cancel_requested = False
+        self.tasks = OrderedDict((task_name, {"status": JobStatus.PENDING, "started": None, "finished": None,
+                                              "duration": None, "error": None, "result": None, "steps": []})
+                                 for task_name in task_names)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if self.finished is not None:
+            self.done.set()
+
+    @property
+    def status(self):
+        statuses = {task["status"] for task in self.tasks.values()}
+        if statuses & ACTIVE_STATUSES:
+            return JobStatus.RUNNING if statuses != {JobStatus.PENDING} else JobStatus.PENDING
+        for status in (JobStatus.INTERRUPTED, JobStatus.FAILED, JobStatus.CANCELLED):
+            if status in statuses:
+                return status
+        return JobStatus.SUCCEEDED
+
+    def to_dict(self):
+        with self.lock:
+            tasks = {name: dict(task, status=task["status"].value, steps=list(task["steps"]))
+                     for name, task in self.tasks.items()}
+            return {
+                "id": self.id,
+                "name": self.name,
+                "status": self.status.value,
+                "created": self.created,
+                "finished": self.finished,
+                "cancel_requested": self.cancel_requested,
+                "owner": self.owner,
+                "tasks": tasks,
+            }
+
+    @classmethod
+    def from_dict(cls, document):
+        job = cls(document["name"], [], job_id=document["id"], created=document["created"], owner=document["owner"])
+        job.finished = document["finished"]
+        if job.finished is not None:
+            job.done.set()
+        job.cancel_requested = document["cancel_requested"]
+        for name, task in document["tasks"].items():
+            job.tasks[name] = dict(task, status=JobStatus(task["status"]))
+        return job
+
+    def _update(self, task_name, **values):
+        with self.lock:
+            self.tasks[task_name].update(values)
+            if values.get("finished") and self.status not in ACTIVE_STATUSES:
+                self.finished = values["finished"]
+                self.done.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits until all tasks of the job finished.
+        :return: True if the job finished, False on timeout
+        """
+        return self.done.wait(timeout)
+
+    def _add_step(self, task_name, step):
+        with self.lock:
+            self.tasks[task_name]["steps"].append(step)
+
+
+class TaskContext:
+    """
+    The job task running in the current thread. Commands run with runcmd report their steps to it and check it for
+    cancellation.
+    """
+
+    def __init__(self, manager, job, task_name):
+        self.manager = manager
+        self.job = job
+        self.task_name = task_name
+        self.process = None
+
+    def check_cancelled(self):
+        if self.job.cancel_requested or self.manager._cancel_requested(self.job.id):
+            self.job.cancel_requested = True
+            raise JobCancelled(f"Job {self.job.id} was cancelled.")
+
+    def add_step(self, command, returncode, started, duration, stdout='', stderr=''):
+        self.job._add_step(self.task_name, {
+            "command": command,
+            "returncode": returncode,
+            "started": started,
+            "duration": duration,
+            "stdout": (stdout or '')[-JOB_STEP_OUTPUT_LIMIT:],
+            "stderr": (stderr or '')[-JOB_STEP_OUTPUT_LIMIT:],
+        })
+        self.manager._save(self.job)
+
+
+_context = threading.local()
+
+
+def current_task():
+    """
+    Returns the context of the job task running in the current thread, None outside of jobs.
+    """
+    return getattr(_context, 'task', None)
+
+
+def process_id():
+    """
+    Returns the owner id of the jobs of this process: host, pid and start time of the process, which tells the process
+    apart from a later one reusing its pid after a restart.
+    """
+    start_time = process_start_time(os.getpid())
+    return f"{socket.gethostname()}:{os.getpid()}" + (f":{start_time}" if start_time else "")
+
+
+def process_start_time(pid):
+    """
+    Returns the start time of the process in clock ticks since boot, None if it is not known.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            stat = file.read()
+    except OSError:
+        return None
+    # the fields after the command name, which is in parentheses and may contain spaces; starttime is the 22nd field
+    return stat[stat.rindex(')') + 2:].split()[19]
+
+
+def is_owner_alive(owner):
+    """
+    Returns whether the process that owns a job still runs. Processes of other hosts are considered gone, since a
+    volume is served by a single container. A process with the owner's pid but another start time reused the pid.
+    """
+    host, _, process = owner.partition(':')
+    pid, _, start_time = process.partition(':')
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    if start_time and process_start_time(pid) not in (None, start_time):
+        return False
+    return True
+
+
+class JobManager:
+    """
+    Runs the tasks of background jobs on a bounded executor, separate from the request handling threads. Jobs are
+    persisted to a SQLite file on the volume (if configured) so that their status and log survive restarts and can
+    be queried from any worker process.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, history_size=JOB_HISTORY_SIZE, db_path=JOB_DB):
+        self.max_workers = max_workers
+        self.history_size = history_size
+        self.db_path = db_path
+        self.executor = None
+        self.jobs = OrderedDict()
+        self.contexts = dict()
+        self.lock = threading.Lock()
+        self.db_lock = threading.RLock()
+        self._connection = None
+        self._connection_pid = None
+
+    def submit(self, name, tasks):
+        """
+        Starts a job running the given tasks concurrently.
+        :param name: job name
+        :param tasks: dictionary of task name to callable, the return value of the callable is the task result
+        :return: the submitted job
+        """
+        job = Job(name, tasks.keys())
+        self._save(job)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history_size:
+                self.jobs.popitem(last=False)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+            for task_name, task in tasks.items():
+                self.executor.submit(self._run_task, job, task_name, task)
+        log.info(f"Job {job.id} ({name}) submitted with {len(tasks)} tasks.")
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        document = self._load(job_id)
+        return Job.from_dict(document) if document is not None else None
+
+    def list(self, limit=20):
+        """
+        Returns the most recent jobs, newest first.
+        """
+        if self._db() is None:
+            with self.lock:
+                jobs = list(self.jobs.values())
+            return [job.to_dict() for job in reversed(jobs)][:limit]
+        with self.db_lock:
+            rows = self._db().execute("SELECT document FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def cancel(self, job_id):
+        """
+        Cancels the job: its pending tasks are skipped and the commands of its running tasks are terminated. Jobs run
+        by another worker process stop at their next step.
+        :return: the job, None if not found
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            contexts = [context for context in self.contexts.values() if context.job.id == job_id]
+        if job is None:
+            document = self._load(job_id)
+            if document is None:
+                return None
+            job = Job.from_dict(document)
+            if job.status in ACTIVE_STATUSES and is_owner_alive(job.owner):
+                job.cancel_requested = True
+                self._save(job)
+                return job
+            if job.status in ACTIVE_STATUSES:
+                self._interrupt(job)
+            return job
+
+        if job.status not in ACTIVE_STATUSES:
+            return job
+        job.cancel_requested = True
+        now = time.time()
+        for task_name, task in job.tasks.items():
+            if task["status"] == JobStatus.PENDING:
+                job._update(task_name, status=JobStatus.CANCELLED, finished=now, duration=0)
+        for context in contexts:
+            process = context.process
+            if process is not None and process.poll() is None:
+                log.info(f"Terminating '{context.task_name}' of cancelled job {job_id}.")
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        self._save(job)
+        return job
+
+    def recover(self):
+        """
+        Marks the unfinished jobs of the processes that no longer run as interrupted.
+        """
+        try:
+            if self._db() is None:
+                return
+            with self.db_lock:
+                rows = self._db().execute("SELECT document FROM jobs WHERE status IN (?, ?)",
+                                          (JobStatus.PENDING.value, JobStatus.RUNNING.value)).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            log.error(f"Could not read the jobs from {self.db_path}: {e}")
+            return
+        for row in rows:
+            job = Job.from_dict(json.loads(row[0]))
+            if not is_owner_alive(job.owner):
+                log.warning(f"Job {job.id} ({job.name}) was interrupted by a restart.")
+                self._interrupt(job)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _run_task(self, job, task_name, task):
+        if job.tasks[task_name]["status"] != JobStatus.PENDING:
+            # cancelled while queued
+            return
+        context = TaskContext(self, job, task_name)
+        started = time.time()
+        job._update(task_name, status=JobStatus.RUNNING, started=started)
+        self._save(job)
+        with self.lock:
+            self.contexts[(job.id, task_name)] = context
+        _context.task = context
+        try:
+            context.check_cancelled()
+            result = task()
+        except Exception as e:
+            finished = time.time()
+            if job.cancel_requested:
+                log.info(f"Job {job.id} task {task_name} cancelled.")
+                job._update(task_name, status=JobStatus.CANCELLED, error=str(e), finished=finished,
+                            duration=finished - started)
+            else:
+                log.error(f"Job {job.id} task {task_name} failed: {e}")
+                job._update(task_name, status=JobStatus.FAILED, error=str(e), finished=finished,
+                            duration=finished - started)
+        else:
+            finished = time.time()
+            job._update(task_name, status=JobStatus.SUCCEEDED, result=result, finished=finished,
+                        duration=finished - started)
+        finally:
+            _context.task = None
+            with self.lock:
+                self.contexts.pop((job.id, task_name), None)
+        self._save(job)
+
+    def _interrupt(self, job):
+        now = time.time()
+        for task_name, task in job.tasks.items():
+            if task["status"] in ACTIVE_STATUSES:
+                job._update(task_name, status=JobStatus.INTERRUPTED, finished=now,
+                            error="The server stopped before the task finished.")
+        self._save(job)
+
+    def _cancel_requested(self, job_id):
+        if self._db() is None:
+            return False
+        with self.db_lock:
+            row = self._db().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def _save(self, job):
+        if self._db() is None:
+            return
+        document = job.to_dict()
+        try:
+            with self.db_lock, self._db() as connection:
+                # a cancellation requested by another process must not be overwritten
+                connection.execute(
+                    "INSERT INTO jobs (id, name, status, created, finished, cancel_requested, document) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET status = excluded.status, "
+                    "finished = excluded.finished, cancel_requested = max(cancel_requested, excluded.cancel_requested),"
+                    " document = excluded.document",
+                    (job.id, job.name, document["status"], job.created, job.finished, int(job.cancel_requested),
+                     json.dumps(document, default=str)))
+                connection.execute("DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY created DESC "
+                                   "LIMIT ?) AND status NOT IN (?, ?)",
+                                   (self.history_size, JobStatus.PENDING.value, JobStatus.RUNNING.value))
+        except (sqlite3.Error, OSError) as e:
+            log.error(f"Could not save job {job.id}: {e}")
+
+    def _load(self, job_id):
+        if self._db() is None:
+            return None
+        with self.db_lock:
+            row = self._db().execute("SELECT document, cancel_requested FROM jobs WHERE id = ?",
+                                     (job_id,)).fetchone()
+        if row is None:
+            return None
+        document = json.loads(row[0])
+        document["cancel_requested"] = bool(row[1])
+        return document
+
+    def _db(self):
+        if not self.db_path:
+            return None
+        with self.db_lock:
+            if self._connection is None or self._connection_pid != os.getpid():
+                os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+                connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                                   "status TEXT NOT NULL, created REAL NOT NULL, finished REAL, "
+                                   "cancel_requested INTEGER NOT NULL DEFAULT 0, document TEXT NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+                connection.commit()
+                self._connection = connection
+                self._connection_pid = os.getpid()
+            return self._connection
+
+
+job_manager = JobManager()
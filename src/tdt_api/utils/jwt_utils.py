@@ -1,32 +1,137 @@
 import os
 import json
+import time
+import hashlib
+import threading
 import jwt
+from collections import OrderedDict, namedtuple
 from typing import Any, Dict
 
+import flask
 from hkdf import Hkdf
 from jose.jwe import decrypt, encrypt
 
+from tdt_api.utils.metrics import timed
+
 
 DEFAULT_USER = "visitor"
 
+# Verified sessions kept in memory, keyed by a hash of their token.
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+# Longest time a verified session is reused, tokens expiring earlier are dropped at their 'exp'.
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', '300'))
+
+Session = namedtuple('Session', ['user', 'email', 'repo_org'])
+ANONYMOUS_SESSION = Session(DEFAULT_USER, None, None)
+
+# secrets and keys, read and derived once by configure()
+_token_secret = None
+_encryption_key = None
+
+
+def configure(token_secret=None, nextauth_secret=None):
+    """
+    Reads the token secrets, from the environment by default, and derives the JWE encryption key. Called at startup
+    once the .env file was loaded.
+    """
+    global _token_secret, _encryption_key
+    _token_secret = token_secret or os.getenv('TOKEN_SECRET')
+    nextauth_secret = nextauth_secret or os.getenv('NEXTAUTH_SECRET')
+    _encryption_key = __encryption_key(nextauth_secret) if nextauth_secret else None
+    session_cache.clear()
+
+
+class SessionCache:
+    """
+    LRU cache of the sessions of verified tokens. Entries expire at the token's 'exp' claim, and at the latest
+    SESSION_CACHE_TTL seconds after the token was verified.
+    """
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, token, decode):
+        """
+        Returns the session of the token, decoding and verifying it with decode on a cache miss.
+        :param kind: token type, part of the key
+        :param token: token
+        :param decode: function returning the session and the expiry time (epoch seconds or None) of the token
+        :return: session
+        """
+        key = hashlib.sha256(f"{kind}:{token}".encode('utf-8')).digest()
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        session, expires = decode(token)
+        expires = min(expires, now + self.ttl) if expires is not None else now + self.ttl
+        if self.max_size > 0 and expires > now:
+            with self.lock:
+                self.entries[key] = (session, expires)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return session
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+session_cache = SessionCache()
+
+
+@timed('get_session_info')
 def get_session_info(rqst):
-    user = DEFAULT_USER
-    email = None
-    repo_org = None
+    """
+    Returns the session of the request: the user, email and repository organization of its auth token. The session
+    is verified once per token (see SessionCache) and once per request, where it is kept on flask.g.
+    :param rqst: request
+    :return: Session, which unpacks as (user, email, repo_org)
+    """
+    in_request = flask.has_request_context() and rqst is flask.request
+    if in_request and 'tdt_session' in flask.g:
+        return flask.g.tdt_session
 
+    session = ANONYMOUS_SESSION
     if rqst.args.get('token'):
         token = rqst.args.get('token')
-        email, repo_org, user = decode_simple_token(token, os.getenv('TOKEN_SECRET'))
+        session = session_cache.get('jwt', token, decode_simple_session)
     elif rqst.cookies and 'tdtAuthToken' in rqst.cookies:
         token = rqst.cookies.get('tdtAuthToken')
-        email, repo_org, user = decode_simple_token(token, os.getenv('TOKEN_SECRET'))
+        session = session_cache.get('jwt', token, decode_simple_session)
     # elif rqst.cookies and 'authjs.session-token' in rqst.cookies:
     #     token = rqst.cookies.get('authjs.session-token')
-    #     email, repo_org, user = decode_encrypted_token(token, os.getenv('NEXTAUTH_SECRET'))
+    #     session = session_cache.get('jwe', token, decode_encrypted_session)
     # elif rqst.cookies and '__Secure-authjs.session-token' in rqst.cookies:
     #     token = rqst.cookies.get('__Secure-authjs.session-token')
-    #     email, repo_org, user = decode_encrypted_token(token, os.getenv('NEXTAUTH_SECRET'))
-    return user, email, repo_org
+    #     session = session_cache.get('jwe', token, decode_encrypted_session)
+    if in_request:
+        flask.g.tdt_session = session
+    return session
+
+
+def decode_simple_session(token: str):
+    decoded = jwt.decode(token, _token_secret, algorithms=['HS256'])
+    return Session(decoded.get('name'), decoded.get('email'), decoded.get('repoOrg')), decoded.get('exp')
+
+
+def decode_encrypted_session(token: str):
+    email, repo_org, user = decode_encrypted_token(token, key=_encryption_key)
+    return Session(user, email, repo_org), None
 
 
 def decode_simple_token(token: str, secret):
@@ -47,8 +152,8 @@ def encode_jwe(payload: Dict[str, Any], secret: str):
     return bytes.decode(encrypt(data, key), "utf-8")
 
 
-def decode_encrypted_token(token: str, secret: str):
-    e_key=  __encryption_key(secret)
+def decode_encrypted_token(token: str, secret: str = None, key: bytes = None):
+    e_key = key or __encryption_key(secret)
     decrypted = decrypt(token,e_key)
 
     if decrypted:
@@ -58,4 +163,7 @@ def decode_encrypted_token(token: str, secret: str):
             user_name = token_content.get('user').get('username')
         return token_content.get('email'), None, user_name
     else:
-        return None, None, None
\ No newline at end of file
+        return None, None, None
+
+
+configure()
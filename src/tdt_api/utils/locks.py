@@ -0,0 +1,69 @@
+import os
+import fcntl
+import threading
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+# Folder under the taxonomies volume holding the lock files shared by the server worker processes.
+LOCKS_FOLDER = '.locks'
+
+_locks = dict()
+_locks_lock = threading.Lock()
+
+
+class TaxonomyLock:
+    """
+    Re-entrant lock that is held across threads of this process and, through an flock() on a lock file in the
+    taxonomies volume, across the worker processes of the server.
+    """
+
+    def __init__(self, name, lock_dir=None):
+        self.name = name
+        self.lock_dir = lock_dir
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def acquire(self):
+        self.lock.acquire()
+        if self.depth == 0 and self.lock_dir:
+            try:
+                os.makedirs(self.lock_dir, exist_ok=True)
+                self.file = open(os.path.join(self.lock_dir, self.name.replace('/', '_') + '.lock'), 'w')
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+            except BaseException:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.lock.release()
+                raise
+        self.depth += 1
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def taxonomy_lock(taxonomy):
+    """
+    Returns the lock that serializes the operations modifying the folder of the given taxonomy (clone, reload, build).
+    :param taxonomy: taxonomy name
+    :return: re-entrant lock of the taxonomy
+    """
+    with _locks_lock:
+        lock = _locks.get(taxonomy)
+        if lock is None:
+            lock_dir = os.path.join(TAXONOMIES_VOLUME, LOCKS_FOLDER) if TAXONOMIES_VOLUME else None
+            lock = TaxonomyLock(taxonomy, lock_dir)
+            _locks[taxonomy] = lock
+        return lock
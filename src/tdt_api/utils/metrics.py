@@ -0,0 +1,351 @@
+import os
+import time
+import logging
+import threading
+import functools
+
+import prometheus_client
+from prometheus_client import multiprocess
+
+log = logging.getLogger(__name__)
+
+# Collect timing spans and request metrics. When disabled the instrumentation is reduced to a flag check.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Maximum number of label combinations per metric in a worker process, further series are dropped.
+METRICS_MAX_SERIES = int(os.getenv('METRICS_MAX_SERIES', '5000'))
+# Folder shared by the worker processes of the server, where prometheus_client keeps the metrics of each worker so that
+# a scrape served by any worker reports all of them. It is read by prometheus_client when it is imported, so it must be
+# set in the environment of the server. Empty reports the scraped worker only.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR', '')
+# Seconds between two copies of the cache and scheduler statistics of a worker into the shared metrics.
+METRICS_COLLECT_INTERVAL = float(os.getenv('METRICS_COLLECT_INTERVAL', '5'))
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+
+# the counters are exported without their creation time series
+prometheus_client.disable_created_metrics()
+
+dropped_series = prometheus_client.Counter('tdt_metrics_dropped_series_total',
+                                           'Samples dropped because a metric had too many series.')
+
+
+class Metric:
+    """
+    Base class of the metrics: a prometheus_client metric whose label values are given as keyword arguments, with at
+    most METRICS_MAX_SERIES series.
+    """
+    metric_class = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=prometheus_client.REGISTRY, **kwargs):
+        self.name = name
+        self.labelnames = tuple(labelnames)
+        self.metric = self.metric_class(name, documentation, self.labelnames, registry=registry, **kwargs)
+        self.series = set()
+        self.lock = threading.Lock()
+
+    def _series(self, labels):
+        if not self.labelnames:
+            return self.metric
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        if key not in self.series:
+            with self.lock:
+                if key not in self.series:
+                    if len(self.series) >= METRICS_MAX_SERIES:
+                        dropped_series.inc()
+                        return None
+                    self.series.add(key)
+        return self.metric.labels(*key)
+
+
+class Counter(Metric):
+    metric_class = prometheus_client.Counter
+
+    def inc(self, amount=1, **labels):
+        series = self._series(labels)
+        if series is not None:
+            series.inc(amount)
+
+
+class Gauge(Metric):
+    metric_class = prometheus_client.Gauge
+
+    def set(self, value, **labels):
+        series = self._series(labels)
+        if series is not None:
+            series.set(value)
+
+
+class Histogram(Metric):
+    metric_class = prometheus_client.Histogram
+
+    def __init__(self, name, documentation, labelnames=(), registry=prometheus_client.REGISTRY,
+                 buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames, registry, buckets=buckets)
+
+    def observe(self, value, **labels):
+        series = self._series(labels)
+        if series is not None:
+            series.observe(value)
+
+
+_metrics = dict()
+_collectors = []
+_gauge_modes = dict()
+# last value of each collected counter series, and the collected gauge series, to update them on the next collection
+_collected = dict()
+_registry_lock = threading.Lock()
+_collect_lock = threading.Lock()
+_collector_thread = None
+_collector_stop = threading.Event()
+
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    mode = 'live' + _gauge_modes.get(name, 'sum')
+    return _register(Gauge, name, documentation, labelnames, multiprocess_mode=mode)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def _register(cls, name, documentation, labelnames, **kwargs):
+    with _registry_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = cls(name, documentation, labelnames, **kwargs)
+            _metrics[name] = metric
+        return metric
+
+
+def register_collector(collector):
+    """
+    Registers a function returning the statistics kept by other components, as a list of (name, type, documentation,
+    samples) tuples, where type is 'counter' or 'gauge' and samples are (labels, value) tuples. They are copied into
+    the metrics on every scrape, and every METRICS_COLLECT_INTERVAL seconds in the server workers.
+    """
+    _collectors.append(collector)
+
+
+def aggregate_gauge(name, mode):
+    """
+    Sets how the values of a gauge reported by the worker processes are combined: 'min', 'max' or 'mostrecent', they
+    are summed by default. Must be called before the gauge is first collected.
+    """
+    _gauge_modes[name] = mode
+
+
+span_duration = histogram('tdt_span_duration_seconds', 'Duration of the instrumented operations.',
+                          ('span', 'taxonomy'))
+span_errors = counter('tdt_span_errors_total', 'Instrumented operations that raised an exception.',
+                      ('span', 'taxonomy'))
+request_duration = histogram('tdt_http_request_duration_seconds', 'Duration of the HTTP requests, until the '
+                             'response was streamed.', ('endpoint', 'method'))
+requests_total = counter('tdt_http_requests_total', 'HTTP requests by response status.',
+                         ('endpoint', 'method', 'status'))
+
+
+class Span:
+    """
+    Context manager recording the duration of an operation, and whether it failed, in the span metrics.
+    """
+    __slots__ = ('name', 'taxonomy', 'start')
+
+    def __init__(self, name, taxonomy=''):
+        self.name = name
+        self.taxonomy = taxonomy or ''
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        span_duration.observe(time.perf_counter() - self.start, span=self.name, taxonomy=self.taxonomy)
+        if exc_type is not None:
+            span_errors.inc(span=self.name, taxonomy=self.taxonomy)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, taxonomy=''):
+    """
+    Returns a context manager timing the enclosed block as the given span.
+    :param name: span name
+    :param taxonomy: taxonomy the operation works on, if any
+    """
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return Span(name, taxonomy)
+
+
+def observe_span(name, seconds, taxonomy=''):
+    """
+    Records a span that was timed by the caller, e.g. a phase ending in another thread.
+    """
+    if METRICS_ENABLED:
+        span_duration.observe(seconds, span=name, taxonomy=taxonomy or '')
+
+
+def timed(name, taxonomy=None):
+    """
+    Decorator timing every call of the function as the given span.
+    :param name: span name
+    :param taxonomy: optional function returning the taxonomy label from the arguments of the call
+    """
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name, taxonomy(*args, **kwargs) if taxonomy else ''):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_app(flask_app):
+    """
+    Records the duration and status of every request of the application.
+    """
+    if not METRICS_ENABLED:
+        return
+    from flask import g, request
+
+    @flask_app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @flask_app.after_request
+    def record_request(response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        method = request.method
+        status = response.status_code
+
+        def record():
+            request_duration.observe(time.perf_counter() - start, endpoint=endpoint, method=method)
+            requests_total.inc(endpoint=endpoint, method=method, status=status)
+        response.call_on_close(record)
+        return response
+
+
+def update_collected():
+    """
+    Copies the statistics of the registered collectors into the metrics: counters are increased by the difference
+    with the previous collection, gauges are set, and the gauge series that are no longer reported are set to 0.
+    """
+    with _collect_lock:
+        for collector in list(_collectors):
+            try:
+                families = collector()
+            except Exception as e:
+                log.error(f"Metrics collector failed: {e}")
+                continue
+            for name, metric_type, documentation, samples in families:
+                _update_family(name, metric_type, documentation, samples)
+
+
+def _update_family(name, metric_type, documentation, samples):
+    if not samples and name not in _metrics:
+        return
+    labelnames = tuple(samples[0][0]) if samples else _metrics[name].labelnames
+    if metric_type == 'counter':
+        metric = counter(name, documentation, labelnames)
+        for labels, value in samples:
+            key = (name, tuple(labels.items()))
+            # a counter of the component that went back to 0 adds its new counts from there
+            previous = _collected.get(key, 0)
+            metric.inc(value - previous if value >= previous else value, **labels)
+            _collected[key] = value
+        return
+    metric = gauge(name, documentation, labelnames)
+    reported = set()
+    for labels, value in samples:
+        metric.set(value, **labels)
+        reported.add(tuple(labels.items()))
+    for labels in _collected.get(name, set()) - reported:
+        metric.set(0, **dict(labels))
+    _collected[name] = reported
+
+
+def render():
+    """
+    Returns all metrics in the Prometheus text exposition format: those of this process, or with
+    PROMETHEUS_MULTIPROC_DIR those of all the worker processes.
+    """
+    update_collected()
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, PROMETHEUS_MULTIPROC_DIR)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry).decode()
+
+
+def start_collector():
+    """
+    Copies the statistics of the collectors into the shared metrics every METRICS_COLLECT_INTERVAL seconds, for the
+    scrapes served by the other workers. Called in each worker after it is forked.
+    """
+    global _collector_thread
+    if not (METRICS_ENABLED and PROMETHEUS_MULTIPROC_DIR) or \
+            (_collector_thread is not None and _collector_thread.is_alive()):
+        return
+    _collector_stop.clear()
+    _collector_thread = threading.Thread(target=_collect_loop, name="metrics-collect", daemon=True)
+    _collector_thread.start()
+
+
+def stop_collector():
+    """
+    Stops the collection thread after a last copy of the statistics of this process.
+    """
+    global _collector_thread
+    if _collector_thread is None:
+        return
+    _collector_stop.set()
+    _collector_thread.join()
+    _collector_thread = None
+    update_collected()
+
+
+def _collect_loop():
+    while not _collector_stop.wait(METRICS_COLLECT_INTERVAL):
+        update_collected()
+
+
+def init_directory():
+    """
+    Prepares PROMETHEUS_MULTIPROC_DIR for a new server, removing the metrics of a previous one.
+    """
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    for name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+        if name.endswith('.db'):
+            os.remove(os.path.join(PROMETHEUS_MULTIPROC_DIR, name))
+
+
+def mark_worker_dead(pid):
+    """
+    Drops the gauges of an exited worker process, its counters and histograms are kept so that they never decrease.
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, PROMETHEUS_MULTIPROC_DIR)
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Number of entries kept in memory.
+PERMISSION_CACHE_SIZE = int(os.getenv('PERMISSION_CACHE_SIZE', '10000'))
+# Seconds a granted permission is served from the cache.
+PERMISSION_CACHE_TTL = float(os.getenv('PERMISSION_CACHE_TTL', '600'))
+# Seconds a 'no access' answer from GitHub is served from the cache.
+PERMISSION_CACHE_NEGATIVE_TTL = float(os.getenv('PERMISSION_CACHE_NEGATIVE_TTL', '60'))
+# Seconds after expiry during which an entry is still served while it is refreshed in the background.
+PERMISSION_CACHE_STALE_TTL = float(os.getenv('PERMISSION_CACHE_STALE_TTL', '300'))
+# Optional SQLite file shared by the worker processes, e.g. on the taxonomies volume.
+PERMISSION_CACHE_DB = os.getenv('PERMISSION_CACHE_DB')
+
+POSITIVE = 'positive'
+NEGATIVE = 'negative'
+
+
+class PermissionCache:
+    """
+    Thread-safe cache in front of a loader function.
+
+    Results are classified by the classify function as POSITIVE, NEGATIVE or None (e.g. transient errors), which are
+    cached with the positive TTL, the negative TTL or not at all. Expired entries are served for another stale_ttl
+    seconds while they are refreshed in the background, and concurrent misses for the same key share a single load.
+    """
+
+    def __init__(self, loader, classify, maxsize=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL,
+                 negative_ttl=PERMISSION_CACHE_NEGATIVE_TTL, stale_ttl=PERMISSION_CACHE_STALE_TTL,
+                 db_path=PERMISSION_CACHE_DB, encode=json.dumps, decode=json.loads):
+        self.loader = loader
+        self.classify = classify
+        self.maxsize = maxsize
+        self.ttls = {POSITIVE: ttl, NEGATIVE: negative_ttl}
+        self.stale_ttl = stale_ttl
+        self.backend_encode = encode
+        self.backend_decode = decode
+        self.entries = OrderedDict()
+        self.loading = dict()
+        self.lock = threading.Lock()
+        self.backend = SqliteCacheBackend(db_path, maxsize, encode, decode, stale_ttl) if db_path else None
+        self._executor = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.errors = 0
+
+    def get(self, *key):
+        """
+        Returns the cached value of the key, loading it if it is missing or expired.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None and self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self._store(key, entry, shared=False)
+
+        if entry is not None:
+            value, expires = entry
+            if now < expires:
+                self._count('hits')
+                return value
+            if now < expires + self.stale_ttl:
+                self._count('stale_hits')
+                self._refresh(key)
+                return value
+        self._count('misses')
+        return self._load(key).result()
+
+    def get_cached(self, *key):
+        """
+        Returns the cached value of the key without loading it, None if it is missing or expired. Stale values are
+        returned and refreshed in the background, like in get.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None and self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self._store(key, entry, shared=False)
+        if entry is None:
+            return None
+        value, expires = entry
+        if now < expires:
+            self._count('hits')
+            return value
+        if now < expires + self.stale_ttl:
+            self._count('stale_hits')
+            self._refresh(key)
+            return value
+        return None
+
+    def put(self, key, value):
+        """
+        Caches a value obtained without the loader, e.g. derived from another lookup.
+        :return: the value
+        """
+        kind = self.classify(value)
+        if kind is not None:
+            self._store(tuple(key), (value, time.time() + self.ttls[kind]))
+        return value
+
+    def invalidate(self, *key):
+        with self.lock:
+            if key:
+                self.entries.pop(key, None)
+            else:
+                self.entries.clear()
+        if self.backend is not None:
+            self.backend.delete(key or None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "loads": self.loads,
+                "errors": self.errors,
+            }
+
+    def shutdown(self):
+        with self.lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _load(self, key):
+        """
+        Loads the key unless a load is already in progress, in which case the caller waits for that one.
+        """
+        with self.lock:
+            future = self.loading.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self.loading[key] = future
+            self.loads += 1
+        try:
+            value = self.loader(*key)
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+                self.loading.pop(key, None)
+            future.set_exception(e)
+            return future
+
+        kind = self.classify(value)
+        if kind is None:
+            with self.lock:
+                self.errors += 1
+        else:
+            self._store(key, (value, time.time() + self.ttls[kind]))
+        with self.lock:
+            self.loading.pop(key, None)
+        future.set_result(value)
+        return future
+
+    def _refresh(self, key):
+        with self.lock:
+            if key in self.loading:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="permission-refresh")
+            executor = self._executor
+        executor.submit(self._load, key)
+
+    def _store(self, key, entry, shared=True):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        if shared and self.backend is not None:
+            self.backend.put(key, entry)
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+class SqliteCacheBackend:
+    """
+    Cache entries stored in a SQLite file so that several processes can share them.
+    """
+
+    def __init__(self, db_path, maxsize, encode=json.dumps, decode=json.loads, stale_ttl=PERMISSION_CACHE_STALE_TTL):
+        self.db_path = db_path
+        self.maxsize = maxsize
+        self.encode = encode
+        self.decode = decode
+        self.stale_ttl = stale_ttl
+        self.local = threading.local()
+        self.writes = 0
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS permission_cache "
+                               "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def get(self, key):
+        try:
+            row = self._connection().execute("SELECT value, expires FROM permission_cache WHERE key = ?",
+                                             (json.dumps(key),)).fetchone()
+        except sqlite3.Error as e:
+            log.warning(f"Shared permission cache is unavailable: {e}")
+            return None
+        if row is None:
+            return None
+        return self.decode(row[0]), row[1]
+
+    def put(self, key, entry):
+        value, expires = entry
+        try:
+            with self._connection() as connection:
+                connection.execute("INSERT OR REPLACE INTO permission_cache (key, value, expires) VALUES (?, ?, ?)",
+                                   (json.dumps(key), self.encode(value), expires))
+                self.writes += 1
+                if self.writes % 100 == 0:
+                    self._prune(connection)
+        except sqlite3.Error as e:
+            log.warning(f"Shared permission cache is unavailable: {e}")
+
+    def delete(self, key=None):
+        try:
+            with self._connection() as connection:
+                if key is None:
+                    connection.execute("DELETE FROM permission_cache")
+                else:
+                    connection.execute("DELETE FROM permission_cache WHERE key = ?", (json.dumps(key),))
+        except sqlite3.Error as e:
+            log.warning(f"Shared permission cache is unavailable: {e}")
+
+    def _prune(self, connection):
+        connection.execute("DELETE FROM permission_cache WHERE expires < ?", (time.time() - self.stale_ttl,))
+        connection.execute("DELETE FROM permission_cache WHERE key NOT IN "
+                           "(SELECT key FROM permission_cache ORDER BY expires DESC LIMIT ?)", (self.maxsize,))
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
@@ -0,0 +1,187 @@
+import os
+import logging
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+log = logging.getLogger(__name__)
+
+# Total size of the cached response bodies. 0 disables the cache.
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Responses larger than this are streamed to the client without being cached.
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(4 * 1024 * 1024)))
+
+RLTBL_DB = '.relatable/relatable.db'
+
+CachedResponse = namedtuple('CachedResponse', ['status', 'headers', 'body'])
+
+
+def db_version(taxonomy_dir):
+    """
+    Returns a token that changes whenever the relatable database of the taxonomy is modified.
+    :param taxonomy_dir: taxonomy folder
+    :return: version token or None if the taxonomy has no database yet
+    """
+    db_path = os.path.join(taxonomy_dir, RLTBL_DB)
+    parts = []
+    for path in (db_path, db_path + '-wal'):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if path == db_path:
+                return None
+            continue
+        parts.append(f"{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}")
+    return ':'.join(parts)
+
+
+def make_key(taxonomy, path, query_string, readonly, user, version):
+    return taxonomy, path, query_string, readonly, user, version
+
+
+def make_etag(key):
+    """
+    Returns the entity tag of the response identified by the given cache key.
+    """
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of complete responses, bounded by the total size of the cached bodies.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generations = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def generation(self, taxonomy):
+        with self.lock:
+            return self.generations.get(taxonomy, 0)
+
+    def put(self, key, entry, generation=None):
+        """
+        Caches the response, unless it is too large or the taxonomy was invalidated after the given generation.
+        """
+        if len(entry.body) > self.max_entry_bytes:
+            return
+        taxonomy = key[0]
+        with self.lock:
+            if generation is not None and generation != self.generations.get(taxonomy, 0):
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.evictions += 1
+
+    def invalidate(self, taxonomy):
+        """
+        Drops the cached responses of the taxonomy and ignores responses of requests that started before.
+        """
+        with self.lock:
+            self.generations[taxonomy] = self.generations.get(taxonomy, 0) + 1
+            for key in [key for key in self.entries if key[0] == taxonomy]:
+                self.size -= len(self.entries.pop(key).body)
+        log.debug(f"Response cache invalidated for {taxonomy}")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def caching_body(self, key, status, headers, chunks, generation=None):
+        """
+        Relays the body chunks and caches the complete response once it has been fully streamed, see CachingBody.
+        :return: iterable of body chunks
+        """
+        return CachingBody(self, key, status, headers, chunks, generation)
+
+
+class CachingBody:
+    """
+    Response body relaying the chunks of another body, which caches the complete response once it has been fully
+    streamed. Chunks are only retained until the body exceeds the maximum entry size. Bodies whose iteration failed, or
+    whose close() returned a non-zero status, are not cached. close() closes the relayed body even if it was never
+    iterated, e.g. for a HEAD request.
+    """
+
+    def __init__(self, cache, key, status, headers, chunks, generation=None):
+        self.cache = cache
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.chunks = chunks
+        self.generation = generation
+        self.iterator = None
+        self.parts = []
+        self.size = 0
+        self.completed = False
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        if self.iterator is None:
+            self.iterator = iter(self.chunks)
+        try:
+            chunk = next(self.iterator)
+        except StopIteration:
+            self.completed = True
+            self.close()
+            raise
+        except BaseException:
+            self.close()
+            raise
+        if self.parts is not None:
+            self.size += len(chunk)
+            if self.size > self.cache.max_entry_bytes:
+                self.parts = None
+            else:
+                self.parts.append(chunk)
+        return chunk
+
+    def close(self):
+        """
+        Closes the relayed body and caches the response if it was complete.
+        :return: status returned by the close() of the relayed body
+        """
+        if self.closed:
+            return None
+        self.closed = True
+        close = getattr(self.chunks, 'close', None)
+        returncode = close() if close is not None else None
+        if self.completed and not returncode and self.parts is not None:
+            self.cache.put(self.key, CachedResponse(self.status, self.headers, b''.join(self.parts)), self.generation)
+        return returncode
+
+
+browser_cache = ResponseCache()
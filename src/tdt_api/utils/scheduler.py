@@ -0,0 +1,292 @@
+import os
+import math
+import time
+import fcntl
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from tdt_api.utils import metrics
+
+log = logging.getLogger(__name__)
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+# Concurrent read-only rltbl calls per taxonomy.
+RLTBL_MAX_READERS = int(os.getenv('RLTBL_MAX_READERS', '4'))
+# Requests that may wait for a taxonomy before new ones are rejected with 503.
+RLTBL_MAX_QUEUE = int(os.getenv('RLTBL_MAX_QUEUE', '32'))
+# Seconds a request waits for its turn before it is rejected with 503.
+RLTBL_QUEUE_TIMEOUT = float(os.getenv('RLTBL_QUEUE_TIMEOUT', '30'))
+
+LOCKS_FOLDER = '.locks'
+# Retry-After (seconds) of the edits rejected while the taxonomy is rebuilt.
+REBUILD_RETRY_AFTER = 60
+# Upper bounds (seconds) of the queue wait time histogram buckets.
+WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+queue_wait = metrics.histogram('tdt_rltbl_queue_wait_seconds', 'Time the rltbl calls waited for their turn.',
+                               ('taxonomy',), buckets=WAIT_BUCKETS)
+
+
+class Saturated(Exception):
+    """
+    The taxonomy has too many queued requests, or the request waited too long for its turn.
+    """
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class Slot:
+    """
+    Admission of a request to a taxonomy, held until the response was streamed. Release is idempotent.
+    """
+
+    def __init__(self, scheduler, write, wait, lock_file=None):
+        self.scheduler = scheduler
+        self.write = write
+        self.wait = wait
+        self.lock_file = lock_file
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        with self.scheduler.condition:
+            if self.released:
+                return
+            self.released = True
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+        self.scheduler._release(self)
+
+
+class TaxonomyScheduler:
+    """
+    Admission control of the rltbl calls of a taxonomy. Readers run concurrently up to max_readers, writers run alone.
+    Requests are admitted in strict arrival order, so a waiting writer is not starved by a stream of readers and the
+    readers queued behind it run once it is done. Writers also hold an flock() on the taxonomy's write lock file so
+    that they are serialized across the worker processes of the server, and are rejected while a build holds the
+    taxonomy's build lock file (see suspend_writes).
+    """
+
+    def __init__(self, name, max_readers=RLTBL_MAX_READERS, max_queue=RLTBL_MAX_QUEUE,
+                 queue_timeout=RLTBL_QUEUE_TIMEOUT, lock_dir=None):
+        self.name = name
+        self.max_readers = max_readers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.lock_dir = lock_dir
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.tickets = itertools.count()
+        self.readers = 0
+        self.writing = False
+        # average seconds a slot is held, used to estimate Retry-After
+        self.hold_time = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def acquire(self, write=False, timeout=None):
+        """
+        Waits until the request may run.
+        :param write: True for requests modifying the taxonomy
+        :param timeout: seconds to wait, queue_timeout by default
+        :return: Slot to release once the response is complete
+        :raises Saturated: if the queue is full or the timeout expired
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        if write:
+            self._check_building()
+        with self.condition:
+            if len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                raise Saturated(f"Too many requests queued for {self.name}.", self._retry_after())
+            ticket = next(self.tickets)
+            self.queue.append(ticket)
+            try:
+                while not (self.queue[0] == ticket and self._can_run(write)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise Saturated(f"Timed out waiting for {self.name}.", self._retry_after())
+                    self.condition.wait(remaining)
+            finally:
+                if self.queue[0] == ticket:
+                    self.queue.popleft()
+                else:
+                    self.queue.remove(ticket)
+                # the next request in line may be able to run as well
+                self.condition.notify_all()
+            if write:
+                self.writing = True
+            else:
+                self.readers += 1
+
+        lock_file = None
+        if write and self.lock_dir:
+            try:
+                lock_file = self._lock_file(deadline)
+            except BaseException:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+                raise
+        wait = time.monotonic() - start
+        self._record_wait(wait)
+        return Slot(self, write, wait, lock_file)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "readers": self.readers,
+                "writing": self.writing,
+                "queued": len(self.queue),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_total,
+                "wait_seconds_max": self.wait_max,
+                "wait_seconds_buckets": dict(zip([str(bound) for bound in WAIT_BUCKETS] + ["+Inf"],
+                                                 itertools.accumulate(self.wait_buckets))),
+            }
+
+    def _can_run(self, write):
+        if write:
+            return not self.writing and self.readers == 0
+        return not self.writing and self.readers < self.max_readers
+
+    def _release(self, slot):
+        held = time.monotonic() - slot.started
+        with self.condition:
+            if slot.write:
+                self.writing = False
+            else:
+                self.readers -= 1
+            self.hold_time = 0.8 * self.hold_time + 0.2 * held
+            self.condition.notify_all()
+
+    def _retry_after(self):
+        """
+        Estimates the seconds until the queue drained from the number of queued requests and the average hold time.
+        """
+        estimate = self.hold_time * (len(self.queue) + 1) / max(self.max_readers, 1)
+        return min(max(math.ceil(estimate), 1), 60)
+
+    def _record_wait(self, wait):
+        with self.condition:
+            self.admitted += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if wait <= bound:
+                    self.wait_buckets[i] += 1
+                    break
+            else:
+                self.wait_buckets[-1] += 1
+        if metrics.METRICS_ENABLED:
+            queue_wait.observe(wait, taxonomy=self.name)
+
+    def _check_building(self):
+        if self.lock_dir and is_building(self.name, self.lock_dir):
+            with self.condition:
+                self.rejected += 1
+            raise Saturated(f"{self.name} is being rebuilt, edits are suspended.", REBUILD_RETRY_AFTER)
+
+    def _lock_file(self, deadline):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        lock_file = open(lock_path(self.lock_dir, self.name, 'write'), 'w')
+        delay = 0.005
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                try:
+                    # a build started while the request was waiting holds the lock until its snapshot is activated
+                    self._check_building()
+                except Saturated:
+                    lock_file.close()
+                    raise
+                if time.monotonic() >= deadline:
+                    lock_file.close()
+                    with self.condition:
+                        self.timeouts += 1
+                    raise Saturated(f"Timed out waiting for {self.name}.", self._retry_after())
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+
+def lock_path(lock_dir, name, kind):
+    return os.path.join(lock_dir, name.replace('/', '_') + f'.{kind}.lock')
+
+
+def is_building(name, lock_dir):
+    """
+    Returns whether a build of the taxonomy holds its build lock, in any worker process.
+    """
+    try:
+        with open(lock_path(lock_dir, name, 'build'), 'rb') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        pass
+    return False
+
+
+@contextmanager
+def suspend_writes(name, lock_dir):
+    """
+    Holds the write lock of the taxonomy, e.g. while a new snapshot is built from the current one, so that no edit goes
+    into a snapshot that is about to be retired. Waits for the running edit to complete, and the edits arriving in the
+    meantime are rejected with 503 in every worker process. Reads are not affected.
+    :param name: taxonomy name
+    :param lock_dir: lock folder in the taxonomies volume
+    """
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(lock_path(lock_dir, name, 'build'), 'w') as build_lock, \
+            open(lock_path(lock_dir, name, 'write'), 'w') as write_lock:
+        fcntl.flock(build_lock, fcntl.LOCK_EX)
+        try:
+            fcntl.flock(write_lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(write_lock, fcntl.LOCK_UN)
+        finally:
+            fcntl.flock(build_lock, fcntl.LOCK_UN)
+
+
+_schedulers = dict()
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(taxonomy):
+    with _schedulers_lock:
+        scheduler = _schedulers.get(taxonomy)
+        if scheduler is None:
+            lock_dir = os.path.join(TAXONOMIES_VOLUME, LOCKS_FOLDER) if TAXONOMIES_VOLUME else None
+            scheduler = TaxonomyScheduler(taxonomy, lock_dir=lock_dir)
+            _schedulers[taxonomy] = scheduler
+        return scheduler
+
+
+def stats():
+    """
+    Returns the admission statistics of all taxonomies.
+    """
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {name: scheduler.stats() for name, scheduler in schedulers.items()}
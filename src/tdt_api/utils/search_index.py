@@ -0,0 +1,312 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from tdt_api.utils.response_cache import db_version
+
+log = logging.getLogger(__name__)
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+# SQLite file of the cross-taxonomy search index, shared by the server worker processes.
+SEARCH_INDEX_DB = os.getenv('SEARCH_INDEX_DB',
+                            os.path.join(TAXONOMIES_VOLUME, '.search', 'search.db') if TAXONOMIES_VOLUME else '')
+# Column identifying a cell set. Every table of the relatable database that has it is indexed.
+SEARCH_ID_COLUMN = os.getenv('SEARCH_ID_COLUMN', 'cell_set_accession')
+# Column holding the main label of a cell set.
+SEARCH_LABEL_COLUMN = os.getenv('SEARCH_LABEL_COLUMN', 'cell_label')
+# Other columns searched as free text (full names, synonyms, ...).
+SEARCH_TEXT_COLUMNS = [column.strip() for column in
+                       os.getenv('SEARCH_TEXT_COLUMNS', 'cell_fullname,synonyms').split(',')]
+# Column holding the rank (labelset) of a cell set, used by the rank filter.
+SEARCH_RANK_COLUMN = os.getenv('SEARCH_RANK_COLUMN', 'labelset')
+SEARCH_DEFAULT_LIMIT = int(os.getenv('SEARCH_DEFAULT_LIMIT', '10'))
+SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_LIMIT', '100'))
+
+RLTBL_DB = '.relatable/relatable.db'
+# Maximum number of variables of a single SQLite statement.
+MAX_VARIABLES = 500
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS sources (taxonomy TEXT PRIMARY KEY, version TEXT NOT NULL, indexed REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS cells (id INTEGER PRIMARY KEY, taxonomy TEXT NOT NULL, source_table TEXT NOT NULL, "
+    "accession TEXT NOT NULL, label TEXT, rank TEXT, species TEXT, data TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS cells_accession ON cells (accession)",
+    "CREATE INDEX IF NOT EXISTS cells_taxonomy ON cells (taxonomy)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS cells_fts USING fts5(accession, label, text, "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+)
+
+
+def match_expression(query):
+    """
+    Converts a user query to an FTS5 expression matching all of its words, the last one as a prefix.
+    :param query: free text query
+    :return: FTS5 match expression, None if the query has no searchable word
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words[:-1]]
+    terms.append(f'"{words[-1]}"*')
+    return ' '.join(terms)
+
+
+class SearchIndex:
+    """
+    Full text index of the cell sets of all taxonomies, built from their relatable databases into a single SQLite FTS5
+    database. A taxonomy is re-indexed only when its relatable database changed since it was last indexed.
+    """
+
+    def __init__(self, db_path=SEARCH_INDEX_DB, taxonomies_volume=TAXONOMIES_VOLUME):
+        self.db_path = db_path
+        self.taxonomies_volume = taxonomies_volume
+        self.local = threading.local()
+        # connections of all the threads, with the process that opened them, closed together by close()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.sync_thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.db_path and self.taxonomies_volume)
+
+    def update(self, taxonomy, species=None):
+        """
+        Re-indexes the taxonomy if its relatable database changed, or drops it from the index if it has no database.
+        :param taxonomy: taxonomy name
+        :param species: species of the taxonomy, stored with its cell sets for filtering
+        :return: True if the index was modified
+        """
+        if not self.enabled:
+            return False
+        taxonomy_dir = os.path.join(self.taxonomies_volume, taxonomy)
+        version = db_version(taxonomy_dir)
+        if version is None:
+            return self.remove(taxonomy)
+
+        connection = self._connection()
+        row = connection.execute("SELECT version FROM sources WHERE taxonomy = ?", (taxonomy,)).fetchone()
+        if row is not None and row[0] == version:
+            return False
+        start = time.time()
+        try:
+            rows = list(self._read_cells(os.path.join(taxonomy_dir, RLTBL_DB)))
+        except sqlite3.Error as e:
+            log.warning(f"Could not index taxonomy {taxonomy}: {e}")
+            return False
+
+        # BEGIN IMMEDIATE serializes the writers of the worker processes, the version is checked again once we hold it
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT version FROM sources WHERE taxonomy = ?", (taxonomy,)).fetchone()
+            if row is not None and row[0] == version:
+                connection.execute("ROLLBACK")
+                return False
+            self._delete(connection, taxonomy)
+            for source_table, accession, label, rank, text, data in rows:
+                cursor = connection.execute(
+                    "INSERT INTO cells (taxonomy, source_table, accession, label, rank, species, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (taxonomy, source_table, accession, label, rank, species, data))
+                connection.execute("INSERT INTO cells_fts (rowid, accession, label, text) VALUES (?, ?, ?, ?)",
+                                   (cursor.lastrowid, accession, label, text))
+            connection.execute("INSERT OR REPLACE INTO sources (taxonomy, version, indexed) VALUES (?, ?, ?)",
+                               (taxonomy, version, time.time()))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        log.info(f"Indexed {len(rows)} cell sets of {taxonomy} in {time.time() - start:.2f}s.")
+        return True
+
+    def remove(self, taxonomy):
+        if not self.enabled:
+            return False
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = self._delete(connection, taxonomy)
+            connection.execute("DELETE FROM sources WHERE taxonomy = ?", (taxonomy,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return deleted > 0
+
+    def sync(self, taxonomies):
+        """
+        Brings the index up to date with the given taxonomies and drops the taxonomies that no longer exist.
+        :param taxonomies: dict of taxonomy name to species
+        """
+        if not self.enabled:
+            return
+        indexed = [row[0] for row in self._connection().execute("SELECT taxonomy FROM sources")]
+        for taxonomy in indexed:
+            if taxonomy not in taxonomies:
+                self.remove(taxonomy)
+        for taxonomy, species in taxonomies.items():
+            try:
+                self.update(taxonomy, species)
+            except sqlite3.Error as e:
+                log.error(f"Could not index taxonomy {taxonomy}: {e}")
+
+    def start_sync(self, taxonomies):
+        """
+        Runs sync in a background thread, so that the first indexing of large taxonomies doesn't delay the startup.
+        """
+        if not self.enabled or (self.sync_thread is not None and self.sync_thread.is_alive()):
+            return
+        self.sync_thread = threading.Thread(target=self.sync, args=(taxonomies,), name="search-index", daemon=True)
+        self.sync_thread.start()
+
+    def on_taxonomy_changed(self, taxonomy, metadata):
+        """
+        Taxonomy index listener keeping the search index in sync with the taxonomies.
+        """
+        try:
+            if metadata is None:
+                self.remove(taxonomy)
+            else:
+                self.update(taxonomy, metadata.get("species"))
+        except sqlite3.Error as e:
+            log.error(f"Could not index taxonomy {taxonomy}: {e}")
+
+    def search(self, queries, taxonomy=None, species=None, rank=None, limit=SEARCH_DEFAULT_LIMIT):
+        """
+        Searches the labels, synonyms and identifiers of the cell sets of all taxonomies.
+        :param queries: list of free text queries, answered in a single round trip
+        :param taxonomy: only search this taxonomy
+        :param species: only search taxonomies of this species
+        :param rank: only return cell sets of this rank
+        :param limit: maximum number of matches per query
+        :return: dict of query to the list of its matches, best match first
+        """
+        filters, params = [], []
+        for column, value in (("taxonomy", taxonomy), ("species", species), ("rank", rank)):
+            if value:
+                filters.append(f"cells.{column} = ? COLLATE NOCASE")
+                params.append(value)
+        sql = ("SELECT cells.taxonomy, cells.accession, cells.label, cells.rank, cells.species, cells.data "
+               "FROM cells_fts JOIN cells ON cells.id = cells_fts.rowid WHERE cells_fts MATCH ? "
+               + ''.join(f"AND {condition} " for condition in filters)
+               + "ORDER BY (cells.label = ? COLLATE NOCASE) DESC, bm25(cells_fts, 10.0, 5.0, 1.0) LIMIT ?")
+
+        results = dict()
+        if not self.enabled:
+            return {query: [] for query in queries}
+        connection = self._connection()
+        for query in queries:
+            expression = match_expression(query)
+            if expression is None:
+                results[query] = []
+                continue
+            rows = connection.execute(sql, [expression] + params + [query.strip(), limit]).fetchall()
+            results[query] = [self._match(row) for row in rows]
+        return results
+
+    def get(self, identifiers):
+        """
+        Looks up cell sets by identifier in all taxonomies.
+        :param identifiers: list of cell set accession ids, answered in a single round trip
+        :return: dict of identifier to the list of cell sets having it
+        """
+        results = {identifier: [] for identifier in identifiers}
+        if not self.enabled:
+            return results
+        connection = self._connection()
+        unique = list(results)
+        for i in range(0, len(unique), MAX_VARIABLES):
+            chunk = unique[i:i + MAX_VARIABLES]
+            rows = connection.execute(
+                "SELECT taxonomy, accession, label, rank, species, data FROM cells WHERE accession IN "
+                f"({','.join('?' * len(chunk))}) ORDER BY taxonomy", chunk).fetchall()
+            for row in rows:
+                results[row[1]].append(self._match(row))
+        return results
+
+    def stats(self):
+        if not self.enabled:
+            return {"taxonomies": 0, "cell_sets": 0}
+        connection = self._connection()
+        return {
+            "taxonomies": connection.execute("SELECT count(*) FROM sources").fetchone()[0],
+            "cell_sets": connection.execute("SELECT count(*) FROM cells").fetchone()[0],
+        }
+
+    def close(self):
+        """
+        Closes the connections opened by all the threads of this process. The threads open a new one on their next
+        call. The connections inherited from a parent process are left to it.
+        """
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+            self.local = threading.local()
+        for pid, connection in connections:
+            if pid == os.getpid():
+                connection.close()
+
+    @staticmethod
+    def _match(row):
+        taxonomy, accession, label, rank, species, data = row
+        return {
+            "taxonomy": taxonomy,
+            "identifier": accession,
+            "label": label,
+            "rank": rank,
+            "species": species,
+            "record": json.loads(data),
+        }
+
+    @staticmethod
+    def _delete(connection, taxonomy):
+        connection.execute("DELETE FROM cells_fts WHERE rowid IN (SELECT id FROM cells WHERE taxonomy = ?)",
+                           (taxonomy,))
+        return connection.execute("DELETE FROM cells WHERE taxonomy = ?", (taxonomy,)).rowcount
+
+    @staticmethod
+    def _read_cells(db_path):
+        """
+        Reads the cell sets of all tables of the relatable database that have the identifier column.
+        """
+        source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+        try:
+            tables = [row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+                      if not row[0].startswith(('sqlite_', '_'))]
+            for table in tables:
+                columns = [row[1] for row in source.execute(f'PRAGMA table_info("{table}")')]
+                if SEARCH_ID_COLUMN not in columns:
+                    continue
+                text_columns = [column for column in SEARCH_TEXT_COLUMNS if column in columns]
+                cursor = source.execute(f'SELECT * FROM "{table}"')
+                names = [description[0] for description in cursor.description]
+                for values in cursor:
+                    record = {name: value for name, value in zip(names, values) if not name.startswith('_')}
+                    accession = record.get(SEARCH_ID_COLUMN)
+                    if not accession:
+                        continue
+                    text = ' '.join(str(record[column]) for column in text_columns if record.get(column))
+                    label = record.get(SEARCH_LABEL_COLUMN)
+                    yield (table, str(accession), label, record.get(SEARCH_RANK_COLUMN), text,
+                           json.dumps(record, default=str))
+        finally:
+            source.close()
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or getattr(self.local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            with self.connections_lock:
+                self.connections.append((os.getpid(), connection))
+                self.local.connection = connection
+                self.local.pid = os.getpid()
+        return connection
+
+
+search_index = SearchIndex()
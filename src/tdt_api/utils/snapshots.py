@@ -0,0 +1,275 @@
+import os
+import time
+import shlex
+import fcntl
+import shutil
+import sqlite3
+import logging
+import threading
+
+from tdt_api.utils import command_line_utils
+from tdt_api.utils.scheduler import suspend_writes, LOCKS_FOLDER
+
+log = logging.getLogger(__name__)
+
+# Folder under the taxonomies volume holding the snapshots of the taxonomies. TAXONOMIES_VOLUME/<taxonomy> is a
+# symlink to the current snapshot, .snapshots/<taxonomy>/<snapshot id>.
+SNAPSHOTS_FOLDER = '.snapshots'
+LEASE_SUFFIX = '.lease'
+DELETING_SUFFIX = '.deleting'
+# id of the snapshot a taxonomy folder created before the snapshots is moved to
+LEGACY_ID = 'legacy'
+ACQUIRE_ATTEMPTS = 5
+RLTBL_DB = '.relatable/relatable.db'
+SQLITE_SUFFIXES = ('', '-wal', '-shm', '-journal')
+
+
+class Lease:
+    """
+    Shared flock() on the lease file of a snapshot, held while a request or a build uses the snapshot. Snapshots are
+    only removed by collect() once no process holds a lease on them.
+    """
+
+    def __init__(self, taxonomy_dir, path, fd=None):
+        self.taxonomy_dir = taxonomy_dir
+        self.path = path
+        self.fd = fd
+
+    def release(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        if resolve(self.taxonomy_dir) != self.path:
+            # the last user of a retired snapshot removes it
+            threading.Thread(target=collect, args=(self.taxonomy_dir,), name="snapshot-gc", daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def snapshots_folder(taxonomy_dir):
+    taxonomy_dir = os.path.abspath(taxonomy_dir)
+    # resolved like the snapshot paths returned by resolve()
+    volume = os.path.realpath(os.path.dirname(taxonomy_dir))
+    return os.path.join(volume, SNAPSHOTS_FOLDER, os.path.basename(taxonomy_dir))
+
+
+def taxonomy_name(path):
+    """
+    Returns the name of the taxonomy of a taxonomy folder or of one of its snapshots.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if os.path.basename(os.path.dirname(parent)) == SNAPSHOTS_FOLDER:
+        return os.path.basename(parent)
+    return os.path.basename(path)
+
+
+def resolve(taxonomy_dir):
+    """
+    Returns the folder of the current snapshot of the taxonomy, or taxonomy_dir itself if it is not a snapshot.
+    """
+    return os.path.realpath(taxonomy_dir)
+
+
+def acquire(taxonomy_dir):
+    """
+    Resolves the current snapshot of the taxonomy and takes a lease on it, so that it is kept until the lease is
+    released even if a new snapshot is activated in the meantime.
+    :param taxonomy_dir: folder of the taxonomy in the volume
+    :return: Lease, whose path is the folder to serve the request from
+    """
+    folder = snapshots_folder(taxonomy_dir)
+    path = taxonomy_dir
+    for _ in range(ACQUIRE_ATTEMPTS):
+        path = resolve(taxonomy_dir)
+        if not os.path.isdir(path):
+            break
+        legacy = not os.path.islink(taxonomy_dir)
+        lease_path = os.path.join(folder, LEGACY_ID + LEASE_SUFFIX) if legacy else path + LEASE_SUFFIX
+        if legacy:
+            os.makedirs(folder, exist_ok=True)
+        try:
+            fd = os.open(lease_path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            continue
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # the snapshot may have been collected, or the legacy folder moved, before the lease was taken
+        if os.path.isdir(path) and legacy == (not os.path.islink(taxonomy_dir)):
+            return Lease(taxonomy_dir, path, fd)
+        os.close(fd)
+    return Lease(taxonomy_dir, path)
+
+
+def create(taxonomy_dir):
+    """
+    Reserves a new snapshot of the taxonomy. Its folder is not created, the lease protects it from collect() while
+    it is built.
+    :return: Lease of the new snapshot
+    """
+    folder = snapshots_folder(taxonomy_dir)
+    os.makedirs(folder, exist_ok=True)
+    snapshot_id = time.strftime('%Y%m%d%H%M%S') + '-' + os.urandom(3).hex()
+    path = os.path.join(folder, snapshot_id)
+    fd = os.open(path + LEASE_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    return Lease(taxonomy_dir, path, fd)
+
+
+def copy_folder(source, target):
+    """
+    Copies a taxonomy folder into a new snapshot. Files are copied on write where the file system supports it, git
+    objects, which are never modified, are hard linked, and the relatable database is copied with the SQLite backup API.
+    :param source: folder to copy
+    :param target: folder to create
+    """
+    os.makedirs(target)
+    taxonomy = taxonomy_name(target)
+    git_dir = os.path.join(source, '.git')
+    database = os.path.join(source, RLTBL_DB)
+    db_folder = os.path.dirname(RLTBL_DB)
+    excluded = set()
+    if os.path.isdir(os.path.join(git_dir, 'objects')):
+        excluded.add('.git')
+    if os.path.isfile(database):
+        excluded.add(db_folder)
+    _copy_entries(source, target, taxonomy, excluded)
+    if '.git' in excluded:
+        os.makedirs(os.path.join(target, '.git'))
+        command_line_utils.runcmd(shlex.join(['cp', '-al', os.path.join(git_dir, 'objects'),
+                                              os.path.join(target, '.git') + '/']), taxonomy=taxonomy)
+        _copy_entries(git_dir, os.path.join(target, '.git'), taxonomy, {'objects'})
+    if db_folder in excluded:
+        os.makedirs(os.path.join(target, db_folder))
+        _copy_entries(os.path.dirname(database), os.path.join(target, db_folder), taxonomy,
+                      {os.path.basename(database) + suffix for suffix in SQLITE_SUFFIXES})
+        copy_database(database, os.path.join(target, RLTBL_DB))
+
+
+def _copy_entries(source, target, taxonomy, excluded=()):
+    entries = [os.path.join(source, name) for name in os.listdir(source) if name not in excluded]
+    if entries:
+        # the names come from the taxonomy repository, they are quoted for the shell
+        command_line_utils.runcmd(shlex.join(['cp', '-a', '--reflink=auto', *entries, target + '/']), taxonomy=taxonomy)
+
+
+def copy_database(source, target):
+    """
+    Copies a SQLite database with the backup API, which reads a consistent state including the transactions that are
+    still in the WAL, where copying the files could race with a checkpoint.
+    :param source: database to copy
+    :param target: database file to create
+    """
+    source_connection = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    target_connection = sqlite3.connect(target)
+    try:
+        source_connection.backup(target_connection)
+        journal_mode = source_connection.execute("PRAGMA journal_mode").fetchone()[0]
+        target_connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+    finally:
+        target_connection.close()
+        source_connection.close()
+
+
+def activate(taxonomy_dir, path):
+    """
+    Makes the snapshot the current one by atomically replacing the taxonomy symlink. A taxonomy folder that is not a
+    snapshot yet is first moved to the legacy snapshot.
+    :param taxonomy_dir: folder of the taxonomy in the volume
+    :param path: folder of the snapshot
+    """
+    taxonomy_dir = os.path.abspath(taxonomy_dir)
+    if os.path.isdir(taxonomy_dir) and not os.path.islink(taxonomy_dir):
+        legacy_dir = os.path.join(snapshots_folder(taxonomy_dir), LEGACY_ID)
+        os.makedirs(os.path.dirname(legacy_dir), exist_ok=True)
+        if os.path.lexists(legacy_dir):
+            raise FileExistsError(f"Legacy snapshot {legacy_dir} already exists.")
+        os.rename(taxonomy_dir, legacy_dir)
+        log.info(f"Moved taxonomy folder {taxonomy_dir} to {legacy_dir}.")
+    volume = os.path.dirname(taxonomy_dir)
+    switch = os.path.join(volume, f".{os.path.basename(taxonomy_dir)}.switch")
+    if os.path.lexists(switch):
+        os.unlink(switch)
+    # relative, so that the volume can be mounted anywhere
+    os.symlink(os.path.relpath(path, volume), switch)
+    os.replace(switch, taxonomy_dir)
+    log.info(f"Taxonomy {taxonomy_dir} switched to snapshot {os.path.basename(path)}.")
+
+
+def build(taxonomy_dir, prepare, copy=True):
+    """
+    Prepares a new snapshot of the taxonomy and activates it once it is ready, the current snapshot serves the requests
+    in the meantime. Edits of the taxonomy are suspended until the new snapshot is activated, so that none is made in
+    the current snapshot after it was copied. Retired snapshots are collected.
+    :param taxonomy_dir: folder of the taxonomy in the volume
+    :param prepare: function called with the folder of the new snapshot
+    :param copy: start from a copy of the current snapshot, otherwise prepare creates the folder
+    :return: folder of the new snapshot
+    """
+    lock_dir = os.path.join(os.path.dirname(os.path.abspath(taxonomy_dir)), LOCKS_FOLDER)
+    lease = create(taxonomy_dir)
+    try:
+        with suspend_writes(taxonomy_name(taxonomy_dir), lock_dir):
+            if copy:
+                copy_folder(resolve(taxonomy_dir), lease.path)
+            prepare(lease.path)
+            activate(taxonomy_dir, lease.path)
+    except BaseException:
+        shutil.rmtree(lease.path, ignore_errors=True)
+        raise
+    finally:
+        lease.release()
+    collect(taxonomy_dir)
+    return lease.path
+
+
+def collect(taxonomy_dir):
+    """
+    Removes the snapshots of the taxonomy that are neither current nor leased, and the lease files left without a
+    snapshot.
+    :return: ids of the removed snapshots
+    """
+    folder = snapshots_folder(taxonomy_dir)
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    removed = []
+    for snapshot_id in sorted({name[:-len(LEASE_SUFFIX)] if name.endswith(LEASE_SUFFIX) else name for name in names}):
+        if snapshot_id.endswith(DELETING_SUFFIX):
+            # left over by an interrupted collection
+            shutil.rmtree(os.path.join(folder, snapshot_id), ignore_errors=True)
+        elif _remove(taxonomy_dir, os.path.join(folder, snapshot_id)):
+            removed.append(snapshot_id)
+    if removed:
+        log.info(f"Removed snapshots {', '.join(removed)} of taxonomy {os.path.basename(taxonomy_dir)}.")
+    return removed
+
+
+def _remove(taxonomy_dir, path):
+    try:
+        fd = os.open(path + LEASE_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        return False
+    trash = None
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        # checked under the lock: a new snapshot is activated before its builder releases its lease
+        if resolve(taxonomy_dir) == path:
+            return False
+        if os.path.lexists(path):
+            trash = path + DELETING_SUFFIX
+            os.rename(path, trash)
+        os.unlink(path + LEASE_SUFFIX)
+    finally:
+        os.close(fd)
+    if trash is None:
+        return False
+    shutil.rmtree(trash, ignore_errors=True)
+    return True
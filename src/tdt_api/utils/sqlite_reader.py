@@ -0,0 +1,225 @@
+import os
+import json
+import queue
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Read-only connections kept open per taxonomy database.
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '4'))
+# Seconds a query waits for a lock held by a writer (rltbl) before failing.
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+# Rows fetched from SQLite at once while streaming a page.
+FETCH_SIZE = 500
+
+
+class TableNotFound(Exception):
+    pass
+
+
+class ColumnNotFound(Exception):
+    pass
+
+
+class WithoutRowid(Exception):
+    """
+    The table was created WITHOUT ROWID, so its rows have no rowid to page on.
+    """
+    pass
+
+
+class ReadOnlyPool:
+    """
+    Bounded pool of read-only connections to a SQLite database. Connections are opened lazily with mode=ro and
+    query_only, so they never write to the database and read concurrently with rltbl in WAL mode.
+    """
+
+    def __init__(self, db_path, size=SQLITE_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        stat = os.stat(db_path)
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.schema = dict()
+
+    def acquire(self, timeout=SQLITE_BUSY_TIMEOUT):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except BaseException:
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            return self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No database connection available for {self.db_path}")
+
+    def release(self, connection):
+        if self.closed:
+            connection.close()
+        else:
+            self.idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def columns(self, connection, table):
+        """
+        Returns the columns of the table, raising TableNotFound if it is not a table of the database and WithoutRowid
+        if its rows cannot be paged in rowid order.
+        """
+        columns = self.schema.get(table)
+        if columns is None:
+            row = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                     (table,)).fetchone()
+            if row is None or table.startswith('sqlite_'):
+                raise TableNotFound(table)
+            try:
+                connection.execute(f'SELECT rowid FROM "{quote(table)}" LIMIT 0')
+            except sqlite3.OperationalError:
+                raise WithoutRowid(table)
+            columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{quote(table)}")')]
+            self.schema[table] = columns
+        return columns
+
+    def is_current(self):
+        """
+        Returns False once the database file was replaced, e.g. by a rebuild or a reload of the taxonomy.
+        """
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) == self.identity
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _connect(self):
+        connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=SQLITE_BUSY_TIMEOUT,
+                                     check_same_thread=False)
+        connection.execute("PRAGMA query_only = ON")
+        return connection
+
+
+def quote(identifier):
+    return identifier.replace('"', '""')
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(taxonomy, db_path):
+    """
+    Returns the connection pool of the taxonomy database, replacing it if the database file changed.
+    """
+    # the same pool whether the database is reached through the taxonomy symlink (warm-up) or its snapshot (requests)
+    db_path = os.path.realpath(db_path)
+    with _pools_lock:
+        pool = _pools.get(taxonomy)
+        if pool is not None and (pool.db_path != db_path or not pool.is_current()):
+            pool.close()
+            pool = None
+        if pool is None:
+            pool = ReadOnlyPool(db_path)
+            _pools[taxonomy] = pool
+        return pool
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+class Page:
+    """
+    A page of table rows read in rowid order after a cursor. The rows are streamed from the database, the cursor of the
+    next page is computed up front so that it can be sent before the rows.
+    """
+
+    def __init__(self, pool, table, columns=None, after=None, limit=100):
+        self.pool = pool
+        self.connection = pool.acquire()
+        try:
+            table_columns = pool.columns(self.connection, table)
+            if columns:
+                unknown = [column for column in columns if column not in table_columns]
+                if unknown:
+                    raise ColumnNotFound(', '.join(unknown))
+            else:
+                columns = [column for column in table_columns if not column.startswith('_')]
+            self.columns = columns
+            after = after if after is not None else -1
+            select = ', '.join(f'"{quote(column)}"' for column in columns)
+            self.sql = f'SELECT {select} FROM "{quote(table)}" WHERE rowid > ? ORDER BY rowid LIMIT ?'
+            self.params = (after, limit)
+            # the last row of this page and the first row of the next one, if any
+            boundary = self.connection.execute(f'SELECT rowid FROM "{quote(table)}" WHERE rowid > ? ORDER BY rowid '
+                                               f'LIMIT 2 OFFSET ?', (after, max(limit - 1, 0))).fetchall()
+            self.next = boundary[0][0] if limit > 0 and len(boundary) == 2 else None
+        except BaseException:
+            self.close()
+            raise
+
+    def rows(self):
+        """
+        Yields the rows of the page as dicts.
+        """
+        try:
+            cursor = self.connection.execute(self.sql, self.params)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(self.columns, row))
+        finally:
+            self.close()
+
+    def ndjson(self):
+        for row in self.rows():
+            yield json.dumps(row, default=str) + '\n'
+
+    def json(self):
+        yield '{"columns": ' + json.dumps(self.columns) + ', "rows": ['
+        separator = ''
+        for row in self.rows():
+            yield separator + json.dumps(row, default=str)
+            separator = ', '
+        yield '], "next": ' + json.dumps(self.next) + '}'
+
+    def close(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            self.pool.release(connection)
@@ -0,0 +1,244 @@
+import os
+import re
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+# Seconds between two scans of the taxonomies volume for changes. 0 disables the watcher.
+TAXONOMY_INDEX_POLL_INTERVAL = float(os.getenv('TAXONOMY_INDEX_POLL_INTERVAL', '30'))
+# Files of a taxonomy that its title and species are read from, in order of preference.
+TAXONOMY_DETAILS_FILES = os.getenv('TAXONOMY_DETAILS_FILES', 'taxonomy_details.yaml,project_config.yaml').split(',')
+
+RLTBL_DB = '.relatable/relatable.db'
+TITLE_KEYS = ('title', 'name', 'id')
+SPECIES_KEYS = ('species', 'organism')
+FIELDS = ('name', 'branch', 'commit', 'initialized', 'db_size', 'last_reload', 'title', 'species')
+
+
+def read_git_head(taxonomy_dir):
+    """
+    Reads the checked out branch and commit from the git metadata files, without running git.
+    :param taxonomy_dir: taxonomy folder
+    :return: branch (None if detached) and commit (None if unknown)
+    """
+    git_dir = os.path.join(taxonomy_dir, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as file:
+            head = file.read().strip()
+    except OSError:
+        return None, None
+    if not head.startswith('ref: '):
+        return None, head
+    ref = head[5:]
+    branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+    try:
+        with open(os.path.join(git_dir, ref)) as file:
+            return branch, file.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return branch, parts[0]
+    except OSError:
+        pass
+    return branch, None
+
+
+def read_taxonomy_details(taxonomy_dir):
+    """
+    Reads the title and species of the taxonomy from the top level keys of its details file.
+    :param taxonomy_dir: taxonomy folder
+    :return: title and species, None if not found
+    """
+    for file_name in TAXONOMY_DETAILS_FILES:
+        path = os.path.join(taxonomy_dir, file_name.strip())
+        if not os.path.isfile(path):
+            continue
+        values = dict()
+        try:
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    match = re.match(r'^([A-Za-z_]+):\s*(.+?)\s*$', line)
+                    if match and match.group(1).lower() not in values:
+                        values[match.group(1).lower()] = match.group(2).strip('\'"')
+        except (OSError, UnicodeDecodeError) as e:
+            log.warning(f"Could not read {path}: {e}")
+            continue
+        title = next((values[key] for key in TITLE_KEYS if values.get(key)), None)
+        species = next((values[key] for key in SPECIES_KEYS if values.get(key)), None)
+        return title, species
+    return None, None
+
+
+def signature(taxonomy_dir):
+    """
+    Returns the stat of the files the metadata is read from, used to detect changes cheaply.
+    """
+    result = []
+    for path in ('.git/HEAD', '.git/FETCH_HEAD', RLTBL_DB):
+        try:
+            stat = os.stat(os.path.join(taxonomy_dir, path))
+            result.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+
+def read_metadata(taxonomy_dir, last_reload=None):
+    branch, commit = read_git_head(taxonomy_dir)
+    title, species = read_taxonomy_details(taxonomy_dir)
+    try:
+        db_size = os.path.getsize(os.path.join(taxonomy_dir, RLTBL_DB))
+    except OSError:
+        db_size = None
+    if last_reload is None:
+        try:
+            last_reload = os.path.getmtime(os.path.join(taxonomy_dir, '.git'))
+        except OSError:
+            pass
+    return {
+        "name": os.path.basename(taxonomy_dir),
+        "branch": branch,
+        "commit": commit,
+        "initialized": db_size is not None,
+        "db_size": db_size,
+        "last_reload": last_reload,
+        "title": title,
+        "species": species,
+    }
+
+
+class TaxonomyIndex:
+    """
+    In-memory catalog of the taxonomies deployed under the taxonomies volume. It is built once, updated by the admin
+    operations and kept in sync with changes made outside of them by a background watcher, so that listing the
+    taxonomies doesn't touch the file system.
+    """
+
+    def __init__(self, taxonomies_volume=TAXONOMIES_VOLUME):
+        self.taxonomies_volume = taxonomies_volume
+        self.entries = dict()
+        self.signatures = dict()
+        self.lock = threading.Lock()
+        self.built = False
+        self.watcher = None
+        self.stopped = threading.Event()
+        self.listeners = []
+
+    def build(self):
+        """
+        Scans the taxonomies volume and indexes every taxonomy folder.
+        """
+        for name in self._folders():
+            self.update(name)
+        self.built = True
+        log.info(f"Taxonomy index built with {len(self.entries)} taxonomies.")
+
+    def update(self, name, reloaded=False):
+        """
+        Re-reads the metadata of the taxonomy, or removes it from the index if its folder no longer exists.
+        :param name: taxonomy name
+        :param reloaded: record the current time as the last reload of the taxonomy
+        """
+        if not self.taxonomies_volume:
+            return
+        taxonomy_dir = os.path.join(self.taxonomies_volume, name)
+        if not os.path.isdir(taxonomy_dir):
+            self.remove(name)
+            return
+        with self.lock:
+            previous = self.entries.get(name)
+        last_reload = time.time() if reloaded else (previous or {}).get("last_reload")
+        entry = read_metadata(taxonomy_dir, last_reload)
+        with self.lock:
+            self.entries[name] = entry
+            self.signatures[name] = signature(taxonomy_dir)
+        self._notify(name, entry)
+
+    def remove(self, name):
+        with self.lock:
+            removed = self.entries.pop(name, None)
+            self.signatures.pop(name, None)
+        if removed is not None:
+            self._notify(name, None)
+
+    def add_listener(self, listener):
+        """
+        Registers a function called with the taxonomy name and its new metadata (None if removed) on every update.
+        """
+        self.listeners.append(listener)
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            return dict(entry) if entry is not None else None
+
+    def list(self, offset=0, limit=None, fields=None):
+        """
+        Returns a page of the catalog ordered by taxonomy name.
+        :param offset: number of taxonomies to skip
+        :param limit: maximum number of taxonomies to return
+        :param fields: fields to return, all fields if None
+        :return: total number of taxonomies and the page of taxonomies
+        """
+        with self.lock:
+            names = sorted(self.entries)
+            page = [self.entries[name] for name in names[offset:offset + limit if limit is not None else None]]
+        if fields:
+            page = [{field: entry.get(field) for field in fields} for entry in page]
+        else:
+            page = [dict(entry) for entry in page]
+        return len(names), page
+
+    def scan(self):
+        """
+        Updates the taxonomies that were added, removed or changed since the last scan.
+        """
+        folders = set(self._folders())
+        with self.lock:
+            indexed = set(self.entries)
+            signatures = dict(self.signatures)
+        for name in indexed - folders:
+            self.remove(name)
+        for name in folders:
+            if name not in indexed or signatures.get(name) != signature(os.path.join(self.taxonomies_volume, name)):
+                self.update(name)
+
+    def start_watcher(self, interval=TAXONOMY_INDEX_POLL_INTERVAL):
+        if interval <= 0 or (self.watcher is not None and self.watcher.is_alive()):
+            return
+        self.stopped.clear()
+        self.watcher = threading.Thread(target=self._watch, args=(interval,), name="taxonomy-index", daemon=True)
+        self.watcher.start()
+
+    def stop_watcher(self):
+        self.stopped.set()
+
+    def _watch(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.scan()
+            except Exception as e:
+                log.error(f"Taxonomy index scan failed: {e}")
+
+    def _notify(self, name, entry):
+        for listener in self.listeners:
+            try:
+                listener(name, dict(entry) if entry is not None else None)
+            except Exception as e:
+                log.error(f"Taxonomy index listener failed for {name}: {e}")
+
+    def _folders(self):
+        if not self.taxonomies_volume or not os.path.isdir(self.taxonomies_volume):
+            return []
+        return [entry.name for entry in os.scandir(self.taxonomies_volume)
+                if entry.is_dir() and not entry.name.startswith('.')]
+
+
+taxonomy_index = TaxonomyIndex()
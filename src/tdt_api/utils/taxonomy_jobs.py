@@ -0,0 +1,61 @@
+import os
+import logging
+from functools import partial
+
+from tdt_api.utils import snapshots
+from tdt_api.utils.github_utils import create_taxonomy_folder, update_taxonomy_folder
+from tdt_api.utils.locks import taxonomy_lock
+from tdt_api.utils.response_cache import browser_cache
+from tdt_api.utils.taxonomy_index import taxonomy_index
+from tdt_api.utils.warmup import warmup
+
+log = logging.getLogger(__name__)
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+
+
+def init_taxonomy_task(repo_name, branch, repo_url, taxonomy_dir, taxonomies_volume=None):
+    """
+    Clones and initializes a taxonomy as a job task. Operations on the same taxonomy are serialized.
+    :return: task result
+    """
+    with taxonomy_lock(repo_name):
+        if os.path.exists(taxonomy_dir):
+            log.info(f"Taxonomy {repo_name} already exists.")
+            return {"message": "Repository already cloned and initialized."}
+        log.info(f"Taxonomy {repo_name} does not exist. Initializing...")
+        try:
+            snapshots.build(taxonomy_dir, partial(create_taxonomy_folder, branch, repo_url,
+                                                  taxonomies_volume or TAXONOMIES_VOLUME), copy=False)
+        finally:
+            taxonomy_index.update(repo_name, reloaded=True)
+        warmup.refresh(repo_name, taxonomy_dir)
+        log.info(f"Taxonomy {repo_name} initialized successfully.")
+        return {"message": "Repository cloned and initialized successfully."}
+
+
+def reload_taxonomy_task(repo_name, branch, repo_url, taxonomy_dir, mode='incremental', taxonomies_volume=None):
+    """
+    Reloads a taxonomy as a job task. 'incremental' updates the branch in a copy of the served snapshot, 'full' clones
+    the taxonomy again into an empty snapshot. Either replaces the served snapshot once it is built.
+    :return: summary of the reload
+    """
+    taxonomies_volume = taxonomies_volume or TAXONOMIES_VOLUME
+    with taxonomy_lock(repo_name):
+        if mode == 'incremental' and os.path.isdir(os.path.join(taxonomy_dir, '.git')):
+            summary = update_taxonomy_folder(branch, repo_url, taxonomies_volume, taxonomy_dir)
+            browser_cache.invalidate(repo_name)
+            taxonomy_index.update(repo_name, reloaded=True)
+            warmup.refresh(repo_name, taxonomy_dir)
+            log.info(f"Taxonomy {repo_name} reloaded successfully.")
+            return dict(summary, message="Taxonomy reloaded successfully.", mode=mode)
+
+        try:
+            snapshots.build(taxonomy_dir, partial(create_taxonomy_folder, branch, repo_url, taxonomies_volume),
+                            copy=False)
+        finally:
+            browser_cache.invalidate(repo_name)
+            taxonomy_index.update(repo_name, reloaded=True)
+        warmup.refresh(repo_name, taxonomy_dir)
+        log.info(f"Taxonomy {repo_name} initialized successfully.")
+        return {"message": "Taxonomy reloaded successfully.", "mode": 'full'}
@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tdt_api.utils import sqlite_reader, snapshots
+from tdt_api.utils.init_manager import init_manager, is_initialized, RLTBL_DB
+from tdt_api.utils.taxonomy_index import taxonomy_index
+
+log = logging.getLogger(__name__)
+
+TAXONOMIES_VOLUME = os.getenv('TAXONOMIES_VOLUME')
+# Warm the taxonomies up when the server starts and after they are initialized or reloaded. Until the startup warm-up
+# is complete the readiness endpoint answers 503.
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Run 'make init' during the warm-up for the taxonomies missing their database.
+WARMUP_INIT = os.getenv('WARMUP_INIT', 'true').lower() in ('1', 'true', 'yes')
+# Bytes of each taxonomy database read into the OS page cache during the warm-up. 0 disables the pre-read.
+WARMUP_PRELOAD_BYTES = int(os.getenv('WARMUP_PRELOAD_BYTES', str(512 * 1024 * 1024)))
+# Number of taxonomies warmed up at the same time ('make init' builds are bounded by TAXONOMY_INIT_WORKERS).
+WARMUP_WORKERS = int(os.getenv('WARMUP_WORKERS', '4'))
+
+RLTBL_BINARY = 'bin/rltbl'
+READ_SIZE = 1024 * 1024
+
+
+def preload_file(path, max_bytes=WARMUP_PRELOAD_BYTES):
+    """
+    Reads the beginning of the file so that it is in the OS page cache when the first request reads it.
+    :return: number of bytes read
+    """
+    if max_bytes <= 0 or not os.path.isfile(path):
+        return 0
+    loaded = 0
+    with open(path, 'rb', buffering=0) as file:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), 0, max_bytes, os.POSIX_FADV_WILLNEED)
+        while loaded < max_bytes:
+            data = file.read(min(READ_SIZE, max_bytes - loaded))
+            if not data:
+                break
+            loaded += len(data)
+    return loaded
+
+
+def warm_taxonomy(taxonomy, taxonomy_dir):
+    """
+    Prepares an initialized taxonomy for its first requests: its database and rltbl binary are read into the page
+    cache and the read-only database connections are opened.
+    :return: warm-up details of the taxonomy
+    """
+    started = time.monotonic()
+    # the current snapshot, which the requests are served from
+    taxonomy_dir = snapshots.resolve(taxonomy_dir)
+    db_path = os.path.join(taxonomy_dir, RLTBL_DB)
+    loaded = preload_file(db_path) + preload_file(os.path.join(taxonomy_dir, RLTBL_BINARY))
+
+    pool = sqlite_reader.get_pool(taxonomy, db_path)
+    connections = []
+    try:
+        for _ in range(pool.size):
+            connection = pool.acquire()
+            connections.append(connection)
+            connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+    finally:
+        for connection in connections:
+            pool.release(connection)
+    return {"preloaded_bytes": loaded, "connections": len(connections),
+            "seconds": round(time.monotonic() - started, 3)}
+
+
+class Warmup:
+    """
+    Startup warm-up of the taxonomies of the volume: the taxonomies missing their database are initialized on the
+    bounded init executor, then every taxonomy is warmed up by warm_taxonomy. The server is ready once it is complete.
+    """
+
+    def __init__(self, enabled=WARMUP_ENABLED, init=WARMUP_INIT, max_workers=WARMUP_WORKERS):
+        self.enabled = enabled
+        self.init = init
+        self.max_workers = max_workers
+        self.state = 'pending' if enabled else 'disabled'
+        self.started = None
+        self.finished = None
+        self.taxonomies = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def ready(self):
+        return self.state in ('complete', 'disabled')
+
+    def start(self, taxonomies_volume=TAXONOMIES_VOLUME):
+        """
+        Runs the warm-up in a background thread, if enabled.
+        """
+        with self.lock:
+            if not self.enabled or self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, args=(taxonomies_volume,), name="warmup", daemon=True)
+            self.thread.start()
+
+    def run(self, taxonomies_volume=TAXONOMIES_VOLUME):
+        with self.lock:
+            self.state = 'running'
+            self.started = time.time()
+        names = [entry["name"] for entry in taxonomy_index.list(fields=['name'])[1]]
+        log.info(f"Warming up {len(names)} taxonomies...")
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="warmup") as executor:
+            for name in names:
+                executor.submit(self._warm, name, os.path.join(taxonomies_volume, name))
+        with self.lock:
+            self.state = 'complete'
+            self.finished = time.time()
+        log.info(f"Warm-up completed in {self.finished - self.started:.1f} seconds.")
+
+    def refresh(self, taxonomy, taxonomy_dir):
+        """
+        Warms up a taxonomy that was initialized or reloaded, if the warm-up is enabled.
+        """
+        if self.enabled:
+            self._warm(taxonomy, taxonomy_dir)
+
+    def status(self):
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "warmup": self.state,
+                "started": self.started,
+                "finished": self.finished,
+                "taxonomies": {name: dict(details) for name, details in self.taxonomies.items()},
+            }
+
+    def _warm(self, taxonomy, taxonomy_dir):
+        try:
+            if not is_initialized(taxonomy_dir):
+                future = init_manager.submit(taxonomy, taxonomy_dir) if self.init else None
+                if future is not None:
+                    future.result()
+                if not is_initialized(taxonomy_dir):
+                    self._record(taxonomy, {"status": "not_initialized"})
+                    return
+            self._record(taxonomy, dict(warm_taxonomy(taxonomy, taxonomy_dir), status="warm"))
+        except Exception as e:
+            log.error(f"Warm-up of taxonomy {taxonomy} failed: {e}")
+            self._record(taxonomy, {"status": "failed", "error": str(e)})
+
+    def _record(self, taxonomy, details):
+        with self.lock:
+            self.taxonomies[taxonomy] = details
+
+
+warmup = Warmup()
@@ -0,0 +1,102 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGitHub:
+    """
+    Local stand-in for the GitHub collaborator permission and organization membership APIs.
+
+    :param permissions: dictionary of (org, repo, user) to 'write' or 'read'; other users get 404
+    :param members: dictionary of org to the set of its members
+    :param latency: seconds each request takes
+    """
+
+    def __init__(self, permissions=None, members=None, latency=0.0, rate_limit=5000):
+        self.permissions = permissions or dict()
+        self.members = members or dict()
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, pattern=''):
+        with self.lock:
+            return len([path for path in self.requests if pattern in path])
+
+    def respond(self, path, if_none_match):
+        """
+        Returns the status, headers and body of the response to a GET request.
+        """
+        match = re.fullmatch(r'/repos/([^/]+)/([^/]+)/collaborators/([^/]+)/permission', path)
+        if match:
+            permission = self.permissions.get(match.groups())
+            if permission is None:
+                return 404, {'message': 'Not Found'}
+            return 200, {'permission': permission,
+                         'user': {'login': match.group(3),
+                                  'permissions': {'pull': True, 'push': permission in ('write', 'admin'),
+                                                  'admin': permission == 'admin'}}}
+        match = re.fullmatch(r'/orgs/([^/]+)/members/([^/]+)', path)
+        if match:
+            return (204, None) if match.group(2) in self.members.get(match.group(1), ()) else (404, None)
+        match = re.fullmatch(r'/orgs/([^/]+)/memberships/([^/]+)', path)
+        if match:
+            if match.group(2) not in self.members.get(match.group(1), ()):
+                return 404, {'message': 'Not Found'}
+            role = 'admin' if match.group(2) in self.members.get(match.group(1) + ':admin', ()) else 'member'
+            return 200, {'state': 'active', 'role': role}
+        return 404, {'message': 'Not Found'}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with fake.lock:
+                    fake.requests.append(self.path)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, data = fake.respond(self.path, self.headers.get('If-None-Match'))
+                body = json.dumps(data).encode() if data is not None else b''
+                etag = f'"{hash((self.path, body)) & 0xffffffff:x}"'
+                with fake.lock:
+                    if self.headers.get('If-None-Match') == etag:
+                        status, body = 304, b''
+                    elif fake.remaining <= 0:
+                        status, body = 403, b'{"message": "API rate limit exceeded"}'
+                    else:
+                        fake.remaining -= 1
+                    remaining = fake.remaining
+                self.send_response(status)
+                self.send_header('ETag', etag)
+                self.send_header('X-RateLimit-Remaining', str(remaining))
+                self.send_header('X-RateLimit-Reset', str(int(time.time()) + 1))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
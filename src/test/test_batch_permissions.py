@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+from tdt_api.utils import github_utils
+from tdt_api.utils.github_client import GitHubClient
+from tdt_api.utils.github_utils import check_user_permissions, Permissions
+from tdt_api.utils.permission_cache import PermissionCache
+from test.fake_github import FakeGitHub
+
+
+@pytest.fixture
+def fake_github(monkeypatch):
+    permissions = {("org", f"repo_{i}", "reader"): "read" for i in range(5)}
+    permissions.update({("small", "a", "reader"): "write"})
+    with FakeGitHub(permissions=permissions, members={"org": {"reader", "owner"}, "org:admin": {"owner"}},
+                    latency=0.2) as fake:
+        client = GitHubClient(base_url=fake.url, pool_size=10)
+        monkeypatch.setattr(github_utils, 'github_client', client)
+        monkeypatch.setattr(github_utils, 'permission_cache', PermissionCache(
+            github_utils.fetch_user_permission, github_utils.classify_permission, db_path=None))
+        monkeypatch.setattr(github_utils, 'org_role_cache', PermissionCache(
+            github_utils.fetch_org_role, github_utils.classify_permission, db_path=None))
+        yield fake
+        client.close()
+
+
+def test_uncached_permissions_are_fetched_concurrently(fake_github):
+    repositories = [("org", f"repo_{i}") for i in range(5)] + [("small", "a"), ("small", "b")]
+    started = time.time()
+    results = check_user_permissions("reader", repositories)
+
+    # one round-trip for the organization role, then one for the repositories
+    assert time.time() - started < 0.7
+    assert results[("org", "repo_3")] == (Permissions.READ, 200)
+    assert results[("small", "a")] == (Permissions.WRITE, 200)
+    assert results[("small", "b")] == (Permissions.NO_ACCESS, 404)
+
+    requests = fake_github.count()
+    assert check_user_permissions("reader", repositories) == results
+    assert fake_github.count() == requests
+
+
+def test_organization_owners_are_answered_by_one_call(fake_github):
+    repositories = [("org", f"repo_{i}") for i in range(5)]
+    results = check_user_permissions("owner", repositories)
+
+    assert set(results.values()) == {(Permissions.WRITE, 200)}
+    assert fake_github.count("/memberships/") == 1
+    assert fake_github.count("/collaborators/") == 0
+    assert github_utils.permission_cache.get_cached("org", "repo_0", "owner") == (Permissions.WRITE, 200)
@@ -0,0 +1,25 @@
+import subprocess
+
+from benchmark.fixtures import write_rltbl_stub
+from benchmark.run import percentile, summarize
+
+
+def test_percentile():
+    values = [0.01 * i for i in range(1, 101)]
+    assert percentile(values, 0.5) == 0.505
+    assert round(percentile(values, 0.99), 4) == 0.9901
+    assert percentile([], 0.5) is None
+
+
+def test_summarize():
+    result = summarize([0.002, 0.001, 0.003], 1, 0.5, {"200": 2, "503": 1})
+    assert result["requests"] == 3 and result["throughput"] == 6.0
+    assert result["p50_ms"] == 2.0 and result["max_ms"] == 3.0
+
+
+def test_rltbl_stub(tmp_path):
+    stub = tmp_path / "bin" / "rltbl"
+    write_rltbl_stub(str(stub), 100, 0)
+    output = subprocess.run([str(stub)], env={"REQUEST_METHOD": "GET"}, capture_output=True, check=True).stdout
+    headers, body = output.split(b"\r\n\r\n", 1)
+    assert headers.startswith(b"Status: 200 OK") and body == b"x" * 100
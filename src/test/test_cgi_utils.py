@@ -0,0 +1,127 @@
+import io
+import os
+import sys
+import pytest
+
+from tdt_api.utils.cgi_utils import CgiProcess, CgiError, read_cgi_headers, iter_cgi_body
+from tdt_api.utils.governor import Governor, INTERACTIVE
+from tdt_api.utils.response_cache import ResponseCache
+
+
+class ClosingBytesIO(io.BytesIO):
+    closed_by_relay = False
+
+    def close(self):
+        self.closed_by_relay = True
+        super().close()
+
+
+def test_headers_are_parsed_and_body_is_untouched():
+    body = b"col1\tcol2\r\nvalue\xe2\x82\xac\n\n"
+    stream = ClosingBytesIO(b"Status: 404 Not Found\r\nContent-Type: text/tab-separated-values\r\n"
+                            b"Set-Cookie: a=b\r\nVary: Cookie\r\n\r\n" + body)
+
+    status, headers = read_cgi_headers(stream)
+    relayed = b"".join(iter_cgi_body(stream, chunk_size=4))
+
+    assert status == "404 Not Found"
+    assert headers == {"Status": "404 Not Found", "Content-Type": "text/tab-separated-values"}
+    assert relayed == body
+    assert stream.closed_by_relay
+
+
+def test_empty_output_is_an_error():
+    with pytest.raises(CgiError):
+        read_cgi_headers(io.BytesIO(b""))
+
+
+def test_cgi_process_streams_output(tmp_path):
+    script = tmp_path / "cgi"
+    script.write_text(f"#!{sys.executable}\n"
+                      "import os, sys\n"
+                      "data = sys.stdin.buffer.read()\n"
+                      "sys.stdout.buffer.write(b'Content-Type: text/plain\\n\\n' + os.environ['PATH_INFO'].encode() + data * 50000)\n")
+    script.chmod(0o755)
+
+    process = CgiProcess(str(script), str(tmp_path), {"PATH_INFO": "/table"}, b"0123456789")
+    status, headers = read_cgi_headers(process)
+    chunks = list(iter_cgi_body(process, chunk_size=65536))
+
+    assert status == 200
+    assert headers == {"Content-Type": "text/plain"}
+    assert len(chunks) > 1
+    assert b"".join(chunks) == b"/table" + b"0123456789" * 50000
+    assert process.process.returncode == 0
+
+
+def test_cgi_process_group_is_killed_on_timeout(tmp_path):
+    script = tmp_path / "cgi"
+    script.write_text("#!/bin/bash\nprintf 'Content-Type: text/plain\\n\\n'\nsleep 30 & wait\n")
+    script.chmod(0o755)
+    governor = Governor(max_processes=1)
+    permit = governor.acquire(INTERACTIVE)
+
+    process = CgiProcess(str(script), str(tmp_path), {}, timeout=0.5, permit=permit)
+    read_cgi_headers(process)
+    with pytest.raises(CgiError):
+        b"".join(iter_cgi_body(process))
+
+    assert process.timed_out
+    assert governor.stats()["running"][INTERACTIVE] == 0
+    assert governor.stats()["killed"][(INTERACTIVE, "timeout")] == 1
+
+
+def test_failed_cgi_process_aborts_the_body_and_is_not_cached(tmp_path):
+    script = tmp_path / "cgi"
+    script.write_text("#!/bin/bash\nprintf 'Content-Type: text/html\\n\\n<table>'\nexit 1\n")
+    script.chmod(0o755)
+    cache = ResponseCache(max_bytes=100)
+
+    process = CgiProcess(str(script), str(tmp_path), {})
+    status, headers = read_cgi_headers(process)
+    relayed = []
+    with pytest.raises(CgiError):
+        for chunk in cache.caching_body(("tax", "table"), status, headers, iter_cgi_body(process)):
+            relayed.append(chunk)
+
+    assert relayed == [b"<table>"]
+    assert process.process.returncode == 1
+    assert cache.get(("tax", "table")) is None
+
+
+def test_cgi_process_runs_with_limits(tmp_path):
+    script = tmp_path / "cgi"
+    script.write_text("#!/bin/sh\nprintf 'Content-Type: text/plain\\n\\n'\nulimit -v\n")
+    script.chmod(0o755)
+
+    # the CGI environment has no PATH, the limit programs are found in the default path
+    process = CgiProcess(str(script), str(tmp_path), {}, limits=["prlimit", f"--as={1024 ** 3}", "--"])
+    read_cgi_headers(process)
+    assert b"".join(iter_cgi_body(process)).strip() == str(1024 ** 2).encode()
+
+
+def test_head_request_stops_rltbl(tmp_path, monkeypatch):
+    from flask import Flask, request
+    from tdt_api.endpoints.taxonomy_service import rltbl
+    from tdt_api.utils.governor import governor
+
+    rltbl_script = tmp_path / "bin" / "rltbl"
+    rltbl_script.parent.mkdir()
+    rltbl_script.write_text("#!/bin/bash\necho $$ > pid\nprintf 'Content-Type: text/html\\n\\n<table>'\nexec sleep 30\n")
+    rltbl_script.chmod(0o755)
+    monkeypatch.setenv("RLTBL_ROOT", "/browser/")
+    app = Flask(__name__)
+
+    @app.route("/table", methods=["GET", "HEAD"])
+    def table():
+        return rltbl(request, "GET", "head_taxonomy", str(tmp_path), "table", "user")
+
+    response = app.test_client().head("/table")
+
+    assert response.status_code == 200
+    assert response.data == b""
+    response.close()
+    # the body was never iterated, rltbl was stopped and its slot released when the response was closed
+    with pytest.raises(ProcessLookupError):
+        os.kill(int((tmp_path / "pid").read_text()), 0)
+    assert governor.stats()["running"][INTERACTIVE] == 0
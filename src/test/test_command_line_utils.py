@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+from tdt_api.utils import metrics
+from tdt_api.utils.command_line_utils import runcmd, run_command, run_command_async, runcmd_async, CommandTimeout, \
+    OutputBuffer
+
+
+def test_output_is_streamed_line_by_line():
+    lines = []
+    result = run_command("echo one; echo two >&2; printf three", on_output=lambda stream, line: lines.append(
+        (stream, line, time.monotonic())))
+
+    assert result.returncode == 0
+    assert result.stdout == "one\nthree"
+    assert result.stderr == "two\n"
+    assert [(stream, line) for stream, line, _ in lines if stream == 'stdout'] == [('stdout', 'one\n'),
+                                                                                  ('stdout', 'three')]
+
+
+def test_lines_are_received_while_the_command_runs():
+    received = []
+    started = time.monotonic()
+    run_command("echo first; sleep 0.5; echo second", on_output=lambda stream, line: received.append(
+        time.monotonic() - started))
+
+    assert received[0] < 0.4 <= received[1]
+
+
+def test_kept_output_is_bounded():
+    result = run_command("seq 1 100000", max_output=1000)
+
+    assert len(result.stdout) <= 1000
+    assert result.stdout.endswith("100000\n")
+
+    buffer = OutputBuffer(max_size=100)
+    assert buffer.feed(b"x" * 200 * 1024) != []
+    assert len(buffer.partial) < 64 * 1024
+
+
+def test_timeout_kills_the_process_group(tmp_path):
+    marker = tmp_path / "survived"
+    started = time.monotonic()
+    result = run_command(f"(sleep 1.5; touch {marker}) & sleep 30", timeout=0.5)
+
+    assert result.timed_out
+    assert time.monotonic() - started < 5
+    time.sleep(1.5)
+    assert not os.path.exists(marker)
+
+
+def test_idle_timeout():
+    started = time.monotonic()
+    result = run_command("echo start; sleep 30", idle_timeout=0.5, timeout=0)
+
+    assert result.timed_out
+    assert result.stdout == "start\n"
+    assert time.monotonic() - started < 5
+
+
+def test_runcmd_raises_on_failure_and_timeout():
+    assert runcmd("echo ok", supress_logs=True) == "ok\n"
+    with pytest.raises(Exception, match="Failed: exit 3"):
+        runcmd("exit 3", supress_logs=True)
+    assert runcmd("echo partial; exit 3", supress_exceptions=True, supress_logs=True) == "partial\n"
+    with pytest.raises(CommandTimeout):
+        runcmd("sleep 30", timeout=0.3, supress_logs=True)
+
+
+def test_commands_in_a_snapshot_are_labelled_with_the_taxonomy(tmp_path):
+    snapshot = tmp_path / ".snapshots" / "tax" / "20261018113637-ab12cd"
+    snapshot.mkdir(parents=True)
+    runcmd("true", cwd=str(snapshot), supress_logs=True)
+
+    text = metrics.render()
+    assert 'span="runcmd:true",taxonomy="tax"' in text
+    assert "20261018113637-ab12cd" not in text
+
+
+def test_async_commands_run_concurrently_from_one_thread():
+    async def run_all():
+        return await asyncio.gather(*[run_command_async(f"sleep 0.3; echo {i}") for i in range(5)],
+                                    run_command_async("sleep 30", timeout=0.3),
+                                    runcmd_async("echo done", supress_logs=True))
+
+    started = time.monotonic()
+    results = asyncio.run(run_all())
+
+    assert time.monotonic() - started < 2
+    assert [result.stdout for result in results[:5]] == [f"{i}\n" for i in range(5)]
+    assert results[5].timed_out
+    assert results[6] == "done\n"
@@ -0,0 +1,91 @@
+import zlib
+import gzip
+
+from flask import Flask, Response
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_etags
+
+from tdt_api.utils import delivery
+from tdt_api.utils.delivery import negotiate_encoding, compress_chunks, peek_body, etag_matches, deliver
+
+app = Flask(__name__)
+PAGE = [b"<tr><td>row %d</td></tr>\n" % i for i in range(200)]
+
+
+class Chunks:
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding(Accept([("gzip", 1), ("deflate", 1)])) == "gzip"
+    assert negotiate_encoding(Accept([("gzip", 0.5), ("br", 1)])) == ("br" if delivery.brotli else "gzip")
+    assert negotiate_encoding(Accept([("deflate", 1)])) is None
+    assert negotiate_encoding(Accept([])) is None
+
+
+def test_compressed_chunks_are_flushed_as_they_are_produced():
+    source = Chunks(PAGE)
+    compressed = compress_chunks(source, "gzip")
+    first = next(iter(compressed))
+    assert gzip.decompress(first + b"".join(compressed)) == b"".join(PAGE)
+    compressed.close()
+    assert source.closed
+
+    # the first chunk can be decoded before the body is complete
+    decoder = zlib.decompressobj(16 + 15)
+    assert decoder.decompress(first) == PAGE[0]
+
+
+def test_peek_body():
+    complete, chunks = peek_body(iter([b"ab", b"cd"]), 10)
+    assert complete and chunks == [b"ab", b"cd"]
+
+    source = Chunks([b"ab", b"cd", b"ef"])
+    complete, chunks = peek_body(source, 3)
+    assert not complete
+    assert b"".join(chunks) == b"abcdef"
+    chunks.close()
+    assert source.closed
+
+
+def test_etag_matches_compressed_representations():
+    assert etag_matches(parse_etags('"abc-gzip"'), "abc") == '"abc-gzip"'
+    assert etag_matches(parse_etags('W/"abc-br"'), "abc", weak=True) == 'W/"abc-br"'
+    assert etag_matches(parse_etags('"abc"'), "abc") == '"abc"'
+    assert etag_matches(parse_etags('"abd-gzip", "abc-deflate"'), "abc") is None
+    assert etag_matches(parse_etags('*'), "abc") == '"abc"'
+
+
+def test_deliver_compresses_large_pages():
+    with app.test_request_context("/api/browser/tax/table", headers={"Accept-Encoding": "gzip"}):
+        from flask import request
+        response = Response(Chunks(PAGE), content_type="text/html")
+        response.set_etag("abc")
+        response = deliver(request, response, "table")
+
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Cache-Control"] == "private, no-cache"
+        assert "Accept-Encoding" in response.vary
+        assert response.get_etag() == ("abc-gzip", False)
+        assert gzip.decompress(response.get_data()) == b"".join(PAGE)
+
+
+def test_deliver_keeps_small_and_binary_bodies():
+    with app.test_request_context("/api/browser/tax/logo.png", headers={"Accept-Encoding": "gzip"}):
+        from flask import request
+        small = deliver(request, Response(iter([b"<p>small</p>"]), content_type="text/html"), "page")
+        assert "Content-Encoding" not in small.headers
+        assert small.get_data() == b"<p>small</p>"
+
+        image = deliver(request, Response(b"x" * 4096, content_type="image/png"), "logo.png")
+        assert "Content-Encoding" not in image.headers
+        assert image.headers["Cache-Control"] == f"public, max-age={delivery.BROWSER_ASSET_MAX_AGE}, immutable"
@@ -0,0 +1,54 @@
+import time
+import pytest
+
+from tdt_api.utils.github_client import GitHubClient, GitHubUnavailable
+from test.fake_github import FakeGitHub
+
+
+@pytest.fixture
+def fake_github():
+    with FakeGitHub(permissions={("org", "repo", "writer"): "write", ("org", "repo", "reader"): "read"},
+                    members={"org2": {"writer"}}) as fake:
+        yield fake
+
+
+def test_conditional_requests_are_revalidated(fake_github):
+    client = GitHubClient(base_url=fake_github.url)
+    first = client.get("/repos/org/repo/collaborators/writer/permission")
+    remaining = fake_github.remaining
+    second = client.get("/repos/org/repo/collaborators/writer/permission")
+
+    assert first == second
+    assert first.data["user"]["permissions"]["push"] is True
+    assert fake_github.count("/collaborators/") == 2
+    assert fake_github.remaining == remaining
+    client.close()
+
+
+def test_org_membership_checks_run_concurrently(fake_github):
+    fake_github.latency = 0.2
+    client = GitHubClient(base_url=fake_github.url, pool_size=4)
+    started = time.time()
+    assert client.is_member_of_any_org(["org1", "org2", "org3", "org4"], "writer") is True
+    assert time.time() - started < 0.6
+    assert client.is_member_of_any_org(["org1", "org3"], "writer") is False
+    client.close()
+
+
+def test_exhausted_rate_limit_backs_off(fake_github):
+    fake_github.remaining = 0
+    client = GitHubClient(base_url=fake_github.url, max_rate_limit_wait=0)
+
+    with pytest.raises(GitHubUnavailable):
+        client.get("/repos/org/repo/collaborators/reader/permission")
+    assert client.rate_limit_remaining == 0
+    with pytest.raises(GitHubUnavailable):
+        client.get("/repos/org/repo/collaborators/reader/permission")
+    assert fake_github.count() == 1
+    client.close()
+
+
+def test_unreachable_github():
+    client = GitHubClient(base_url="http://127.0.0.1:9", timeout=0.5)
+    with pytest.raises(GitHubUnavailable):
+        client.get("/orgs/org/members/user")
@@ -1,7 +1,9 @@
 import pytest
 from dotenv import load_dotenv
 import os
+from tdt_api.utils import github_utils, metrics
 from tdt_api.utils.github_utils import check_user_permission, Permissions, is_user_member_of_org
+from tdt_api.utils.taxonomy_index import taxonomy_index
 
 load_dotenv(os.path.join(os.path.dirname(__file__), '../../.env'))
 
@@ -52,4 +54,14 @@ def test_is_user_member_of_org_not_member(github_token):
     user_id = "tdt-robot"
 
     result = is_user_member_of_org(orgs, user_id)
-    assert result is False
\ No newline at end of file
+    assert result is False
+
+def test_permission_spans_are_labelled_with_deployed_taxonomies_only(monkeypatch):
+    monkeypatch.setattr(github_utils.permission_cache, 'get', lambda repo_org, repo_name, user_id: (Permissions.READ, 0))
+    monkeypatch.setattr(taxonomy_index, 'entries', {'deployed_taxonomy': {'name': 'deployed_taxonomy'}})
+    check_user_permission('org', 'deployed_taxonomy', 'user')
+    check_user_permission('org', 'random-repository-name', 'user')
+
+    text = metrics.render()
+    assert 'span="check_user_permission",taxonomy="deployed_taxonomy"' in text
+    assert 'random-repository-name' not in text
@@ -0,0 +1,140 @@
+import os
+import time
+import asyncio
+import threading
+
+import pytest
+
+from tdt_api.utils import governor as governor_module
+from tdt_api.utils import command_line_utils
+from tdt_api.utils.command_line_utils import run_command, runcmd_async
+from tdt_api.utils.governor import Governor, Rejected, limits, INTERACTIVE, BACKGROUND
+
+
+def wait_until(condition):
+    while not condition():
+        threading.Event().wait(0.01)
+
+
+def test_interactive_calls_are_admitted_first():
+    governor = Governor(max_processes=1, interactive_reserve=0)
+    running = governor.acquire(BACKGROUND)
+    admitted = []
+
+    def acquire(priority):
+        permit = governor.acquire(priority)
+        admitted.append(priority)
+        permit.release()
+
+    threads = [threading.Thread(target=acquire, args=(priority,)) for priority in (BACKGROUND, INTERACTIVE)]
+    threads[0].start()
+    wait_until(lambda: governor.stats()["waiting"][BACKGROUND] == 1)
+    threads[1].start()
+    wait_until(lambda: governor.stats()["waiting"][INTERACTIVE] == 1)
+
+    running.release()
+    for thread in threads:
+        thread.join(2)
+    assert admitted == [INTERACTIVE, BACKGROUND]
+
+
+def test_builds_leave_reserved_slots_and_calls_time_out():
+    governor = Governor(max_processes=3, max_per_taxonomy=1, interactive_reserve=1, queue_timeout=0.05)
+    builds = [governor.acquire(BACKGROUND), governor.acquire(BACKGROUND)]
+    with pytest.raises(Rejected):
+        governor.acquire(BACKGROUND, timeout=0.05)
+
+    call = governor.acquire(INTERACTIVE, "tax")
+    with pytest.raises(Rejected) as error:
+        governor.acquire(INTERACTIVE, "tax")
+    assert error.value.retry_after == 1
+
+    builds[0].release(returncode=-9)
+    builds[1].release(returncode=-9, killed=True)
+    call.release(returncode=0)
+    call.release(returncode=-9)
+    stats = governor.stats()
+    assert stats["running"] == {INTERACTIVE: 0, BACKGROUND: 0}
+    assert stats["rejected"] == {INTERACTIVE: 1, BACKGROUND: 1}
+    assert stats["killed"][(BACKGROUND, "signal")] == 1
+    assert stats["killed"][(INTERACTIVE, "signal")] == 0
+
+
+def test_slots_are_shared_by_the_worker_processes(tmp_path):
+    # governors with the same lock folder stand for the worker processes of the server
+    first, second = (Governor(max_processes=2, max_per_taxonomy=1, interactive_reserve=1, queue_timeout=0.05,
+                              lock_dir=str(tmp_path)) for _ in range(2))
+    build = first.acquire(BACKGROUND)
+    with pytest.raises(Rejected):
+        second.acquire(BACKGROUND, timeout=0.05)
+    call = second.acquire(INTERACTIVE, "tax")
+    with pytest.raises(Rejected):
+        first.acquire(INTERACTIVE)
+
+    build.release()
+    with pytest.raises(Rejected):
+        first.acquire(INTERACTIVE, "tax")
+    other = first.acquire(INTERACTIVE, "other")
+    other.release()
+    call.release()
+    second.acquire(BACKGROUND, "tax", timeout=0.05).release()
+
+
+def test_taxonomy_slots_do_not_collide_with_the_global_slots(tmp_path):
+    first, second = (Governor(max_processes=1, max_per_taxonomy=1, interactive_reserve=0, queue_timeout=0.05,
+                              lock_dir=str(tmp_path)) for _ in range(2))
+    # a taxonomy named like the global slots
+    call = first.acquire(INTERACTIVE, "slot")
+    with pytest.raises(Rejected):
+        second.acquire(INTERACTIVE, "other")
+    call.release()
+    second.acquire(INTERACTIVE, "slot").release()
+    assert sorted(os.listdir(tmp_path)) == ["global", "taxonomy"]
+
+
+def test_waiting_interactive_calls_hold_back_the_builds_of_other_workers(tmp_path):
+    first, second = (Governor(max_processes=2, interactive_reserve=0, lock_dir=str(tmp_path)) for _ in range(2))
+    builds = [first.acquire(BACKGROUND), first.acquire(BACKGROUND)]
+    admitted = []
+    thread = threading.Thread(target=lambda: admitted.append(second.acquire(INTERACTIVE, timeout=5)))
+    thread.start()
+    wait_until(lambda: second.stats()["waiting"][INTERACTIVE] == 1)
+    time.sleep(0.05)
+
+    builds[0].release()
+    with pytest.raises(Rejected):
+        first.acquire(BACKGROUND, timeout=0.02)
+    thread.join(2)
+    assert len(admitted) == 1
+    admitted[0].release()
+    builds[1].release()
+
+
+def test_async_commands_take_a_slot_of_their_taxonomy(tmp_path, monkeypatch):
+    monkeypatch.setattr(command_line_utils, "governor", Governor(max_per_taxonomy=1, lock_dir=str(tmp_path / "locks")))
+    snapshot = tmp_path / ".snapshots" / "tax" / "20261018113637-ab12cd"
+    snapshot.mkdir(parents=True)
+
+    async def run_all():
+        return await asyncio.gather(*[runcmd_async("sleep 0.2", cwd=str(snapshot), supress_logs=True)
+                                      for _ in range(2)])
+
+    started = time.monotonic()
+    asyncio.run(run_all())
+    assert time.monotonic() - started >= 0.4
+    assert command_line_utils.governor.stats()["admitted"][BACKGROUND] == 2
+
+
+def test_limits_are_applied_to_the_child(monkeypatch):
+    monkeypatch.setattr(governor_module, "BUILD_MEMORY_LIMIT", 1024 ** 3)
+    monkeypatch.setattr(governor_module, "BUILD_NICE", 5)
+    monkeypatch.setattr(governor_module, "RLTBL_CPU_LIMIT", 0)
+    monkeypatch.setattr(governor_module, "RLTBL_MEMORY_LIMIT", 0)
+    assert limits(INTERACTIVE) == []
+    assert limits(BACKGROUND) == ["nice", "-n", "5", "prlimit", f"--as={1024 ** 3}", "--"]
+
+    # the limits apply to every program of the command
+    result = run_command("true; ulimit -v; nice", limits=limits(BACKGROUND))
+    memory, niceness = result.stdout.split()
+    assert memory == str(1024 ** 2)
+    assert int(niceness) >= 5
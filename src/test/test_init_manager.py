@@ -0,0 +1,59 @@
+import threading
+
+from tdt_api.utils import init_manager as init_module
+from tdt_api.utils.init_manager import TaxonomyInitManager, InitStatus
+
+
+def test_concurrent_callers_share_one_build(tmp_path, monkeypatch):
+    calls = []
+    release = threading.Event()
+
+    def fake_runcmd(cmd, cwd=None, **kwargs):
+        calls.append(cmd)
+        release.wait(5)
+        (tmp_path / ".relatable").mkdir()
+        (tmp_path / ".relatable" / "relatable.db").touch()
+
+    monkeypatch.setattr(init_module, "runcmd", fake_runcmd)
+    manager = TaxonomyInitManager(max_workers=2)
+
+    futures = {manager.submit("tax", str(tmp_path)) for _ in range(5)}
+    assert len(futures) == 1
+    assert manager.ensure_initialized("tax", str(tmp_path), wait=0.01) == InitStatus.INITIALIZING
+
+    release.set()
+    futures.pop().result(5)
+    assert calls == ["make init"]
+    assert manager.ensure_initialized("tax", str(tmp_path)) == InitStatus.READY
+    manager.shutdown()
+
+
+def test_failed_build_is_not_retried_immediately(tmp_path, monkeypatch):
+    calls = []
+
+    def failing_runcmd(cmd, cwd=None, **kwargs):
+        calls.append(cmd)
+        raise Exception("make: *** [init] Error 2")
+
+    monkeypatch.setattr(init_module, "runcmd", failing_runcmd)
+    manager = TaxonomyInitManager(max_workers=1, retry_interval=60)
+
+    assert manager.ensure_initialized("tax", str(tmp_path), wait=5) == InitStatus.FAILED
+    assert manager.ensure_initialized("tax", str(tmp_path), wait=5) == InitStatus.FAILED
+    status = manager.status("tax", str(tmp_path))
+    assert calls == ["make init"]
+    assert "Error 2" in status["error"]
+    assert 0 < status["retry_after"] <= 60
+
+    # an explicit init request retries at once
+    future = manager.submit("tax", str(tmp_path), force=True)
+    assert future is not None
+    future.exception(5)
+    assert calls == ["make init", "make init"]
+    manager.shutdown()
+
+
+def test_missing_taxonomy_is_not_built(tmp_path):
+    manager = TaxonomyInitManager()
+    assert manager.submit("missing", str(tmp_path / "missing")) is None
+    assert manager.status("missing", str(tmp_path / "missing"))["status"] == InitStatus.NOT_FOUND
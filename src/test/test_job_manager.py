@@ -0,0 +1,108 @@
+import time
+
+from tdt_api.utils.job_manager import Job, JobManager, JobStatus, process_id, is_owner_alive
+
+
+def wait_for(job, timeout=5):
+    deadline = time.time() + timeout
+    while job.status in {JobStatus.PENDING, JobStatus.RUNNING} and time.time() < deadline:
+        time.sleep(0.01)
+    return job.to_dict()
+
+
+def test_tasks_run_concurrently_and_report_progress():
+    manager = JobManager(max_workers=3)
+    started = time.time()
+    job = manager.submit("init_taxonomies", {name: (lambda: time.sleep(0.2)) for name in ("a", "b", "c")})
+    result = wait_for(job)
+
+    assert time.time() - started < 0.5
+    assert result["status"] == "succeeded"
+    assert set(result["tasks"]) == {"a", "b", "c"}
+    assert all(task["duration"] >= 0.2 for task in result["tasks"].values())
+    assert manager.get(job.id) is job
+    manager.shutdown()
+
+
+def test_failed_task_fails_the_job():
+    def fail():
+        raise Exception("git clone failed")
+
+    manager = JobManager(max_workers=2)
+    result = wait_for(manager.submit("init_taxonomies", {"ok": lambda: None, "broken": fail}))
+
+    assert result["status"] == "failed"
+    assert result["tasks"]["ok"]["status"] == "succeeded"
+    assert result["tasks"]["broken"]["error"] == "git clone failed"
+    manager.shutdown()
+
+
+def test_job_history_is_bounded():
+    manager = JobManager(history_size=2)
+    jobs = [manager.submit("empty", {}) for _ in range(3)]
+
+    assert manager.get(jobs[0].id) is None
+    assert jobs[2].to_dict()["status"] == "succeeded"
+
+
+def test_steps_are_recorded_and_persisted(tmp_path):
+    from tdt_api.utils.command_line_utils import runcmd
+
+    db_path = str(tmp_path / "jobs.db")
+    manager = JobManager(max_workers=1, db_path=db_path)
+    job = manager.submit("reload_taxonomy", {"a": lambda: runcmd("echo hello") and {"reloaded": True}})
+    assert job.wait(5)
+    manager.shutdown()
+
+    # another process (or a restarted one) reads the job from the database
+    result = JobManager(db_path=db_path).get(job.id).to_dict()
+    assert result["status"] == "succeeded"
+    assert result["tasks"]["a"]["result"] == {"reloaded": True}
+    step = result["tasks"]["a"]["steps"][0]
+    assert step["command"] == "echo hello"
+    assert step["returncode"] == 0
+    assert step["stdout"] == "hello\n"
+    assert step["duration"] >= 0
+
+
+def test_cancel_terminates_running_command_and_skips_queued_tasks(tmp_path):
+    from tdt_api.utils.command_line_utils import runcmd
+
+    manager = JobManager(max_workers=1, db_path=str(tmp_path / "jobs.db"))
+    job = manager.submit("init_taxonomies", {"slow": lambda: runcmd("sleep 10"), "queued": lambda: None})
+    deadline = time.time() + 5
+    while not any(context.process for context in manager.contexts.values()) and time.time() < deadline:
+        time.sleep(0.01)
+    started = time.time()
+    manager.cancel(job.id)
+
+    assert job.wait(5)
+    assert time.time() - started < 5
+    result = job.to_dict()
+    assert result["status"] == "cancelled"
+    assert result["tasks"]["slow"]["status"] == "cancelled"
+    assert result["tasks"]["queued"]["status"] == "cancelled"
+    assert result["cancel_requested"]
+    manager.shutdown()
+
+
+def test_jobs_of_stopped_processes_are_interrupted(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    manager = JobManager(db_path=db_path)
+    job = Job("init_taxonomies", ["a"], owner="another-host:1")
+    manager._save(job)
+
+    manager.recover()
+    result = manager.get(job.id).to_dict()
+    assert result["status"] == "interrupted"
+    assert result["tasks"]["a"]["error"]
+
+
+def test_owner_with_a_reused_pid_is_not_alive():
+    owner = process_id()
+    assert is_owner_alive(owner)
+    host, pid, start_time = owner.split(':')
+    # a process of an earlier run that had the same pid
+    assert not is_owner_alive(f"{host}:{pid}:{int(start_time) - 1}")
+    assert is_owner_alive(f"{host}:{pid}")
+    assert not is_owner_alive(f"another-host:{pid}:{start_time}")
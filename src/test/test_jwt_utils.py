@@ -0,0 +1,68 @@
+import time
+
+import jwt
+import pytest
+from flask import Flask, request
+
+from tdt_api.utils import jwt_utils
+from tdt_api.utils.jwt_utils import SessionCache, Session, get_session_info, session_cache
+
+SECRET = 'test-token-secret-of-32-bytes-or-more'
+
+
+@pytest.fixture(autouse=True)
+def token_secret():
+    jwt_utils.configure(token_secret=SECRET)
+    yield
+    jwt_utils.configure()
+
+
+def token(**claims):
+    return jwt.encode(dict({'name': 'user_1', 'email': 'user_1@localhost', 'repoOrg': 'org'}, **claims), SECRET,
+                      algorithm='HS256')
+
+
+def test_session_is_decoded_once_per_token():
+    app = Flask(__name__)
+    value = token()
+    stats = session_cache.stats()
+    for _ in range(3):
+        with app.test_request_context(f'/?token={value}'):
+            user, email, repo_org = get_session_info(request)
+            assert get_session_info(request) is get_session_info(request)
+    assert (user, email, repo_org) == ('user_1', 'user_1@localhost', 'org')
+    assert session_cache.stats()["misses"] == stats["misses"] + 1
+
+    with app.test_request_context('/'):
+        assert get_session_info(request) == Session('visitor', None, None)
+
+
+def test_sessions_expire_with_their_token():
+    cache = SessionCache(ttl=60)
+    calls = []
+
+    def decode(value):
+        calls.append(value)
+        return Session('user', None, None), time.time() + 0.2
+
+    cache.get('jwt', 'a', decode)
+    cache.get('jwt', 'a', decode)
+    assert len(calls) == 1
+    time.sleep(0.25)
+    cache.get('jwt', 'a', decode)
+    assert len(calls) == 2
+
+
+def test_invalid_tokens_are_not_cached():
+    app = Flask(__name__)
+    with app.test_request_context(f'/?token={token(exp=int(time.time()) - 10)}'):
+        with pytest.raises(jwt.ExpiredSignatureError):
+            get_session_info(request)
+    assert session_cache.stats()["size"] == 0
+
+
+def test_cache_is_bounded():
+    cache = SessionCache(max_size=2)
+    for value in ('a', 'b', 'c'):
+        cache.get('jwt', value, lambda v: (Session(v, None, None), None))
+    assert cache.stats()["size"] == 2
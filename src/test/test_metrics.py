@@ -0,0 +1,111 @@
+import os
+import sys
+import subprocess
+
+import pytest
+from prometheus_client import REGISTRY, CollectorRegistry, generate_latest
+
+from tdt_api.utils import metrics
+
+
+def test_histogram_and_counter_exposition():
+    registry = CollectorRegistry()
+    histogram = metrics.Histogram('test_duration_seconds', 'Test durations.', ('span',), registry, buckets=(0.1, 1))
+    histogram.observe(0.05, span='a')
+    histogram.observe(0.5, span='a')
+    histogram.observe(5, span='a')
+    counter = metrics.Counter('test_total', 'Test counter.', ('path',), registry)
+    counter.inc(path='x"y')
+    counter.inc(2, path='x"y')
+
+    lines = generate_latest(registry).decode().splitlines()
+    assert 'test_duration_seconds_bucket{le="0.1",span="a"} 1.0' in lines
+    assert 'test_duration_seconds_bucket{le="1.0",span="a"} 2.0' in lines
+    assert 'test_duration_seconds_bucket{le="+Inf",span="a"} 3.0' in lines
+    assert 'test_duration_seconds_sum{span="a"} 5.55' in lines
+    assert 'test_duration_seconds_count{span="a"} 3.0' in lines
+    assert 'test_total{path="x\\"y"} 3.0' in lines
+
+
+def test_spans_record_duration_and_errors():
+    @metrics.timed('test_span', lambda taxonomy: taxonomy)
+    def work(taxonomy):
+        if taxonomy == 'bad':
+            raise ValueError(taxonomy)
+
+    work('good')
+    with pytest.raises(ValueError):
+        work('bad')
+    with metrics.span('test_block', 'good'):
+        pass
+
+    text = metrics.render()
+    assert 'tdt_span_duration_seconds_count{span="test_span",taxonomy="good"} 1.0' in text
+    assert 'tdt_span_duration_seconds_count{span="test_block",taxonomy="good"} 1.0' in text
+    assert 'tdt_span_errors_total{span="test_span",taxonomy="bad"} 1.0' in text
+
+
+def test_series_limit(monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_MAX_SERIES', 2)
+    registry = CollectorRegistry()
+    counter = metrics.Counter('test_limited_total', 'Test counter.', ('id',), registry)
+    dropped = REGISTRY.get_sample_value('tdt_metrics_dropped_series_total')
+    for i in range(5):
+        counter.inc(id=i)
+    assert generate_latest(registry).decode().count('test_limited_total{') == 2
+    assert REGISTRY.get_sample_value('tdt_metrics_dropped_series_total') - dropped == 3
+
+
+def test_disabled_metrics_are_noops(monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_ENABLED', False)
+
+    def work():
+        return 1
+
+    assert metrics.timed('test_disabled')(work) is work
+    assert metrics.span('test_disabled') is metrics.span('other')
+
+
+def test_collected_statistics(monkeypatch):
+    stats = {'hits': 3, 'size': float('inf')}
+    monkeypatch.setattr(metrics, '_collectors', [lambda: [
+        ('test_collected_hits_total', 'counter', 'Test hits.', [({'cache': 'a'}, stats['hits'])]),
+        ('test_collected_size', 'gauge', 'Test size.', [({'cache': 'a'}, stats['size'])]),
+    ]])
+    text = metrics.render()
+    assert 'test_collected_hits_total{cache="a"} 3.0' in text
+    assert 'test_collected_size{cache="a"} +Inf' in text
+
+    stats.update(hits=5, size=float('nan'))
+    text = metrics.render()
+    assert 'test_collected_hits_total{cache="a"} 5.0' in text
+    assert 'test_collected_size{cache="a"} NaN' in text
+
+
+WORKER = """
+from tdt_api.utils import metrics
+metrics.counter('test_workers_total', 'Test counter.', ('path',)).inc({count}, path='a')
+metrics.aggregate_gauge('test_workers_gauge', 'min')
+metrics.register_collector(lambda: [('test_workers_gauge', 'gauge', 'Test gauge.', [({{}}, {gauge})])])
+print(metrics.render())
+"""
+
+
+def test_metrics_are_aggregated_across_workers(tmp_path):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+
+    def worker(count, gauge):
+        process = subprocess.Popen([sys.executable, '-c', WORKER.format(count=count, gauge=gauge)], env=env,
+                                   cwd=os.path.dirname(os.path.dirname(__file__)), stdout=subprocess.PIPE, text=True)
+        return process.pid, process.communicate()[0]
+
+    first, _ = worker(10, 3)
+    _, text = worker(100, 5)
+    assert 'test_workers_total{path="a"} 110.0' in text
+    assert 'test_workers_gauge 3.0' in text
+
+    # the gauges of the exited workers are dropped, their counters are kept
+    metrics.multiprocess.mark_process_dead(first, str(tmp_path))
+    _, text = worker(1, 7)
+    assert 'test_workers_total{path="a"} 111.0' in text
+    assert 'test_workers_gauge 5.0' in text
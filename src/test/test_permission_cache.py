@@ -0,0 +1,87 @@
+import time
+import threading
+
+from tdt_api.utils.permission_cache import PermissionCache, POSITIVE, NEGATIVE
+from tdt_api.utils.github_utils import Permissions, classify_permission, permission_cache
+
+
+def counting_loader(results, delay=0.0):
+    calls = []
+
+    def loader(*key):
+        calls.append(key)
+        time.sleep(delay)
+        return results[key[-1]]
+    return loader, calls
+
+
+def test_positive_and_negative_ttls():
+    loader, calls = counting_loader({"writer": (Permissions.WRITE, 200), "stranger": (Permissions.NO_ACCESS, 404)})
+    cache = PermissionCache(loader, classify_permission, ttl=60, negative_ttl=0.05, stale_ttl=0, db_path=None)
+
+    for _ in range(3):
+        cache.get("org", "repo", "writer")
+        cache.get("org", "repo", "stranger")
+    time.sleep(0.06)
+    cache.get("org", "repo", "writer")
+    cache.get("org", "repo", "stranger")
+
+    assert calls.count(("org", "repo", "writer")) == 1
+    assert calls.count(("org", "repo", "stranger")) == 2
+
+
+def test_transient_errors_are_not_cached():
+    loader, calls = counting_loader({"user": (Permissions.NO_ACCESS, 503)})
+    cache = PermissionCache(loader, classify_permission, db_path=None)
+    cache.get("org", "repo", "user")
+    cache.get("org", "repo", "user")
+
+    assert len(calls) == 2
+    assert cache.stats()["errors"] == 2
+
+
+def test_concurrent_misses_share_one_load():
+    loader, calls = counting_loader({"user": (Permissions.READ, 200)}, delay=0.2)
+    cache = PermissionCache(loader, classify_permission, db_path=None)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("org", "repo", "user"))) for _ in range(8)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+
+    assert len(calls) == 1
+    assert results == [(Permissions.READ, 200)] * 8
+
+
+def test_stale_entries_are_served_while_refreshing():
+    results = {"user": (Permissions.READ, 200)}
+    loader, calls = counting_loader(results)
+    cache = PermissionCache(loader, classify_permission, ttl=0.01, stale_ttl=60, db_path=None)
+    cache.get("org", "repo", "user")
+    time.sleep(0.02)
+    results["user"] = (Permissions.WRITE, 200)
+
+    assert cache.get("org", "repo", "user") == (Permissions.READ, 200)
+    time.sleep(0.1)
+    assert cache.get("org", "repo", "user") == (Permissions.WRITE, 200)
+    assert cache.stats()["loads"] >= 2
+    cache.shutdown()
+
+
+def test_lru_eviction():
+    cache = PermissionCache(lambda *key: (Permissions.READ, 200), lambda result: POSITIVE, maxsize=2, db_path=None)
+    for user in ("a", "b", "c"):
+        cache.get("org", "repo", user)
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size"] == 2
+
+
+def test_shared_backend_between_caches(tmp_path):
+    db_path = str(tmp_path / "permissions.db")
+    loader, calls = counting_loader({"user": (Permissions.WRITE, 200)})
+    codec = dict(encode=permission_cache.backend_encode, decode=permission_cache.backend_decode)
+    first = PermissionCache(loader, classify_permission, db_path=db_path, **codec)
+    second = PermissionCache(loader, classify_permission, db_path=db_path, **codec)
+
+    assert first.get("org", "repo", "user") == (Permissions.WRITE, 200)
+    assert second.get("org", "repo", "user") == (Permissions.WRITE, 200)
+    assert len(calls) == 1
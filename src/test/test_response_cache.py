@@ -0,0 +1,101 @@
+import os
+
+from tdt_api.utils.response_cache import ResponseCache, CachedResponse, db_version, make_key, make_etag
+
+
+def entry(body):
+    return CachedResponse("200 OK", {"Content-Type": "text/html"}, body)
+
+
+def test_lru_eviction_by_size():
+    cache = ResponseCache(max_bytes=10, max_entry_bytes=10)
+    cache.put(("tax", "a"), entry(b"1234"))
+    cache.put(("tax", "b"), entry(b"1234"))
+    cache.get(("tax", "a"))
+    cache.put(("tax", "c"), entry(b"1234"))
+
+    assert cache.get(("tax", "b")) is None
+    assert cache.get(("tax", "a")) is not None
+    assert cache.size == 8
+    assert cache.evictions == 1
+
+
+def test_large_entries_are_not_cached():
+    cache = ResponseCache(max_bytes=100, max_entry_bytes=3)
+    cache.put(("tax", "a"), entry(b"1234"))
+    assert cache.get(("tax", "a")) is None
+
+
+def test_invalidate_drops_taxonomy_and_in_flight_responses():
+    cache = ResponseCache(max_bytes=100)
+    cache.put(("tax", "a"), entry(b"1"))
+    cache.put(("other", "a"), entry(b"1"))
+    generation = cache.generation("tax")
+    cache.invalidate("tax")
+    cache.put(("tax", "b"), entry(b"1"), generation)
+
+    assert cache.get(("tax", "a")) is None
+    assert cache.get(("tax", "b")) is None
+    assert cache.get(("other", "a")) is not None
+
+
+def test_caching_body_stores_streamed_response():
+    cache = ResponseCache(max_bytes=100, max_entry_bytes=10)
+    key = ("tax", "a")
+    assert list(cache.caching_body(key, "200 OK", {}, iter([b"ab", b"cd"]))) == [b"ab", b"cd"]
+    assert cache.get(key).body == b"abcd"
+
+    list(cache.caching_body(("tax", "b"), "200 OK", {}, iter([b"0123456789", b"x"])))
+    assert cache.get(("tax", "b")) is None
+
+
+def test_abandoned_stream_is_not_cached():
+    cache = ResponseCache(max_bytes=100)
+    body = cache.caching_body(("tax", "a"), "200 OK", {}, iter([b"ab", b"cd"]))
+    next(body)
+    body.close()
+    assert cache.get(("tax", "a")) is None
+
+
+def test_body_closed_with_an_error_status_is_not_cached():
+    class FailedBody:
+        def __iter__(self):
+            return iter([b"ab"])
+
+        def close(self):
+            return 1
+
+    cache = ResponseCache(max_bytes=100)
+    assert list(cache.caching_body(("tax", "a"), "200 OK", {}, FailedBody())) == [b"ab"]
+    assert cache.get(("tax", "a")) is None
+
+
+def test_db_version_tracks_database_changes(tmp_path):
+    assert db_version(str(tmp_path)) is None
+    db = tmp_path / ".relatable" / "relatable.db"
+    db.parent.mkdir()
+    db.write_bytes(b"v1")
+    first = db_version(str(tmp_path))
+    db.write_bytes(b"v2 longer")
+    second = db_version(str(tmp_path))
+
+    assert first != second
+    assert make_etag(make_key("tax", "table", "", "TRUE", "visitor", first)) != \
+           make_etag(make_key("tax", "table", "", "TRUE", "visitor", second))
+
+
+def test_unread_body_is_closed():
+    class Body:
+        closed = False
+
+        def __iter__(self):
+            return iter([b"ab"])
+
+        def close(self):
+            self.closed = True
+
+    cache = ResponseCache(max_bytes=100)
+    body = Body()
+    cache.caching_body(("tax", "a"), "200 OK", {}, body).close()
+    assert body.closed
+    assert cache.get(("tax", "a")) is None
@@ -0,0 +1,95 @@
+import time
+import threading
+
+import pytest
+
+from tdt_api.utils.scheduler import TaxonomyScheduler, Saturated, suspend_writes, is_building
+
+
+def test_readers_share_writers_are_exclusive(tmp_path):
+    scheduler = TaxonomyScheduler("tax", max_readers=2, lock_dir=str(tmp_path))
+    first, second = scheduler.acquire(), scheduler.acquire()
+    with pytest.raises(Saturated):
+        scheduler.acquire(timeout=0.05)
+    first.release()
+    first.release()
+    third = scheduler.acquire(timeout=0.05)
+
+    with pytest.raises(Saturated):
+        scheduler.acquire(write=True, timeout=0.05)
+    second.release()
+    third.release()
+    writer = scheduler.acquire(write=True, timeout=0.05)
+    assert (tmp_path / "tax.write.lock").exists()
+    with pytest.raises(Saturated):
+        scheduler.acquire(timeout=0.05)
+    writer.release()
+    assert scheduler.stats()["timeouts"] == 3
+
+
+def test_fifo_order_does_not_starve_writers():
+    scheduler = TaxonomyScheduler("tax", max_readers=2)
+    reader = scheduler.acquire()
+    order = []
+
+    def run(name, write):
+        slot = scheduler.acquire(write=write, timeout=5)
+        order.append(name)
+        time.sleep(0.01)
+        slot.release()
+
+    threads = []
+    for name, write in (("writer", True), ("reader", False)):
+        threads.append(threading.Thread(target=run, args=(name, write)))
+        threads[-1].start()
+        time.sleep(0.05)
+    # the reader arrived after the writer, it must not overtake it even though a read slot is free
+    assert order == []
+    reader.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["writer", "reader"]
+
+
+def test_queue_depth_limit():
+    scheduler = TaxonomyScheduler("tax", max_readers=1, max_queue=1)
+    slot = scheduler.acquire()
+    waiter = threading.Thread(target=lambda: scheduler.acquire(timeout=1).release())
+    waiter.start()
+    time.sleep(0.05)
+    with pytest.raises(Saturated) as error:
+        scheduler.acquire()
+    assert error.value.retry_after >= 1
+    slot.release()
+    waiter.join(5)
+    stats = scheduler.stats()
+    assert stats["rejected"] == 1 and stats["admitted"] == 2 and stats["queued"] == 0
+    assert stats["wait_seconds_buckets"]["+Inf"] == 2
+
+
+def test_writes_are_suspended_during_a_build(tmp_path):
+    scheduler = TaxonomyScheduler("tax", lock_dir=str(tmp_path))
+    writer = scheduler.acquire(write=True)
+    entered = threading.Event()
+
+    def build():
+        with suspend_writes("tax", str(tmp_path)):
+            entered.set()
+            time.sleep(0.2)
+
+    thread = threading.Thread(target=build)
+    thread.start()
+    # the build waits for the running edit
+    time.sleep(0.05)
+    assert is_building("tax", str(tmp_path)) and not entered.is_set()
+    with pytest.raises(Saturated) as e:
+        scheduler.acquire(write=True, timeout=5)
+    assert e.value.retry_after == 60
+    writer.release()
+    assert entered.wait(1)
+    reader = scheduler.acquire(timeout=0.05)
+    reader.release()
+    thread.join()
+
+    assert not is_building("tax", str(tmp_path))
+    scheduler.acquire(write=True, timeout=0.05).release()
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from tdt_api.utils.search_index import SearchIndex, match_expression
+
+CELLS = [
+    ("CS202210140_1", "L2/3 IT", "layer 2/3 intratelencephalic neuron", "IT neuron|L2/3 excitatory", "Cluster"),
+    ("CS202210140_2", "Astrocyte", "astrocyte of the cerebral cortex", "", "Subclass"),
+    ("CS202210140_3", "Microglia", "microglial cell", "brain macrophage", "Subclass"),
+]
+
+
+def make_taxonomy(volume, name, cells=CELLS):
+    folder = volume / name / ".relatable"
+    folder.mkdir(parents=True, exist_ok=True)
+    db = folder / "relatable.db"
+    if db.exists():
+        db.unlink()
+    connection = sqlite3.connect(db)
+    connection.execute("CREATE TABLE cas (_id INTEGER, cell_set_accession TEXT, cell_label TEXT, cell_fullname TEXT, "
+                       "synonyms TEXT, labelset TEXT)")
+    connection.execute("CREATE TABLE message (table_name TEXT, message TEXT)")
+    connection.executemany("INSERT INTO cas VALUES (?, ?, ?, ?, ?, ?)",
+                           [(i,) + cell for i, cell in enumerate(cells)])
+    connection.commit()
+    connection.close()
+    # make sure the version token changes even within the mtime resolution
+    os.utime(db, ns=(db.stat().st_atime_ns, db.stat().st_mtime_ns + 10 ** 9))
+
+
+def test_match_expression():
+    assert match_expression("L2/3 intra") == '"L2" "3" "intra"*'
+    assert match_expression("  ?? ") is None
+
+
+def test_search_and_get(tmp_path):
+    make_taxonomy(tmp_path, "human")
+    make_taxonomy(tmp_path, "mouse", CELLS[1:])
+    index = SearchIndex(str(tmp_path / ".search" / "search.db"), str(tmp_path))
+    index.sync({"human": "Homo sapiens", "mouse": "Mus musculus"})
+
+    results = index.search(["astro", "macrophage", "intratelencephalic"])
+    assert {match["taxonomy"] for match in results["astro"]} == {"human", "mouse"}
+    assert [match["label"] for match in results["macrophage"]] == ["Microglia", "Microglia"]
+    assert results["intratelencephalic"][0]["identifier"] == "CS202210140_1"
+    assert results["intratelencephalic"][0]["record"]["labelset"] == "Cluster"
+
+    assert len(index.search(["astrocyte"], species="mus musculus")["astrocyte"]) == 1
+    assert index.search(["astrocyte"], rank="Cluster")["astrocyte"] == []
+    assert len(index.search(["cell"], taxonomy="human", limit=1)["cell"]) == 1
+
+    found = index.get(["CS202210140_1", "CS202210140_3", "unknown"])
+    assert [match["taxonomy"] for match in found["CS202210140_1"]] == ["human"]
+    assert [match["taxonomy"] for match in found["CS202210140_3"]] == ["human", "mouse"]
+    assert found["unknown"] == []
+
+
+def test_incremental_update(tmp_path):
+    make_taxonomy(tmp_path, "human")
+    index = SearchIndex(str(tmp_path / "search.db"), str(tmp_path))
+    assert index.update("human")
+    assert not index.update("human")
+
+    make_taxonomy(tmp_path, "human", CELLS[:1])
+    assert index.update("human")
+    assert index.stats() == {"taxonomies": 1, "cell_sets": 1}
+    assert index.search(["astrocyte"])["astrocyte"] == []
+
+    index.on_taxonomy_changed("human", None)
+    assert index.stats() == {"taxonomies": 0, "cell_sets": 0}
+
+
+def test_close_closes_the_connections_of_all_threads(tmp_path):
+    make_taxonomy(tmp_path, "human")
+    index = SearchIndex(str(tmp_path / "search.db"), str(tmp_path))
+    connections = []
+    threads = [threading.Thread(target=lambda: connections.append(index._connection())) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, connections))) == 3
+
+    index.close()
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+    # the index opens a new connection on the next call
+    assert index.update("human")
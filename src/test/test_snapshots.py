@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from tdt_api.utils import snapshots
+from tdt_api.utils.scheduler import TaxonomyScheduler, Saturated
+from tdt_api.utils.taxonomy_index import TaxonomyIndex
+
+
+def make_folder(folder):
+    (folder / ".git" / "objects" / "ab").mkdir(parents=True)
+    (folder / ".git" / "objects" / "ab" / "cdef").write_bytes(b"object")
+    (folder / ".git" / "HEAD").write_text("ref: refs/heads/main\n")
+    (folder / "data.tsv").write_text("a\tb\n")
+    return folder
+
+
+def snapshot_files(taxonomy_dir):
+    return sorted(os.listdir(snapshots.snapshots_folder(taxonomy_dir)))
+
+
+def wait_for_collection():
+    for thread in threading.enumerate():
+        if thread.name == "snapshot-gc":
+            thread.join()
+
+
+def test_build_switches_snapshot_and_migrates_legacy_folder(tmp_path):
+    taxonomy_dir = str(make_folder(tmp_path / "tax"))
+    with snapshots.acquire(taxonomy_dir) as lease:
+        assert lease.path == os.path.realpath(taxonomy_dir)
+
+    path = snapshots.build(taxonomy_dir, lambda folder: open(os.path.join(folder, "new.tsv"), "w").close())
+
+    assert os.path.islink(taxonomy_dir)
+    assert snapshots.resolve(taxonomy_dir) == path
+    assert sorted(os.listdir(taxonomy_dir)) == [".git", "data.tsv", "new.tsv"]
+    assert snapshots.taxonomy_name(path) == "tax"
+    # the legacy folder had no requests in flight
+    assert snapshot_files(taxonomy_dir) == [os.path.basename(path), os.path.basename(path) + ".lease"]
+
+    index = TaxonomyIndex(str(tmp_path))
+    index.build()
+    assert index.list(0, 10, fields=["name"]) == (1, [{"name": "tax"}])
+
+
+def test_leased_snapshot_is_kept_until_released(tmp_path):
+    taxonomy_dir = str(make_folder(tmp_path / "tax"))
+    first = snapshots.build(taxonomy_dir, lambda folder: None)
+
+    lease = snapshots.acquire(taxonomy_dir)
+    assert lease.path == first
+    second = snapshots.build(taxonomy_dir, lambda folder: None)
+
+    assert snapshots.resolve(taxonomy_dir) == second
+    assert os.path.isdir(first)
+    # git objects are shared, the other files are copies
+    objects = os.path.join(".git", "objects", "ab", "cdef")
+    assert os.stat(os.path.join(first, objects)).st_ino == os.stat(os.path.join(second, objects)).st_ino
+    assert os.stat(os.path.join(first, "data.tsv")).st_ino != os.stat(os.path.join(second, "data.tsv")).st_ino
+
+    lease.release()
+    wait_for_collection()
+    assert not os.path.exists(first)
+    assert snapshots.collect(taxonomy_dir) == []
+
+
+def test_failed_build_keeps_current_snapshot(tmp_path):
+    taxonomy_dir = str(make_folder(tmp_path / "tax"))
+    current = snapshots.build(taxonomy_dir, lambda folder: None)
+
+    def fail(folder):
+        raise RuntimeError("make init failed")
+
+    with pytest.raises(RuntimeError):
+        snapshots.build(taxonomy_dir, fail)
+    wait_for_collection()
+
+    assert snapshots.resolve(taxonomy_dir) == current
+    assert snapshot_files(taxonomy_dir) == [os.path.basename(current), os.path.basename(current) + ".lease"]
+
+
+def test_build_copies_the_database_and_suspends_edits(tmp_path):
+    taxonomy_dir = str(make_folder(tmp_path / "tax"))
+    (tmp_path / "tax" / ".relatable").mkdir()
+    (tmp_path / "tax" / ".relatable" / "config.toml").write_text("")
+    connection = sqlite3.connect(os.path.join(taxonomy_dir, snapshots.RLTBL_DB))
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA wal_autocheckpoint = 0")
+    connection.execute("CREATE TABLE cell_set (id TEXT)")
+    connection.execute("INSERT INTO cell_set VALUES ('CS:1')")
+    connection.commit()
+    # the row is only in the WAL, which the snapshot does not copy as a file
+    assert os.path.getsize(os.path.join(taxonomy_dir, snapshots.RLTBL_DB + "-wal")) > 0
+    scheduler = TaxonomyScheduler("tax", lock_dir=str(tmp_path / ".locks"))
+
+    def prepare(folder):
+        with pytest.raises(Saturated):
+            scheduler.acquire(write=True, timeout=0.05)
+        scheduler.acquire(timeout=0.05).release()
+
+    path = snapshots.build(taxonomy_dir, prepare)
+    connection.close()
+
+    assert sorted(os.listdir(os.path.join(path, ".relatable"))) == ["config.toml", "relatable.db"]
+    copy = sqlite3.connect(os.path.join(path, snapshots.RLTBL_DB))
+    assert copy.execute("SELECT id FROM cell_set").fetchall() == [("CS:1",)]
+    assert copy.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    copy.close()
+    scheduler.acquire(write=True, timeout=0.05).release()
+
+
+def test_build_copies_file_names_with_shell_characters(tmp_path):
+    taxonomy_dir = str(make_folder(tmp_path / "tax"))
+    names = ["with space.tsv", "$(touch injected).tsv", "a;touch injected2", "`touch injected3`"]
+    for name in names:
+        (tmp_path / "tax" / name).write_text("x")
+
+    path = snapshots.build(taxonomy_dir, lambda folder: None)
+
+    assert sorted(os.listdir(path)) == sorted([".git", "data.tsv", *names])
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("injected")]
+    assert not [name for name in os.listdir(os.getcwd()) if name.startswith("injected")]
@@ -0,0 +1,65 @@
+import json
+import sqlite3
+
+import pytest
+
+from tdt_api.utils.sqlite_reader import ReadOnlyPool, Page, TableNotFound, ColumnNotFound, WithoutRowid
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "relatable.db"
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE cas (_id INTEGER, accession TEXT, label TEXT)")
+    connection.executemany("INSERT INTO cas VALUES (?, ?, ?)", [(i, f"CS_{i}", f"cell {i}") for i in range(1, 6)])
+    connection.commit()
+    connection.close()
+    return str(path)
+
+
+def test_cursor_pagination(db_path):
+    pool = ReadOnlyPool(db_path, size=1)
+    page = Page(pool, "cas", limit=2)
+    assert list(page.rows()) == [{"accession": "CS_1", "label": "cell 1"}, {"accession": "CS_2", "label": "cell 2"}]
+    assert page.next == 2
+
+    page = Page(pool, "cas", ["label"], after=page.next, limit=2)
+    assert [row["label"] for row in page.rows()] == ["cell 3", "cell 4"]
+    page = Page(pool, "cas", ["_id"], after=page.next, limit=2)
+    document = json.loads(''.join(page.json()))
+    assert document == {"columns": ["_id"], "rows": [{"_id": 5}], "next": None}
+
+
+def test_validation_and_read_only(db_path):
+    pool = ReadOnlyPool(db_path, size=1)
+    with pytest.raises(TableNotFound):
+        Page(pool, "missing")
+    with pytest.raises(ColumnNotFound):
+        Page(pool, "cas", ["label", "bogus"])
+    # the single connection was returned to the pool by the failed pages
+    with pool.connection() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute("DELETE FROM cas")
+
+
+def test_pool_is_replaced_with_the_database(db_path, tmp_path):
+    pool = ReadOnlyPool(db_path)
+    assert pool.is_current()
+    (tmp_path / "relatable.db").rename(tmp_path / "old.db")
+    (tmp_path / "old.db").rename(tmp_path / "relatable.db")
+    assert pool.is_current()
+    sqlite3.connect(tmp_path / "new.db").close()
+    (tmp_path / "new.db").replace(tmp_path / "relatable.db")
+    assert not pool.is_current()
+
+
+def test_without_rowid_table_is_rejected(db_path):
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE labels (accession TEXT PRIMARY KEY, label TEXT) WITHOUT ROWID")
+    connection.close()
+    pool = ReadOnlyPool(db_path, size=1)
+    with pytest.raises(WithoutRowid):
+        Page(pool, "labels")
+    # the connection was returned to the pool
+    assert [row["label"] for row in Page(pool, "cas", limit=1).rows()] == ["cell 1"]
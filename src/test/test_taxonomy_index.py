@@ -0,0 +1,57 @@
+import os
+
+from tdt_api.utils.taxonomy_index import TaxonomyIndex, read_git_head
+
+
+def make_taxonomy(volume, name, commit="a" * 40, branch="main", db=True):
+    folder = volume / name
+    (folder / ".git" / "refs" / "heads").mkdir(parents=True)
+    (folder / ".git" / "HEAD").write_text(f"ref: refs/heads/{branch}\n")
+    (folder / ".git" / "refs" / "heads" / branch).write_text(commit + "\n")
+    (folder / "taxonomy_details.yaml").write_text(f"title: '{name} title'\nspecies: Homo sapiens\n")
+    if db:
+        (folder / ".relatable").mkdir()
+        (folder / ".relatable" / "relatable.db").write_bytes(b"x" * 10)
+    return folder
+
+
+def test_build_and_list(tmp_path):
+    make_taxonomy(tmp_path, "tax_b")
+    make_taxonomy(tmp_path, "tax_a", db=False)
+    (tmp_path / ".staging").mkdir()
+    index = TaxonomyIndex(str(tmp_path))
+    index.build()
+
+    total, page = index.list(0, 1)
+    assert total == 2
+    assert page == [{"name": "tax_a", "branch": "main", "commit": "a" * 40, "initialized": False, "db_size": None,
+                     "last_reload": page[0]["last_reload"], "title": "tax_a title", "species": "Homo sapiens"}]
+    total, page = index.list(1, 10, fields=["name", "db_size"])
+    assert page == [{"name": "tax_b", "db_size": 10}]
+
+
+def test_packed_refs(tmp_path):
+    folder = tmp_path / "tax"
+    (folder / ".git").mkdir(parents=True)
+    (folder / ".git" / "HEAD").write_text("ref: refs/heads/dev\n")
+    (folder / ".git" / "packed-refs").write_text("# pack-refs with: peeled\n" + "b" * 40 + " refs/heads/dev\n")
+    assert read_git_head(str(folder)) == ("dev", "b" * 40)
+
+
+def test_scan_picks_up_changes(tmp_path):
+    folder = make_taxonomy(tmp_path, "tax")
+    index = TaxonomyIndex(str(tmp_path))
+    index.build()
+
+    (folder / ".git" / "refs" / "heads" / "main").write_text("c" * 40 + "\n")
+    head = folder / ".git" / "HEAD"
+    os.utime(head, ns=(head.stat().st_atime_ns, head.stat().st_mtime_ns + 10 ** 9))
+    make_taxonomy(tmp_path, "new")
+    index.scan()
+    assert index.get("tax")["commit"] == "c" * 40
+    assert index.get("new") is not None
+
+    os.rename(folder, tmp_path / ".removed")
+    index.scan()
+    assert index.get("tax") is None
+    assert index.list()[0] == 1
@@ -0,0 +1,161 @@
+import os
+import sys
+import sqlite3
+import subprocess
+
+import pytest
+
+from tdt_api.utils import snapshots
+from tdt_api.utils.github_utils import (clone_command, create_taxonomy_folder, update_taxonomy_folder, RLTBL_DB,
+                                        MIRRORS_FOLDER)
+
+MAKEFILE = """init:
+\tmkdir -p .relatable
+\t{python} -c "import sqlite3; sqlite3.connect('{db}').execute('CREATE TABLE IF NOT EXISTS build (id)')"
+"""
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com', GIT_COMMITTER_NAME='test',
+               GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def git(*args, cwd):
+    return subprocess.run(['git', *args], cwd=cwd, env=GIT_ENV, check=True, capture_output=True, text=True).stdout
+
+
+def commit(work_dir, path, content):
+    with open(os.path.join(work_dir, path), 'w') as file:
+        file.write(content)
+    git('add', '-A', cwd=work_dir)
+    git('commit', '-q', '-m', f'Update {path}', cwd=work_dir)
+    git('push', '-q', 'origin', 'main', cwd=work_dir)
+
+
+@pytest.fixture
+def origin(tmp_path):
+    """
+    Local bare repository of a taxonomy, and a clone of it to push commits from.
+    """
+    work_dir = str(tmp_path / 'work')
+    os.makedirs(work_dir)
+    git('init', '-q', '-b', 'main', cwd=work_dir)
+    with open(os.path.join(work_dir, 'Makefile'), 'w') as file:
+        file.write(MAKEFILE.format(python=sys.executable, db=RLTBL_DB))
+    with open(os.path.join(work_dir, 'data.tsv'), 'w') as file:
+        file.write('a\tb\n')
+    git('add', '-A', cwd=work_dir)
+    git('commit', '-q', '-m', 'Initial commit', cwd=work_dir)
+    bare_dir = str(tmp_path / 'tax.git')
+    git('clone', '-q', '--bare', work_dir, bare_dir, cwd=str(tmp_path))
+    git('remote', 'add', 'origin', bare_dir, cwd=work_dir)
+    return 'file://' + bare_dir, work_dir
+
+
+@pytest.fixture
+def volume(tmp_path):
+    os.makedirs(tmp_path / 'volume')
+    return str(tmp_path / 'volume')
+
+
+def mark_database(taxonomy_dir):
+    """
+    Adds a row to the database of the taxonomy, which disappears if the taxonomy is rebuilt.
+    """
+    connection = sqlite3.connect(os.path.join(taxonomy_dir, RLTBL_DB))
+    with connection:
+        connection.execute("INSERT INTO build VALUES (1)")
+    connection.close()
+
+
+def is_marked(taxonomy_dir):
+    connection = sqlite3.connect(os.path.join(taxonomy_dir, RLTBL_DB))
+    try:
+        return connection.execute("SELECT count(*) FROM build").fetchone()[0] == 1
+    finally:
+        connection.close()
+
+
+def test_incremental_reload_without_changes_is_a_noop(origin, volume):
+    repo_url, _ = origin
+    taxonomy_dir = os.path.join(volume, 'tax')
+    create_taxonomy_folder('main', repo_url, volume, taxonomy_dir, 'full')
+
+    summary = update_taxonomy_folder('main', repo_url, volume, taxonomy_dir)
+
+    assert summary['previous'] == summary['current']
+    assert summary['rebuilt'] is False
+    # no snapshot was built
+    assert not os.path.islink(taxonomy_dir)
+    assert not os.path.exists(snapshots.snapshots_folder(taxonomy_dir))
+
+
+def test_reload_rebuilds_only_for_build_inputs(origin, volume):
+    repo_url, work_dir = origin
+    taxonomy_dir = os.path.join(volume, 'tax')
+    create_taxonomy_folder('main', repo_url, volume, taxonomy_dir, 'full')
+    mark_database(taxonomy_dir)
+
+    commit(work_dir, 'README.md', '# Taxonomy\n')
+    summary = update_taxonomy_folder('main', repo_url, volume, taxonomy_dir)
+    assert summary['changed_files'] == 1
+    assert summary['rebuilt'] is False
+    assert os.path.exists(os.path.join(taxonomy_dir, 'README.md'))
+    assert is_marked(taxonomy_dir)
+
+    commit(work_dir, 'data.tsv', 'a\tb\nc\td\n')
+    summary = update_taxonomy_folder('main', repo_url, volume, taxonomy_dir)
+    assert summary['rebuilt'] is True
+    assert open(os.path.join(taxonomy_dir, 'data.tsv')).read() == 'a\tb\nc\td\n'
+    assert not is_marked(taxonomy_dir)
+
+
+def test_reload_of_shallow_clone_stays_shallow(origin, volume):
+    repo_url, work_dir = origin
+    taxonomy_dir = os.path.join(volume, 'tax')
+    create_taxonomy_folder('main', repo_url, volume, taxonomy_dir, 'shallow')
+    assert os.path.exists(os.path.join(taxonomy_dir, '.git', 'shallow'))
+
+    commit(work_dir, 'data.tsv', 'a\tb\nc\td\n')
+    summary = update_taxonomy_folder('main', repo_url, volume, taxonomy_dir)
+
+    assert summary['current'] == git('rev-parse', 'HEAD', cwd=work_dir).strip()
+    assert git('rev-parse', 'HEAD', cwd=taxonomy_dir).strip() == summary['current']
+    assert git('rev-list', '--count', 'HEAD', cwd=taxonomy_dir).strip() == '1'
+
+
+def test_clone_command_per_strategy(origin, volume):
+    repo_url, _ = origin
+    taxonomy_dir = os.path.join(volume, 'tax')
+    mirror_dir = os.path.join(volume, MIRRORS_FOLDER, 'tax.git')
+
+    assert clone_command('main', repo_url, volume, taxonomy_dir, 'full') == f"git clone {repo_url} {taxonomy_dir}"
+    assert clone_command('main', repo_url, volume, taxonomy_dir, 'shallow') == \
+        f"git clone --depth 1 --single-branch --branch main {repo_url} {taxonomy_dir}"
+    assert clone_command('main', repo_url, volume, taxonomy_dir, 'blobless') == \
+        f"git clone --filter=blob:none --branch main {repo_url} {taxonomy_dir}"
+    assert clone_command('main', repo_url, volume, taxonomy_dir, 'reference') == \
+        f"git clone --reference {mirror_dir} --branch main {repo_url} {taxonomy_dir}"
+    assert os.path.isdir(os.path.join(mirror_dir, 'objects'))
+    with pytest.raises(ValueError):
+        clone_command('main', repo_url, volume, taxonomy_dir, 'sparse')
+
+
+def test_reference_clones_reuse_the_mirror(origin, volume):
+    repo_url, work_dir = origin
+    mirror_dir = os.path.join(volume, MIRRORS_FOLDER, 'tax.git')
+    first_dir = os.path.join(volume, 'tax')
+    create_taxonomy_folder('main', repo_url, volume, first_dir, 'reference')
+    commit(work_dir, 'data.tsv', 'a\tb\nc\td\n')
+    second_dir = os.path.join(volume, 'tax_copy')
+    create_taxonomy_folder('main', repo_url, volume, second_dir, 'reference')
+
+    head = git('rev-parse', 'HEAD', cwd=work_dir).strip()
+    # the mirror was fetched for the second clone, which borrows all of its objects
+    assert git('rev-parse', 'main', cwd=mirror_dir).strip() == head
+    for taxonomy_dir in (first_dir, second_dir):
+        alternates = open(os.path.join(taxonomy_dir, '.git', 'objects', 'info', 'alternates')).read().strip()
+        assert os.path.realpath(alternates) == os.path.realpath(os.path.join(mirror_dir, 'objects'))
+    assert git('count-objects', '-v', cwd=second_dir).splitlines()[0] == 'count: 0'
+
+    commit(work_dir, 'README.md', '# Taxonomy\n')
+    update_taxonomy_folder('main', repo_url, volume, first_dir)
+    assert git('rev-parse', 'main', cwd=mirror_dir).strip() == git('rev-parse', 'HEAD', cwd=work_dir).strip()
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+from flask import Flask, Blueprint
+
+from tdt_api.app import initialize_app
+from tdt_api.endpoints import taxonomy_service
+from tdt_api.utils.init_manager import init_manager
+
+
+@pytest.fixture(scope="module")
+def client():
+    app = Flask(__name__)
+    initialize_app(app, Blueprint("tdt", __name__))
+    return app.test_client()
+
+
+@pytest.mark.parametrize("url", ["/api/browser/{}/table", "/api/data/{}/table", "/api/init_taxonomy/{}",
+                                 "/api/init_status/{}"])
+def test_internal_folders_are_not_taxonomies(client, url, tmp_path, monkeypatch):
+    monkeypatch.setattr(taxonomy_service, "TAXONOMIES_VOLUME", str(tmp_path))
+    for folder in (".snapshots", ".locks", ".mirrors", ".jobs", ".search"):
+        os.makedirs(tmp_path / folder)
+    (tmp_path / "Makefile").write_text("init:\n\ttouch built\n")
+    submitted = []
+    monkeypatch.setattr(init_manager, "submit", lambda *args, **kwargs: submitted.append(args))
+
+    for taxonomy in (".snapshots", ".locks", ".mirrors", ".jobs", ".search", "missing", "..", "."):
+        response = client.get(url.format(taxonomy))
+        assert response.status_code == 404, taxonomy
+    assert submitted == []
+    assert not (tmp_path / "built").exists()
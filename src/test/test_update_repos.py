@@ -0,0 +1,94 @@
+import os
+import json
+import subprocess
+
+from tdt_api.scripts.update_repos import update_repos, update_run_sh, run_sh_version, main, upgrade_taxonomy_task
+from tdt_api.utils.job_manager import JobManager
+
+RUN_SH = """#!/bin/sh
+IMAGE=${IMAGE:-taxonomy-development-tools:1.0.0}
+docker run -ti --rm $IMAGE
+"$@"
+"""
+
+MAKEFILE = """upgrade:
+\techo upgraded >> upgrades.log
+"""
+
+
+def create_taxonomy(folder, name, makefile=MAKEFILE):
+    taxonomy_dir = os.path.join(folder, name)
+    os.makedirs(taxonomy_dir)
+    with open(os.path.join(taxonomy_dir, 'run.sh'), 'w') as file:
+        # docker is not needed by the tests, run.sh runs the make target directly
+        file.write(RUN_SH.replace("docker run -ti --rm $IMAGE", "echo docker run -ti --rm $IMAGE > /dev/null"))
+    with open(os.path.join(taxonomy_dir, 'Makefile'), 'w') as file:
+        file.write(makefile)
+    return taxonomy_dir
+
+
+def upgrades(taxonomy_dir):
+    path = os.path.join(taxonomy_dir, 'upgrades.log')
+    return len(open(path).readlines()) if os.path.exists(path) else 0
+
+
+def test_update_run_sh_sets_the_image_version_once(tmp_path):
+    with open(tmp_path / 'run.sh', 'w') as file:
+        file.write(RUN_SH)
+    update_run_sh(str(tmp_path), '2.1.0')
+
+    content = open(tmp_path / 'run.sh').read()
+    assert content.count('IMAGE=') == 1
+    assert run_sh_version(str(tmp_path)) == '2.1.0'
+    assert ' -ti ' not in content
+
+
+def test_rerun_skips_upgraded_repositories(tmp_path):
+    repositories = {f'https://example.org/org/tax_{i}': 'main' for i in range(3)}
+    broken = os.path.join(tmp_path, 'tax_2')
+    dirs = [create_taxonomy(str(tmp_path), 'tax_0'), create_taxonomy(str(tmp_path), 'tax_1'),
+            create_taxonomy(str(tmp_path), 'tax_2', makefile="upgrade:\n\texit 1\n")]
+
+    summary = update_repos(repositories, '2.1.0', str(tmp_path), runner=JobManager(max_workers=3, db_path=''))
+    assert [row["status"] for row in summary] == ['succeeded', 'succeeded', 'failed']
+    assert json.load(open(tmp_path / '.upgrade_state.json')).keys() == {'tax_0', 'tax_1'}
+
+    # fix the broken repository and run again: only it is upgraded
+    with open(os.path.join(broken, 'Makefile'), 'w') as file:
+        file.write(MAKEFILE)
+    summary = update_repos(repositories, '2.1.0', str(tmp_path), runner=JobManager(max_workers=3, db_path=''))
+    assert [row["status"] for row in summary] == ['skipped', 'skipped', 'succeeded']
+    assert [upgrades(taxonomy_dir) for taxonomy_dir in dirs] == [1, 1, 1]
+
+
+def test_dry_run_changes_nothing(tmp_path, capsys):
+    taxonomy_dir = create_taxonomy(str(tmp_path), 'tax_0')
+    with open(tmp_path / 'repositories.json', 'w') as file:
+        json.dump({'https://example.org/org/tax_0.git': 'main', 'https://example.org/org/new.git': 'main'}, file)
+
+    status = main(['--version', '2.1.0', '--folder', str(tmp_path), '--repositories',
+                   str(tmp_path / 'repositories.json'), '--dry-run'])
+
+    assert status == 0
+    assert run_sh_version(taxonomy_dir) == '1.0.0'
+    assert not os.path.exists(tmp_path / 'new')
+    output = capsys.readouterr().out
+    assert 'tax_0' in output and 'upgrade' in output
+    assert 'new' in output and 'clone' in output
+
+
+def test_repository_values_are_not_run_by_the_shell(tmp_path):
+    # the repository URL and the branch come from the --repositories file
+    source = create_taxonomy(str(tmp_path / 'source'), 'tax;touch pwned')
+    env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com', GIT_COMMITTER_NAME='test',
+               GIT_COMMITTER_EMAIL='test@example.com')
+    for command in (['git', 'init', '-q', '-b', 'main'], ['git', 'add', '-A'], ['git', 'commit', '-q', '-m', 'init']):
+        subprocess.run(command, cwd=source, env=env, check=True)
+    taxonomies = tmp_path / 'taxonomies'
+    taxonomies.mkdir()
+
+    upgrade_taxonomy_task('file://' + source, 'main;touch pwned', '2.1.0', str(taxonomies))
+
+    assert upgrades(str(taxonomies / 'tax;touch pwned')) == 1
+    assert not os.path.exists(taxonomies / 'pwned')
+    assert not os.path.exists(taxonomies / 'tax;touch pwned' / 'pwned')
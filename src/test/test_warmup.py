@@ -0,0 +1,73 @@
+import os
+import sqlite3
+
+from tdt_api.utils import sqlite_reader, snapshots
+from tdt_api.utils.init_manager import RLTBL_DB
+from tdt_api.utils.taxonomy_index import taxonomy_index
+from tdt_api.utils.warmup import Warmup, preload_file, warm_taxonomy
+
+
+def create_taxonomy(folder, name, initialized=True):
+    taxonomy_dir = os.path.join(folder, name)
+    os.makedirs(os.path.join(taxonomy_dir, '.relatable'))
+    with open(os.path.join(taxonomy_dir, 'Makefile'), 'w') as file:
+        file.write("init:\n\tpython3 -c \"import sqlite3; sqlite3.connect('.relatable/relatable.db')"
+                   ".execute('CREATE TABLE t (a)')\"\n")
+    if initialized:
+        connection = sqlite3.connect(os.path.join(taxonomy_dir, RLTBL_DB))
+        connection.execute("CREATE TABLE t (a)")
+        connection.executemany("INSERT INTO t VALUES (?)", [('x' * 100,)] * 1000)
+        connection.commit()
+        connection.close()
+    return taxonomy_dir
+
+
+def test_preload_file_reads_up_to_the_limit(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'x' * 3000)
+
+    assert preload_file(str(path), max_bytes=1000) == 1000
+    assert preload_file(str(path), max_bytes=10000) == 3000
+    assert preload_file(str(tmp_path / 'missing')) == 0
+
+
+def test_warm_taxonomy_opens_the_database_connections(tmp_path):
+    taxonomy_dir = create_taxonomy(str(tmp_path), 'warm_tax')
+
+    details = warm_taxonomy('warm_tax', taxonomy_dir)
+
+    assert details["preloaded_bytes"] == os.path.getsize(os.path.join(taxonomy_dir, RLTBL_DB))
+    pool = sqlite_reader.get_pool('warm_tax', os.path.join(taxonomy_dir, RLTBL_DB))
+    assert details["connections"] == pool.size == pool.created
+    sqlite_reader.close_pools()
+
+
+def test_warm_pool_is_used_by_the_requests(tmp_path):
+    taxonomy_dir = create_taxonomy(str(tmp_path), 'snapshot_tax')
+    snapshots.build(taxonomy_dir, lambda folder: None)
+    assert os.path.islink(taxonomy_dir)
+
+    warm_taxonomy('snapshot_tax', taxonomy_dir)
+    pool = sqlite_reader.get_pool('snapshot_tax', os.path.join(taxonomy_dir, RLTBL_DB))
+    # the data endpoint opens the database of the snapshot it leased
+    with snapshots.acquire(taxonomy_dir) as lease:
+        assert sqlite_reader.get_pool('snapshot_tax', os.path.join(lease.path, RLTBL_DB)) is pool
+    assert pool.created == pool.size and not pool.closed
+    sqlite_reader.close_pools()
+
+
+def test_ready_once_all_taxonomies_are_initialized_and_warm(tmp_path, monkeypatch):
+    create_taxonomy(str(tmp_path), 'tax_a')
+    cold_dir = create_taxonomy(str(tmp_path), 'tax_b', initialized=False)
+    monkeypatch.setattr(taxonomy_index, 'entries', {'tax_a': {'name': 'tax_a'}, 'tax_b': {'name': 'tax_b'}})
+
+    warmup = Warmup(enabled=True)
+    assert not warmup.ready
+    warmup.run(str(tmp_path))
+
+    status = warmup.status()
+    assert status["ready"] and status["warmup"] == "complete"
+    assert os.path.exists(os.path.join(cold_dir, RLTBL_DB))
+    assert {details["status"] for details in status["taxonomies"].values()} == {"warm"}
+    assert Warmup(enabled=False).ready
+    sqlite_reader.close_pools()